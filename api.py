@@ -0,0 +1,312 @@
+"""JSON API for Blogly, mounted at /api/v1.
+
+Listings use the same keyset-paginated query functions as the HTML views,
+but select only the columns a client asks for and serialize the resulting
+row tuples directly, without building ORM instances:
+
+  fields=title,created_at   attributes of the primary resource
+  fields[users]=last_name   attributes of included resources
+  include=user,tags         related resources of posts, one query per relation
+  sort=popular              users and tags with the most posts first
+  after=… / before=…        cursors from the "links" of a previous page
+
+POST /users/<id>/posts creates a batch of posts in one transaction.
+"""
+
+import json
+from datetime import datetime
+from flask import Blueprint, Response, current_app, request, url_for
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Post, Tag, PostTag, DeletionJob
+from pagination import InvalidCursor
+from querybudget import query_budget
+
+bp = Blueprint("api", __name__)
+
+MODELS = {"users": User, "posts": Post, "tags": Tag}
+
+# Attributes a client may ask for; content is only read from the database when requested
+FIELDS = {
+    "users": ("first_name", "last_name", "image_url", "updated_at", "post_count"),
+    "posts": ("title", "excerpt", "content", "created_at", "updated_at", "user_id"),
+    "tags": ("name", "updated_at", "post_count"),
+}
+DEFAULT_FIELDS = {
+    "users": ("first_name", "last_name", "image_url"),
+    "posts": ("title", "created_at", "user_id"),
+    "tags": ("name",),
+}
+INCLUDES = {"posts": ("user", "tags")}
+
+
+class ApiError(Exception):
+    """An error reported to the client as {"error": message}"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+@bp.errorhandler(ApiError)
+def handle_api_error(e):
+    return json_response({"error": str(e)}, e.status)
+
+
+@bp.errorhandler(InvalidCursor)
+def handle_invalid_cursor(e):
+    return json_response({"error": "Invalid page cursor"}, 400)
+
+
+def json_response(document, status=200):
+    body = json.dumps(document, default=_json_default, separators=(",", ":"))
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can't serialize {type(value).__name__}")
+
+
+def requested_fields(kind, primary=False):
+    """Attribute names for kind from fields[kind]= (or fields= for the primary resource).
+
+    For the primary resource, include= is checked here too.
+    """
+
+    raw = request.args.get(f"fields[{kind}]")
+    if primary:
+        requested_includes(kind)
+        if raw is None:
+            raw = request.args.get("fields")
+    if raw is None:
+        return DEFAULT_FIELDS[kind]
+
+    names = tuple(name for name in raw.split(",") if name)
+    unknown = [name for name in names if name not in FIELDS[kind]]
+    if unknown:
+        raise ApiError(f"Unknown {kind} field(s): {', '.join(unknown)}")
+    return names
+
+
+def requested_includes(kind):
+    names = tuple(name for name in request.args.get("include", "").split(",") if name)
+    unknown = [name for name in names if name not in INCLUDES.get(kind, ())]
+    if unknown:
+        raise ApiError(f"Can't include {', '.join(unknown)} with {kind}")
+    return names
+
+
+def columns_for(kind, names):
+    """id followed by the named columns; serialize() relies on this order"""
+
+    model = MODELS[kind]
+    return [model.id] + [getattr(model, name) for name in names]
+
+
+def serialize(rows, names):
+    """Dicts of id plus names from rows that start with those columns (extra key columns are dropped)"""
+
+    keys = ("id",) + tuple(names)
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def page_links(page):
+    args = {key: value for key, value in request.args.items() if key not in ("after", "before")}
+    args.update(request.view_args)
+    links = {}
+    if page.next_cursor:
+        links["next"] = url_for(request.endpoint, after=page.next_cursor, **args)
+    if page.prev_cursor:
+        links["prev"] = url_for(request.endpoint, before=page.prev_cursor, **args)
+    return links
+
+
+def get_row(kind, item_id, names):
+    row = db.session.query(*columns_for(kind, names)).filter(MODELS[kind].id == item_id).first()
+    if row is None:
+        raise ApiError(f"No {kind[:-1]} with id {item_id}", 404)
+    return serialize([row], names)[0]
+
+
+def post_names():
+    """Requested post fields, with user_id added when the user is included"""
+
+    names = requested_fields("posts", primary=True)
+    if "user" in requested_includes("posts") and "user_id" not in names:
+        names += ("user_id",)
+    return names
+
+
+def include_related(posts):
+    """Adds included users and tags for a list of post dicts: one query per relation"""
+
+    includes = requested_includes("posts")
+    included = {}
+
+    if "user" in includes and posts:
+        names = requested_fields("users")
+        user_ids = {post["user_id"] for post in posts}
+        rows = db.session.query(*columns_for("users", names)).filter(User.id.in_(user_ids))
+        included["users"] = serialize(rows, names)
+
+    if "tags" in includes and posts:
+        names = requested_fields("tags")
+        by_id = {post["id"]: post for post in posts}
+        for post in posts:
+            post["tag_ids"] = []
+        rows = (db.session.query(PostTag.post_id, *columns_for("tags", names))
+                .join(Tag, Tag.id == PostTag.tag_id)
+                .filter(PostTag.post_id.in_(by_id))
+                .order_by(Tag.name))
+        tags = {}
+        for post_id, *tag in rows:
+            by_id[post_id]["tag_ids"].append(tag[0])
+            tags.setdefault(tag[0], tag)
+        included["tags"] = serialize(tags.values(), names)
+
+    return included
+
+
+def post_page_response(page, names):
+    data = serialize(page.items, names)
+    document = {"data": data, "links": page_links(page)}
+    included = include_related(data)
+    if included:
+        document["included"] = included
+    return json_response(document)
+
+
+### Users ###
+
+
+@bp.route("/users")
+@query_budget(1)
+def list_users():
+    """Users ordered by name"""
+    names = requested_fields("users", primary=True)
+    page = User.get_page(request.args.get("after"), request.args.get("before"),
+                         columns=columns_for("users", names), sort=request.args.get("sort"))
+    return json_response({"data": serialize(page.items, names), "links": page_links(page)})
+
+
+@bp.route("/users/<int:user_id>")
+@query_budget(1)
+def get_user(user_id):
+    """One user"""
+    return json_response({"data": get_row("users", user_id, requested_fields("users", primary=True))})
+
+
+@bp.route("/users/<int:user_id>/posts")
+@query_budget(3)
+def list_user_posts(user_id):
+    """A user's posts, newest first"""
+    names = post_names()
+    page = Post.get_page(request.args.get("after"), request.args.get("before"),
+                         columns=columns_for("posts", names), user_id=user_id)
+    return post_page_response(page, names)
+
+
+@bp.route("/users/<int:user_id>/posts", methods=["POST"])
+def create_user_posts(user_id):
+    """Creates a batch of posts for a user from {"data": [post, ...]}, all in one transaction.
+
+    Each post has title and content, and optionally tags (names),
+    created_at and idempotency_key. The response lists one result per post,
+    in order. It is 201 when any post was created, or 200 when every key had
+    been used before. It is 422 when any post is invalid; nothing is
+    written then.
+    """
+    if db.session.query(User.id).filter(User.id == user_id).first() is None:
+        raise ApiError(f"No user with id {user_id}", 404)
+    document = request.get_json(silent=True)
+    items = document.get("data") if isinstance(document, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ApiError('Expected {"data": [post, ...]}')
+    limit = current_app.config["POST_BATCH_LIMIT"]
+    if len(items) > limit:
+        raise ApiError(f"At most {limit:,} posts per request", 413)
+
+    try:
+        results = Post.create_batch(user_id, items)
+        if any(result["status"] == "invalid" for result in results):
+            db.session.rollback()
+            return json_response({"error": "Invalid posts; none were created", "data": results}, 422)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ApiError("Another request created some of these posts at the same time; retry", 409)
+
+    created = any(result["status"] == "created" for result in results)
+    return json_response({"data": results}, 201 if created else 200)
+
+
+### Posts ###
+
+
+@bp.route("/posts")
+@query_budget(3)
+def list_posts():
+    """All posts, newest first"""
+    names = post_names()
+    page = Post.get_page(request.args.get("after"), request.args.get("before"),
+                         columns=columns_for("posts", names))
+    return post_page_response(page, names)
+
+
+@bp.route("/posts/<int:post_id>")
+@query_budget(3)
+def get_post(post_id):
+    """One post"""
+    post = get_row("posts", post_id, post_names())
+    document = {"data": post}
+    included = include_related([post])
+    if included:
+        document["included"] = included
+    return json_response(document)
+
+
+### Tags ###
+
+
+@bp.route("/tags")
+@query_budget(1)
+def list_tags():
+    """Tags ordered by name"""
+    names = requested_fields("tags", primary=True)
+    page = Tag.get_page(request.args.get("after"), request.args.get("before"),
+                        columns=columns_for("tags", names), sort=request.args.get("sort"))
+    return json_response({"data": serialize(page.items, names), "links": page_links(page)})
+
+
+@bp.route("/tags/<int:tag_id>")
+@query_budget(1)
+def get_tag(tag_id):
+    """One tag"""
+    return json_response({"data": get_row("tags", tag_id, requested_fields("tags", primary=True))})
+
+
+@bp.route("/tags/<int:tag_id>/posts")
+@query_budget(3)
+def list_tag_posts(tag_id):
+    """A tag's posts, newest first"""
+    names = post_names()
+    page = Post.get_page_for_tag(tag_id, request.args.get("after"), request.args.get("before"),
+                                 columns=columns_for("posts", names))
+    return post_page_response(page, names)
+
+
+### Deletions ###
+
+
+@bp.route("/deletions/<int:job_id>")
+@query_budget(1)
+def get_deletion(job_id):
+    """Progress of a background user or tag deletion"""
+    job = DeletionJob.query.get(job_id)
+    if job is None:
+        raise ApiError(f"No deletion with id {job_id}", 404)
+    return json_response({"data": {
+        "id": job.id, "kind": job.kind, "target_id": job.target_id, "status": job.status,
+        "total": job.total, "deleted": job.deleted, "error": job.error, "updated_at": job.updated_at,
+    }})
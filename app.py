@@ -1,58 +1,111 @@
 """Blogly application."""
 
-from pydoc import render_doc
-from flask import Flask, render_template, redirect, request
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, abort, render_template, redirect, request, url_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 from models import db, connect_db
-from models import User, Post, Tag, PostTag
+from models import User, Post, Tag, Feed
+from querybudget import query_budget
+from pagination import InvalidCursor
+from cli import blogly_cli
+from pagecache import cached_page, cached_stream, init_page_cache
+from streaming import stream_template
+from conditional import conditional
+from search import search_posts
+from identitycache import init_identity_cache
+from metrics import init_metrics
+from config import CONFIGS, engine_options
+from replicas import init_replicas, use_primary
+import api
+import assets
+import atom
+import avatars
+import deletions
+import migrations
 import os
 
-app = Flask(__name__)
+bp = Blueprint("blogly", __name__)
 
-# Specify the database
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///blogly"
 
-# Default is True, turn off to prevent overhead
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+def create_app(config=None, **settings):
+    """Builds the app for a profile name or config class, with optional overrides.
 
-# Prints all SQL statements to terminal
-app.config["SQLALCHEMY_ECHO"] = True
+    The profile defaults to BLOGLY_CONFIG (or "development"). Nothing touches
+    the database here unless AUTO_MIGRATE is set.
+    """
 
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or "something"
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
-debug = DebugToolbarExtension(app)
+    config = config or os.environ.get("BLOGLY_CONFIG", "development")
+    app = Flask(__name__)
+    app.config.from_object(CONFIGS[config] if isinstance(config, str) else config)
+    app.config.update(settings)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
+
+    if app.config["DEBUG_TOOLBAR"]:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    if app.config["AUTO_MIGRATE"]:
+        migrations.upgrade(db.engine)
+    init_page_cache(app)
+    init_identity_cache(app)
+    init_metrics(app)
+    init_replicas(app)
+    assets.init_assets(app)
+    avatars.init_avatars(app)
+    deletions.init_deletions(app)
+    app.register_blueprint(bp)
+    app.register_blueprint(api.bp, url_prefix="/api/v1")
+    app.cli.add_command(blogly_cli)
+    return app
+
+
+@bp.app_errorhandler(InvalidCursor)
+def handle_invalid_cursor(e):
+    """Rejects tampered or stale page cursors"""
+    return "Invalid page cursor", 400
 
-connect_db(app)
-db.create_all()
 
 ### User View Functions ###
 
 
-@app.route("/")
+@bp.route("/")
+@cached_page
+@query_budget(4)
 def show_home_page():
-    """Redirects to users page"""
-    newest_posts = Post.get_newest_posts()
+    """Shows the home feed: one key lookup and one for tag names (two more if it isn't stored yet)"""
+    newest_posts = Feed.get_entries("home")
 
     return render_template("/home.html", newest_posts=newest_posts)
 
 
-@app.route("/users")
+@bp.route("/users")
+@conditional(User.get_list_version)
+@query_budget(1)
 def show_users_page():
     """Shows list of all users"""
 
-    users = User.query.order_by(User.last_name)
-    return render_template("base.html", users=users)
+    sort = request.args.get("sort")
+    page = User.get_page(request.args.get("after"), request.args.get("before"), sort=sort)
+    return render_template("base.html", users=page.items, page=page, sort=sort)
 
 
-@app.route("/users/<int:user_id>")
+@bp.route("/users/<int:user_id>")
+@conditional(User.get_version)
+@cached_stream("text/html")
+@query_budget(3)
 def show_user_details(user_id):
-    """Shows user details"""
+    """Shows user details; the post list streams from a server-side cursor as it renders.
 
-    user = User.query.get(user_id)
-    return render_template("userdetails.html", user=user)
+    The budget covers the user (free when it is in the identity cache), the streamed post titles
+    and the identity cache's version check, which a worker runs at most once a second.
+    """
 
+    user = User.query.get(user_id) or abort(404)
+    return stream_template("userdetails.html", user=user, posts=Post.stream_titles(user_id))
 
-@app.route("/users/<int:user_id>/edit", methods=["GET", "POST"])
+
+@bp.route("/users/<int:user_id>/edit", methods=["GET", "POST"])
 def show_edit_page(user_id):
     """Shows edit page for user"""
 
@@ -66,22 +119,34 @@ def show_edit_page(user_id):
         user.last_name = request.form.get("last_name")
         user.image_url = request.form.get("image_url")
         db.session.add(user)
+        Feed.rename_author(user)
         db.session.commit()
+        avatars.prefetch(user.image_url)
         return redirect("/")
 
 
-@app.route("/users/<int:user_id>/delete")
+@bp.route("/users/<int:user_id>/delete")
+@use_primary
 def delete_user(user_id):
     """Deletes user"""
 
     user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return redirect("/")
+    if deletions.should_defer(user.post_count):
+        deletions.enqueue("user", user_id, user.post_count)
+        return redirect("/")
+
+    Tag.subtract_user_posts(user_id)
+    feeds = Feed.names_for_user(user_id)
     db.session.delete(user)
+    Feed.remove_user(user_id, feeds)
     db.session.commit()
 
     return redirect("/")
 
 
-@app.route("/users/new", methods=["GET", "POST"])
+@bp.route("/users/new", methods=["GET", "POST"])
 def show_add_users_page():
     """Shows page to add a new user"""
 
@@ -91,21 +156,20 @@ def show_add_users_page():
     if request.method == "POST":
         first = request.form.get("first_name")
         last = request.form.get("last_name")
-        image = request.form.get("image_url")
-
-        if not image:
-            image = "https://m.media-amazon.com/images/I/51zLZbEVSTL._AC_SL1200_.jpg"
+        # without an image the page shows the avatar placeholder
+        image = request.form.get("image_url") or None
 
         new_user = User(first_name=first, last_name=last, image_url=image)
         db.session.add(new_user)
         db.session.commit()
+        avatars.prefetch(image)
         return redirect("/users")
 
 
 ### Post View Functions ###
 
 
-@app.route("/users/<int:user_id>/posts/new", methods=["GET", "POST"])
+@bp.route("/users/<int:user_id>/posts/new", methods=["GET", "POST"])
 def create_post(user_id):
     """Create new post"""
 
@@ -119,65 +183,67 @@ def create_post(user_id):
         content = request.form.get("content")
         new_post = Post(title=title, content=content, user_id=user_id)
         db.session.add(new_post)
-        db.session.commit()
-
-        selected_tags = request.form.getlist("check")
-        # loop through each selected tag, if any, and add to db
-        if selected_tags:
-            for name in selected_tags:
-                tag_id = Tag.query.filter_by(name=name).first().id
-                db.session.add(PostTag(post_id=new_post.id, tag_id=tag_id))
+        new_post.set_tags(request.form.getlist("check", type=int))
+        User.change_post_count(user_id, 1)
+        Feed.update_post(new_post.id, user_id)
 
         db.session.commit()
         return redirect(f"/users/{user_id}")
 
 
-@app.route("/posts/<int:post_id>")
+@bp.route("/posts/<int:post_id>")
+@conditional(Post.get_version)
+@cached_page
+@query_budget(5)
 def show_post(post_id):
-    """Show post contents"""
+    """Show post contents: two queries, plus one each for an author or tags not in the identity cache.
 
-    post = Post.query.get(post_id)
+    One more when the identity cache checks its version, at most once a second per worker.
+    """
+
+    post = Post.get_for_page(post_id)
     return render_template("post.html", post=post)
 
 
-@app.route("/posts/<int:post_id>/edit", methods=["GET", "POST"])
+@bp.route("/posts/<int:post_id>/edit", methods=["GET", "POST"])
 def edit_post(post_id):
     """Edit post"""
 
-    post = Post.query.get(post_id)
-    user = post.user
-    tags = Tag.get_all_tags()
+    post = Post.query.options(undefer(Post.content)).get(post_id)
 
     if request.method == "GET":
-        return render_template("postedits.html", post=post, user=user, tags=tags)
+        user = post.user
+        tags = Tag.get_all_tags()
+        tag_ids = {post_tag.tag_id for post_tag in post.post_tags}
+        return render_template(
+            "postedits.html", post=post, user=user, tags=tags, tag_ids=tag_ids
+        )
 
     if request.method == "POST":
-        post.title = request.form.get("title")
+        title = request.form.get("title")
+        if title != post.title:
+            post.touch_listing_pages()
+        post.title = title
         post.content = request.form.get("content")
-        selected_tags = request.form.getlist("check")
-
-        # delete all tags for this post
-        PostTag.query.filter_by(post_id=post_id).delete()
-
-        # loop through each selected tag, if any, and add to db
-        if selected_tags:
-            for name in selected_tags:
-                tag_id = Tag.query.filter_by(name=name).first().id
-                db.session.add(PostTag(post_id=post_id, tag_id=tag_id))
+        added, removed = post.set_tags(request.form.getlist("check", type=int))
+        Feed.update_post(post_id, post.user_id, removed)
 
         db.session.commit()
         return redirect(f"/posts/{post_id}")
 
 
-@app.route("/posts/<int:post_id>/delete")
+@bp.route("/posts/<int:post_id>/delete")
+@use_primary
 def delete_post(post_id):
     """Delete post"""
 
     post = Post.query.get(post_id)
     user = post.user
 
-    PostTag.query.filter_by(post_id=post_id).delete()
+    added, removed = post.set_tags([])
+    User.change_post_count(user.id, -1)
     Post.query.filter_by(id=post_id).delete()
+    Feed.update_post(post_id, user.id, removed)
     db.session.commit()
 
     return redirect(f"/users/{user.id}")
@@ -186,21 +252,30 @@ def delete_post(post_id):
 ### Tag View Functions ###
 
 
-@app.route("/tags")
+@bp.route("/tags")
+@conditional(Tag.get_list_version)
+@cached_page
+@query_budget(1)
 def show_tags():
     """List all tags"""
-    tags = Tag.get_all_tags()
-    return render_template("tags.html", tags=tags)
+    sort = request.args.get("sort")
+    page = Tag.get_page(request.args.get("after"), request.args.get("before"), sort=sort)
+    return render_template("tags.html", tags=page.items, page=page, sort=sort)
 
 
-@app.route("/tags/<int:tag_id>")
+@bp.route("/tags/<int:tag_id>")
+@conditional(Tag.get_version)
+@cached_page
+@query_budget(3)
 def show_tag_details(tag_id):
-    """Show tag details"""
+    """Show tag details: the tag (free when in the identity cache, bar its version check) and posts"""
     tag = Tag.query.get(tag_id)
-    return render_template("tagdetails.html", tag=tag)
+    page = Post.get_page_for_tag(tag_id, request.args.get("after"), request.args.get("before"),
+                                 columns=(Post.id, Post.title))
+    return render_template("tagdetails.html", tag=tag, posts=page.items, page=page)
 
 
-@app.route("/tags/new", methods=["GET", "POST"])
+@bp.route("/tags/new", methods=["GET", "POST"])
 def add_tag():
     """Show form to add new tag or add new tag"""
     if request.method == "GET":
@@ -210,11 +285,16 @@ def add_tag():
         tag = request.form.get("tag")
         new_tag = Tag(name=tag)
         db.session.add(new_tag)
-        db.session.commit()
+        try:
+            Tag.bump_version()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return render_template("tagform.html", error=f"Tag {tag} already exists"), 409
         return redirect("/tags")
 
 
-@app.route("/tags/<int:tag_id>/edit", methods=["GET", "POST"])
+@bp.route("/tags/<int:tag_id>/edit", methods=["GET", "POST"])
 def edit_tag(tag_id):
     """Edit tag"""
     tag = Tag.query.get(tag_id)
@@ -224,14 +304,75 @@ def edit_tag(tag_id):
 
     if request.method == "POST":
         tag.name = request.form.get("name")
-        db.session.commit()
+        try:
+            Tag.bump_version()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            tag = Tag.query.get(tag_id)
+            error = f"Tag {request.form.get('name')} already exists"
+            return render_template("tagedits.html", tag=tag, error=error), 409
         return redirect("/tags")
 
 
-@app.route("/tags/<int:tag_id>/delete", methods=["POST"])
+@bp.route("/tags/<int:tag_id>/delete", methods=["POST"])
 def delete_tag(tag_id):
     """Delete tag"""
-    PostTag.query.filter_by(tag_id=tag_id).delete()
+    tag = Tag.query.get(tag_id)
+    if tag is None:
+        return redirect("/tags")
+    if deletions.should_defer(tag.post_count):
+        deletions.enqueue("tag", tag_id, tag.post_count)
+        return redirect("/tags")
+
     Tag.query.filter_by(id=tag_id).delete()
+    Feed.query.filter_by(name=f"tag:{tag_id}").delete()
+    Tag.bump_version()
     db.session.commit()
     return redirect("/tags")
+
+
+### Atom Feeds ###
+
+
+@bp.route("/feed.atom")
+@conditional(lambda: atom.feed_version("home"))
+@cached_stream(atom.MIMETYPE)
+def home_feed():
+    """Atom feed of the newest posts"""
+    return atom.generate("home", "Blogly Recent Posts", url_for(".home_feed", _external=True),
+                         url_for(".show_home_page", _external=True))
+
+
+@bp.route("/users/<int:user_id>/feed.atom")
+@conditional(lambda user_id: atom.feed_version(f"user:{user_id}"))
+@cached_stream(atom.MIMETYPE)
+def user_feed(user_id):
+    """Atom feed of a user's newest posts"""
+    user = User.query.get(user_id) or abort(404)
+    return atom.generate(f"user:{user_id}", f"Posts by {user.get_full_name()}",
+                         url_for(".user_feed", user_id=user_id, _external=True),
+                         url_for(".show_user_details", user_id=user_id, _external=True))
+
+
+@bp.route("/tags/<int:tag_id>/feed.atom")
+@conditional(lambda tag_id: atom.feed_version(f"tag:{tag_id}"))
+@cached_stream(atom.MIMETYPE)
+def tag_feed(tag_id):
+    """Atom feed of a tag's newest posts"""
+    tag = Tag.query.get(tag_id) or abort(404)
+    return atom.generate(f"tag:{tag_id}", f"Posts tagged {tag.name}",
+                         url_for(".tag_feed", tag_id=tag_id, _external=True),
+                         url_for(".show_tag_details", tag_id=tag_id, _external=True))
+
+
+### Search View Functions ###
+
+
+@bp.route("/search")
+@query_budget(2)
+def search():
+    """Search posts by title and content"""
+    q = request.args.get("q", "")
+    page = search_posts(q, request.args.get("after"))
+    return render_template("search.html", q=q, hits=page.items, page=page)
@@ -0,0 +1,209 @@
+"""Static asset pipeline for Blogly.
+
+`flask blogly build-assets` copies every file in static/ to static/dist/
+under a content-hashed name (styles.css -> styles.3f2a9c0d1b7e.css), writes
+.gz and, when the optional brotli package is installed, .br variants next to
+it, and records the names in static/dist/manifest.json.
+
+Templates link assets with asset_url("styles.css"). Hashed files are served
+from memory with the best precompressed variant the client accepts and
+Cache-Control: immutable, since a changed file gets a new name. Before a
+build, asset_url falls back to the plain /static URL.
+
+With COMPRESS_HTML set, HTML responses are gzipped on the fly as well.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import zlib
+from flask import Response, abort, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MANIFEST = "manifest.json"
+HASH_LENGTH = 12
+ONE_YEAR = 365 * 24 * 3600
+
+# Types that are already compressed, or too small to gain from it
+SKIP_COMPRESSION = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".woff", ".woff2", ".gz", ".br", ".zip")
+MIN_COMPRESS_SIZE = 256
+EXTENSIONS = {"gzip": ".gz", "br": ".br"}
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def hashed_name(name, data):
+    """styles.css -> styles.<hash>.css"""
+
+    root, ext = os.path.splitext(name)
+    return f"{root}.{fingerprint(data)}{ext}"
+
+
+def compressed_variants(data):
+    """{encoding: body} for the encodings worth storing"""
+
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def build(source, dest):
+    """Fingerprints and precompresses every file under source into dest.
+
+    dest is emptied first and skipped while walking source. Returns the
+    manifest: {relative name: hashed relative name}.
+    """
+
+    shutil.rmtree(dest, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dest)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, source).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+
+            hashed = hashed_name(name, data)
+            manifest[name] = hashed
+            target = os.path.join(dest, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as f:
+                f.write(data)
+
+            if len(data) < MIN_COMPRESS_SIZE or filename.lower().endswith(SKIP_COMPRESSION):
+                continue
+            for encoding, body in compressed_variants(data).items():
+                with open(target + EXTENSIONS[encoding], "wb") as f:
+                    f.write(body)
+
+    with open(os.path.join(dest, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    """The built manifest, the asset_url helper and the hashed-file handler"""
+
+    def __init__(self, folder, url_path, static_url_path):
+        self.folder = folder
+        self.url_path = url_path
+        self.static_url_path = static_url_path
+        self._files = {}
+        try:
+            with open(os.path.join(folder, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, name):
+        """The URL for a static file: hashed once built, plain before"""
+
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return f"{self.static_url_path}/{name}"
+        return f"{self.url_path}/{hashed}"
+
+    def load(self, filename):
+        """{encoding or None: body} for a hashed file, read once and kept"""
+
+        files = self._files.get(filename)
+        if files is None:
+            if filename not in self.manifest.values():
+                return None
+            path = os.path.join(self.folder, filename)
+            files = {}
+            for encoding, ext in [(None, ""), *EXTENSIONS.items()]:
+                if os.path.exists(path + ext):
+                    with open(path + ext, "rb") as f:
+                        files[encoding] = f.read()
+            self._files[filename] = files
+        return files
+
+    def serve(self, filename):
+        files = self.load(filename)
+        if not files:
+            abort(404)
+
+        accepted = request.accept_encodings
+        encoding = next((e for e in ("br", "gzip") if e in files and accepted[e]), None)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        resp = Response(files[encoding], mimetype=mimetype)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        resp.vary.add("Accept-Encoding")
+        resp.set_etag(filename)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ONE_YEAR
+        resp.cache_control.immutable = True
+        return resp.make_conditional(request)
+
+
+def compress_response(response, level, min_size):
+    """Gzips an HTML response for a client that accepts it; streamed bodies chunk by chunk"""
+
+    if (response.mimetype != "text/html" or response.status_code != 200
+            or "Content-Encoding" in response.headers or response.direct_passthrough
+            or not request.accept_encodings["gzip"]):
+        return response
+
+    if response.is_streamed:
+        body = response.response
+
+        def chunks():
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            try:
+                for chunk in body:
+                    data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+                    # flush each chunk so the client still gets the page progressively
+                    yield data + compressor.flush(zlib.Z_SYNC_FLUSH)
+                yield compressor.flush()
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+
+        response.response = chunks()
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=level))
+
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    # the bytes differ from the uncompressed representation, so the validator is weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_assets(app):
+    """Loads the manifest, adds asset_url to templates, serves hashed files and compresses HTML"""
+
+    folder = app.config.get("ASSETS_FOLDER") or os.path.join(app.static_folder, "dist")
+    assets = Assets(folder, f"{app.static_url_path}/dist", app.static_url_path)
+    app.extensions["assets"] = assets
+    app.jinja_env.globals["asset_url"] = assets.url
+    app.add_url_rule(f"{app.static_url_path}/dist/<path:filename>", "dist_asset", assets.serve)
+
+    if app.config.get("COMPRESS_HTML"):
+        level = app.config.get("COMPRESS_LEVEL", 6)
+        min_size = app.config.get("COMPRESS_MIN_SIZE", 1024)
+
+        @app.after_request
+        def compress_html(response):
+            return compress_response(response, level, min_size)
+
+    return assets
@@ -0,0 +1,201 @@
+"""Async serving mode for Blogly's read routes.
+
+create_asgi_app() wraps the Flask app in an ASGI application. GET requests
+for the six read pages (/, /users, /users/<id>, /posts/<id>, /tags,
+/tags/<id>) are served by coroutines on a SQLAlchemy asyncio engine, so a
+slow query holds a connection but not a worker thread. Every other request,
+including all writes, goes to the unchanged Flask views through asgiref's
+WSGI adapter, which runs them in a thread pool.
+
+Needs the optional asyncpg (or aiosqlite), asgiref and an ASGI server:
+
+  uvicorn --factory asyncread:create_asgi_app
+
+The async pages render the same templates with the same eager-loading
+strategies as the sync views. They skip the page cache, conditional GETs and
+replica routing, which stay on the sync path.
+"""
+
+import os
+import re
+from urllib.parse import parse_qsl
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from sqlalchemy import select
+from sqlalchemy.orm import configure_mappers, joinedload, selectinload, undefer
+from app import create_app
+from models import User, Post, Tag, PostTag, Feed
+from pagination import Keyset, InvalidCursor
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+except ImportError:  # pragma: no cover
+    WsgiToAsgi = None
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_url(uri):
+    """The asyncio-driver equivalent of a sync database URI"""
+
+    scheme, rest = uri.split("://", 1)
+    return f"{ASYNC_DRIVERS[scheme.split('+')[0]]}://{rest}"
+
+
+def async_engine(config):
+    """An async engine with the same pool and timeout settings as the sync one"""
+
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if uri.startswith("postgresql"):
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+        if config["DB_STATEMENT_TIMEOUT_MS"]:
+            timeout = str(config["DB_STATEMENT_TIMEOUT_MS"])
+            options["connect_args"] = {"server_settings": {"statement_timeout": timeout}}
+    return create_async_engine(async_url(uri), **options)
+
+
+class NotFound(Exception):
+    """Raised by a read handler when the requested row doesn't exist"""
+
+
+### Read handlers: (session, args, *path ids) -> (template, context) ###
+
+
+def post_loaders():
+    """Same strategy as Post.with_user_and_tags()"""
+    return (joinedload(Post.user), selectinload(Post.post_tags).joinedload(PostTag.tags))
+
+
+async def get_or_404(session, statement):
+    item = (await session.execute(statement)).scalars().first()
+    if item is None:
+        raise NotFound()
+    return item
+
+
+async def show_home_page(session, args):
+    """Same reads as Feed.get_entries("home")"""
+    size = Feed.size()
+    entries = (await session.execute(select(Feed.entries).filter(Feed.name == "home"))).scalar()
+    if entries is None:
+        rows = (await session.execute(Feed.select_summaries("home", size))).all()
+        pairs = (await session.execute(Feed.select_tag_ids([row.id for row in rows]))).all()
+        entries = Feed.summarize(rows, pairs)
+    tag_names = (await session.execute(Feed.select_tag_names(entries))).all() if entries else []
+    return "home.html", {"newest_posts": Feed.decode(entries[:size], tag_names)}
+
+
+async def show_users_page(session, args):
+    keys, descending = User.page_keys(args.get("sort"))
+    keyset = Keyset(keys, args.get("after"), args.get("before"), descending=descending)
+    page = keyset.page((await session.execute(keyset.apply(select(User)))).scalars())
+    return "base.html", {"users": page.items, "page": page, "sort": args.get("sort")}
+
+
+async def show_user_details(session, args, user_id):
+    user = await get_or_404(session, select(User).filter(User.id == user_id))
+    posts = (await session.execute(Post.stream_titles(user_id).statement)).all()
+    return "userdetails.html", {"user": user, "posts": posts}
+
+
+async def show_post(session, args, post_id):
+    post = await get_or_404(session, select(Post).options(*post_loaders(), undefer(Post.content))
+                            .filter(Post.id == post_id))
+    return "post.html", {"post": post}
+
+
+async def show_tags(session, args):
+    keys, descending = Tag.page_keys(args.get("sort"))
+    keyset = Keyset(keys, args.get("after"), args.get("before"), descending=descending)
+    page = keyset.page((await session.execute(keyset.apply(select(Tag)))).scalars())
+    return "tags.html", {"tags": page.items, "page": page, "sort": args.get("sort")}
+
+
+async def show_tag_details(session, args, tag_id):
+    tag = await get_or_404(session, select(Tag).filter(Tag.id == tag_id))
+    keyset = Keyset((Post.created_at, Post.id), args.get("after"), args.get("before"), descending=True)
+    statement = (select(Post).join(PostTag, PostTag.post_id == Post.id)
+                 .filter(PostTag.tag_id == tag_id))
+    page = keyset.page((await session.execute(keyset.apply(statement))).scalars())
+    return "tagdetails.html", {"tag": tag, "posts": page.items, "page": page}
+
+
+ROUTES = [
+    (re.compile(r"/"), show_home_page),
+    (re.compile(r"/users"), show_users_page),
+    (re.compile(r"/users/(\d+)"), show_user_details),
+    (re.compile(r"/posts/(\d+)"), show_post),
+    (re.compile(r"/tags"), show_tags),
+    (re.compile(r"/tags/(\d+)"), show_tag_details),
+]
+
+
+class AsyncReadApp:
+    """ASGI app: async read routes in front of the Flask app"""
+
+    def __init__(self, flask_app):
+        # backrefs such as Post.user only exist once the mappers are configured
+        configure_mappers()
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.engine = async_engine(flask_app.config)
+        self.templates = Environment(
+            loader=FileSystemLoader(os.path.join(flask_app.root_path, flask_app.template_folder)),
+            autoescape=select_autoescape(["html"]))
+        self.templates.globals["asset_url"] = flask_app.extensions["assets"].url
+        self.templates.globals["avatar_url"] = flask_app.extensions["avatars"].url
+
+    def match(self, scope):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return None
+        for pattern, handler in ROUTES:
+            found = pattern.fullmatch(scope["path"])
+            if found:
+                return handler, [int(value) for value in found.groups()]
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        route = self.match(scope)
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+
+        handler, ids = route
+        args = dict(parse_qsl(scope["query_string"].decode()))
+        try:
+            async with AsyncSession(self.engine) as session:
+                template, context = await handler(session, args, *ids)
+                status, body = 200, self.templates.get_template(template).render(context)
+        except NotFound:
+            status, body = 404, "Not Found"
+        except InvalidCursor:
+            status, body = 400, "Invalid page cursor"
+
+        data = body.encode()
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"text/html; charset=utf-8"),
+            (b"content-length", str(len(data)).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else data})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_asgi_app(config=None, **settings):
+    """The ASGI entry point: create_app() plus the async read routes"""
+
+    if WsgiToAsgi is None:
+        raise RuntimeError("async serving needs asgiref and an asyncio database driver (asyncpg)")
+    return AsyncReadApp(create_app(config, **settings))
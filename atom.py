@@ -0,0 +1,85 @@
+"""Atom feeds for the site, each user and each tag.
+
+A feed lists the ATOM_SIZE newest posts, read with one index-ordered LIMIT
+query whose rows are streamed and written out in batches, so neither the
+posts table nor the whole document is ever held in memory. The feed's own
+<updated> element comes last, once the newest change has been seen; Atom
+allows its children in any order.
+
+Revalidation is answered by feed_version(), which reads only the (id,
+post change, author change) of the listed posts.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+from flask import current_app, url_for
+from models import db, User, Post, Tag, PostTag, Feed, CacheVersion
+
+MIMETYPE = "application/atom+xml"
+BATCH_SIZE = 50
+MODELS = {"user": User, "tag": Tag}
+
+
+def timestamp(value):
+    """RFC 3339 form of a naive UTC datetime"""
+    return value.replace(microsecond=0).isoformat() + "Z"
+
+
+def feed_version(name):
+    """What a feed depends on: (newest change, tag names version, listed posts).
+
+    Returns None if the feed's user or tag doesn't exist.
+    """
+
+    kind, _, id = name.partition(":")
+    if kind in MODELS and db.session.query(MODELS[kind].id).filter_by(id=int(id)).scalar() is None:
+        return None
+
+    columns = (Post.id, Post.updated_at, User.updated_at)
+    rows = tuple(tuple(row) for row in db.session.execute(
+        Feed.select_posts(name, columns, current_app.config["ATOM_SIZE"])))
+    stamps = [stamp for row in rows for stamp in row[1:] if stamp]
+    return (max(stamps, default=None), CacheVersion.get("tags"), rows)
+
+
+def tag_names(post_ids):
+    """{post_id: [tag names]} for a batch of posts"""
+
+    names = {post_id: [] for post_id in post_ids}
+    rows = db.session.execute(Feed.select_tag_ids(post_ids).add_columns(Tag.name)
+                              .join(Tag, Tag.id == PostTag.tag_id).order_by(Tag.name))
+    for post_id, tag_id, name in rows:
+        names[post_id].append(name)
+    return names
+
+
+def generate(name, title, feed_url, page_url):
+    """Yields the Atom document for a feed in chunks, one per batch of posts"""
+
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+           f"<title>{escape(title)}</title>\n<id>{escape(feed_url)}</id>\n"
+           f'<link rel="self" href={quoteattr(feed_url)}/>\n'
+           f'<link rel="alternate" type="text/html" href={quoteattr(page_url)}/>\n')
+
+    result = db.session.execute(Feed.select_summaries(name, current_app.config["ATOM_SIZE"]),
+                                execution_options={"stream_results": True, "max_row_buffer": BATCH_SIZE})
+    newest = None
+    for rows in result.partitions(BATCH_SIZE):
+        tags = tag_names([row.id for row in rows])
+        chunk = []
+        for row in rows:
+            updated = row.updated_at or row.created_at
+            newest = max(newest, updated) if newest else updated
+            url = url_for(".show_post", post_id=row.id, _external=True)
+            chunk.append(
+                f"<entry>\n<title>{escape(row.title)}</title>\n<id>{escape(url)}</id>\n"
+                f"<link href={quoteattr(url)}/>\n"
+                f"<published>{timestamp(row.created_at or updated)}</published>\n"
+                f"<updated>{timestamp(updated)}</updated>\n"
+                f"<author><name>{escape(row.first_name)} {escape(row.last_name)}</name></author>\n"
+                + "".join(f"<category term={quoteattr(tag)}/>\n" for tag in tags[row.id])
+                + f"<summary>{escape(row.excerpt or '')}</summary>\n"
+                "</entry>\n")
+        yield "".join(chunk)
+
+    yield f"<updated>{timestamp(newest) if newest else '1970-01-01T00:00:00Z'}</updated>\n</feed>\n"
@@ -0,0 +1,363 @@
+"""Local avatar thumbnails for Blogly.
+
+User.image_url points at someone else's server, often at a full-size photo,
+so pages never link it directly. When a user is saved, or their page is
+first shown, the URL is queued. A background thread then fetches it once
+and makes an AVATAR_SIZE square JPEG thumbnail. This needs the optional
+Pillow package; without it, originals up to AVATAR_MAX_ORIGINAL_BYTES are
+kept as they are. The file is stored on local disk under its content hash.
+users.avatar names the file and users.avatar_source records the URL it came
+from, so an edited image_url is fetched again. Until then, and for URLs that
+fail, pages show a placeholder.
+
+Only hosts that resolve to public addresses are fetched, over a connection
+to the address that was checked, and redirects are not followed, so an
+image_url can't make the server reach internal services.
+
+Files are served from /avatars/<name> with immutable caching, since
+different content gets a different name. The folder is kept under
+AVATAR_DISK_BUDGET bytes by removing the least recently used files. A user
+whose file was removed is fetched again on their next view.
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import queue
+import re
+import socket
+import tempfile
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlsplit
+from flask import Response, abort, current_app, request
+from models import db, User
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+PLACEHOLDER = "avatar.svg"
+HASH_LENGTH = 16
+NAME_PATTERN = re.compile(r"^[0-9a-f]{%d}\.(jpg|png|gif|webp)$" % HASH_LENGTH)
+MIMETYPES = {"jpg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+ONE_YEAR = 365 * 24 * 3600
+
+# A file's last use is recorded at most this often, so busy pages don't write to the disk on every view
+TOUCH_INTERVAL = 3600
+
+# Leading bytes of the formats stored as they are when Pillow is missing
+SIGNATURES = ((b"\xff\xd8\xff", "jpg"), (b"\x89PNG\r\n\x1a\n", "png"), (b"GIF87a", "gif"), (b"GIF89a", "gif"))
+
+
+class AvatarError(Exception):
+    """An image_url that couldn't be fetched or made into an avatar"""
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to an address that was already checked, so the host isn't resolved again"""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection to a checked address; the certificate is still verified for the host name"""
+
+    def __init__(self, host, port, address, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def public_address(host, port, allow_private=False):
+    """The address to connect to for host, refusing hosts that resolve to a non-global address.
+
+    Loopback, private, link-local (cloud metadata) and other reserved
+    addresses are refused unless allow_private is set, so an image_url
+    can't reach services inside the network.
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as e:
+        raise AvatarError(f"resolving {host}: {e}") from e
+    for *_, sockaddr in infos:
+        ip = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global and not allow_private:
+            raise AvatarError(f"{host} resolves to non-public address {ip}")
+    return infos[0][4][0]
+
+
+def fetch(url, timeout, max_bytes, allow_private=False):
+    """The body at an http(s) URL on a public host, refusing redirects and anything over max_bytes"""
+
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise AvatarError(f"unsupported URL {url!r}")
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError as e:
+        raise AvatarError(f"unsupported URL {url!r}") from e
+    address = public_address(parts.hostname, port, allow_private)
+
+    connection_class = _PinnedHTTPSConnection if parts.scheme == "https" else _PinnedHTTPConnection
+    conn = connection_class(parts.hostname, port, address, timeout)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    try:
+        conn.request("GET", path, headers={"User-Agent": "Blogly avatars"})
+        resp = conn.getresponse()
+        # a redirect could point anywhere, including at an internal host
+        if resp.status != 200:
+            raise AvatarError(f"fetching {url}: HTTP {resp.status} {resp.reason}")
+        data = resp.read(max_bytes + 1)
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        raise AvatarError(f"fetching {url}: {e}") from e
+    finally:
+        conn.close()
+    if len(data) > max_bytes:
+        raise AvatarError(f"{url} is over {max_bytes:,} bytes")
+    return data
+
+
+def image_format(data):
+    """The file extension for a JPEG, PNG, GIF or WebP body, or None"""
+
+    for signature, ext in SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def thumbnail(data, size, max_original):
+    """(body, extension) of the avatar for an image: a size x size JPEG, or the original without Pillow"""
+
+    if Image is None:
+        ext = image_format(data)
+        if ext is None:
+            raise AvatarError("not a JPEG, PNG, GIF or WebP image")
+        if len(data) > max_original:
+            raise AvatarError(f"image is over {max_original:,} bytes; install Pillow to shrink it")
+        return data, ext
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image = ImageOps.fit(ImageOps.exif_transpose(image).convert("RGB"), (size, size))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarError(f"not a usable image: {e}") from e
+    out = BytesIO()
+    image.save(out, "JPEG", quality=85, optimize=True, progressive=True)
+    return out.getvalue(), "jpg"
+
+
+class AvatarStore:
+    """Content-addressed avatar files in one folder, kept under a byte budget by LRU eviction.
+
+    A file's mtime is its last use. Every worker process on the host can
+    share the folder.
+    """
+
+    def __init__(self, folder, budget):
+        self.folder = folder
+        self.budget = budget
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def put(self, body, ext):
+        """Stores body unless the same content is there already; returns its name"""
+
+        name = f"{hashlib.sha256(body).hexdigest()[:HASH_LENGTH]}.{ext}"
+        if not self.exists(name):
+            fd, tmp = tempfile.mkstemp(dir=self.folder, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(tmp, self.path(name))
+            self.evict(keep=name)
+        return name
+
+    def exists(self, name):
+        """Whether a file is stored, marking it used"""
+
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            return False
+        if time.time() - stat.st_mtime > TOUCH_INTERVAL:
+            self._touch(name)
+        return True
+
+    def get(self, name):
+        """A stored file's body, or None"""
+
+        try:
+            with open(self.path(name), "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        self.exists(name)
+        return body
+
+    def _touch(self, name):
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep=None):
+        """Removes least recently used files until the folder fits the budget; returns their names"""
+
+        files = []
+        for entry in os.scandir(self.folder):
+            if NAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        total = sum(size for _, _, size in files)
+
+        removed = []
+        for _, name, size in sorted(files):
+            if total <= self.budget:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(name)
+        return removed
+
+
+class Avatars:
+    """avatar_url for templates, the background fetcher and the /avatars handler"""
+
+    def __init__(self, app, store, url_path, placeholder_url, worker=True):
+        self.app = app
+        self.store = store
+        self.url_path = url_path
+        self.placeholder_url = placeholder_url
+        self.worker = worker
+        self.size = app.config["AVATAR_SIZE"]
+        self.timeout = app.config["AVATAR_FETCH_TIMEOUT"]
+        self.max_source = app.config["AVATAR_MAX_SOURCE_BYTES"]
+        self.max_original = app.config["AVATAR_MAX_ORIGINAL_BYTES"]
+        self.retry_seconds = app.config["AVATAR_RETRY_SECONDS"]
+        self.allow_private = app.config.get("AVATAR_ALLOW_PRIVATE_HOSTS", False)
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def url(self, user):
+        """The user's thumbnail URL, or the placeholder while it is fetched"""
+
+        source = user.image_url
+        if not source:
+            return self.placeholder_url
+        if user.avatar and user.avatar_source == source and self.store.exists(user.avatar):
+            return f"{self.url_path}/{user.avatar}"
+        self.request(source)
+        return self.placeholder_url
+
+    def request(self, url):
+        """Queues url for the background fetcher, unless it is queued or failed recently"""
+
+        if not self.worker or not url:
+            return
+        with self._lock:
+            failed_at = self._failed.get(url)
+            if url in self._queued or (failed_at and time.monotonic() - failed_at < self.retry_seconds):
+                return
+            self._queued.add(url)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="blogly-avatars", daemon=True)
+                self._thread.start()
+        self._queue.put(url)
+
+    def refresh(self, url):
+        """Fetches url and points every user with that image_url at its thumbnail; commits"""
+
+        data = fetch(url, self.timeout, self.max_source, self.allow_private)
+        body, ext = thumbnail(data, self.size, self.max_original)
+        name = self.store.put(body, ext)
+        User.query.filter(User.image_url == url).update(
+            {User.avatar: name, User.avatar_source: url}, synchronize_session=False)
+        db.session.commit()
+        return name
+
+    def _run(self):
+        while True:
+            url = self._queue.get()
+            failed = True
+            try:
+                with self.app.app_context():
+                    self.refresh(url)
+                failed = False
+            except AvatarError as e:
+                self.app.logger.warning("avatar: %s", e)
+            except Exception:
+                self.app.logger.exception("avatar fetch of %s", url)
+            finally:
+                with self._lock:
+                    self._queued.discard(url)
+                    if failed:
+                        self._forget_old_failures()
+                        self._failed[url] = time.monotonic()
+                    else:
+                        self._failed.pop(url, None)
+                self._queue.task_done()
+
+    def _forget_old_failures(self):
+        cutoff = time.monotonic() - self.retry_seconds
+        for url in [url for url, at in self._failed.items() if at < cutoff]:
+            del self._failed[url]
+
+    def serve(self, name):
+        match = NAME_PATTERN.match(name)
+        body = match and self.store.get(name)
+        if not body:
+            abort(404)
+
+        resp = Response(body, mimetype=MIMETYPES[match.group(1)])
+        resp.set_etag(name)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ONE_YEAR
+        resp.cache_control.immutable = True
+        return resp.make_conditional(request)
+
+
+def prefetch(url):
+    """Starts fetching a just-saved image_url, so the thumbnail is ready by the first view"""
+    current_app.extensions["avatars"].request(url)
+
+
+def init_avatars(app):
+    """Opens the avatar folder, adds avatar_url to templates and serves /avatars/<name>"""
+
+    folder = app.config.get("AVATAR_FOLDER") or os.path.join(app.instance_path, "avatars")
+    store = AvatarStore(folder, app.config["AVATAR_DISK_BUDGET"])
+    placeholder = app.extensions["assets"].url(PLACEHOLDER)
+    avatars = Avatars(app, store, "/avatars", placeholder, worker=app.config.get("AVATAR_WORKER", True))
+    app.extensions["avatars"] = avatars
+    app.jinja_env.globals["avatar_url"] = avatars.url
+    app.add_url_rule("/avatars/<name>", "avatar", avatars.serve)
+    return avatars
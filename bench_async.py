@@ -0,0 +1,140 @@
+"""Concurrent-client throughput benchmark: sync Flask views vs the async read path.
+
+Serves the app twice, one worker process each time: first the plain Flask app
+under gunicorn with --threads worker threads, then asyncread.create_asgi_app
+under uvicorn. Each time --clients keep-alive connections request the six
+read pages round-robin for --duration seconds. Reports requests per second,
+p50/p95/p99 latency and errors.
+
+Both servers run the production profile with the page cache off, so every
+request reaches the database.
+
+Usage: python bench_async.py [--clients 500] [--duration 15] [--database postgresql:///blogly_routes]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from sqlalchemy import create_engine, text
+
+
+def server_command(mode, port, threads):
+    if mode == "sync":
+        return [sys.executable, "-m", "gunicorn", "--worker-class", "gthread", "--workers", "1",
+                "--threads", str(threads), "--backlog", "4096", "--bind", f"127.0.0.1:{port}",
+                "--log-level", "warning", "app:create_app()"]
+    return [sys.executable, "-m", "uvicorn", "--factory", "asyncread:create_asgi_app",
+            "--port", str(port), "--backlog", "4096", "--log-level", "warning"]
+
+
+def read_paths(database):
+    """The six read pages, filled in with the busiest user and tag and the newest post"""
+
+    engine = create_engine(database)
+    with engine.connect() as conn:
+        user_id = conn.execute(text(
+            "SELECT user_id FROM posts GROUP BY user_id ORDER BY count(*) DESC LIMIT 1")).scalar()
+        tag_id = conn.execute(text(
+            "SELECT tag_id FROM post_tags GROUP BY tag_id ORDER BY count(*) DESC LIMIT 1")).scalar()
+        post_id = conn.execute(text("SELECT max(id) FROM posts")).scalar()
+    engine.dispose()
+    return ["/", "/users", f"/users/{user_id}", f"/posts/{post_id}", "/tags", f"/tags/{tag_id}"]
+
+
+def start_server(mode, database, port, threads):
+    env = dict(os.environ, BLOGLY_CONFIG="production", DATABASE_URL=database, PAGE_CACHE_BACKEND="")
+    server = subprocess.Popen(server_command(mode, port, threads), env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{mode} server didn't start")
+
+
+async def client(port, paths, offset, stop_at, latencies, errors):
+    """One keep-alive connection issuing GETs until stop_at"""
+
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        errors.append("connect")
+        return
+
+    i = offset
+    while time.perf_counter() < stop_at:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            errors.append("connection")
+            break
+        if status != 200:
+            errors.append(status)
+        latencies.append(time.perf_counter() - start)
+
+    writer.close()
+
+
+async def load(port, paths, clients, duration):
+    latencies, errors = [], []
+    stop_at = time.perf_counter() + duration
+    await asyncio.gather(*(client(port, paths, n, stop_at, latencies, errors) for n in range(clients)))
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--database", default="postgresql:///blogly_routes")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--threads", type=int, default=32, help="Worker threads for the sync server.")
+    args = parser.parse_args()
+
+    paths = read_paths(args.database)
+    print(f"{args.clients} clients, {args.duration:g} s per mode")
+    print(f"{'mode':<6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+
+    for mode in args.modes.split(","):
+        server = start_server(mode, args.database, args.port, args.threads)
+        try:
+            asyncio.run(load(args.port, paths, 10, 2))
+            latencies, errors = asyncio.run(load(args.port, paths, args.clients, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies.sort()
+        pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+        print(f"{mode:<6} {len(latencies) / args.duration:8.1f} {statistics.median(latencies) * 1000:8.1f} "
+              f"{pick(0.95):8.1f} {pick(0.99):8.1f} {len(errors):7d}")
+        if errors:
+            print("       errors: " + ", ".join(f"{kind} x{n}" for kind, n in Counter(errors).items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Per-route latency benchmark for Blogly.
+
+Drives every GET route in app.py through the Flask test client, then every
+route that writes, and reports p50/p95/p99 latency, SQL statements per
+request and peak Python memory per route. Results can be saved as a
+baseline; comparing against one exits with status 1 and lists the
+regressions.
+
+The write routes run after the reads, on users, tags and posts they create
+themselves and delete again, so the dataset the reads see stays the same.
+
+An empty benchmark database is first filled with datagen (10k posts unless
+--scale or --posts says otherwise).
+
+Usage:
+  python bench_routes.py [--database postgresql:///blogly_routes] --save-baseline bench_baseline.json
+  python bench_routes.py --baseline bench_baseline.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from itertools import chain
+
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from app import create_app
+from models import db, User, Post, Tag, PostTag
+import datagen
+import migrations
+
+# Not read routes: static files, and GET routes that delete (write_routes() times those)
+SKIPPED_ENDPOINTS = {"static", "delete_user", "delete_post"}
+QUERY_STRINGS = {"search": "q={word}"}
+# Untimed requests per route. The first one in a process reads the identity cache's shared
+# version, which clears the cache, so rows are only cached from the second.
+WARMUPS = 2
+
+statements = 0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    global statements
+    statements += 1
+
+
+def sample_ids():
+    """The busiest user and tag and the newest post: the worst cases for their pages"""
+
+    user_id = (db.session.query(Post.user_id).group_by(Post.user_id)
+               .order_by(func.count().desc()).limit(1).scalar())
+    tag_id = (db.session.query(PostTag.tag_id).group_by(PostTag.tag_id)
+              .order_by(func.count().desc()).limit(1).scalar())
+    post_id = db.session.query(func.max(Post.id)).scalar()
+    word = (db.session.query(Post.title).filter_by(id=post_id).scalar() or "blogly").split()[0]
+    db.session.rollback()
+    return {"user_id": user_id or 1, "tag_id": tag_id or 1, "post_id": post_id or 1, "word": word}
+
+
+def routes(app, samples):
+    """(name, url) for every GET route that can be filled in from samples"""
+
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        name = rule.endpoint.rpartition(".")[2]
+        if "GET" not in rule.methods or name in SKIPPED_ENDPOINTS:
+            continue
+        if any(arg not in samples for arg in rule.arguments):
+            continue
+        url = rule.rule
+        for arg in rule.arguments:
+            url = url.replace(f"<int:{arg}>", str(samples[arg]))
+        if name in QUERY_STRINGS:
+            url += "?" + QUERY_STRINGS[name].format(**samples)
+        yield name, url
+
+
+def new_ids(app, model, after):
+    """Ids of the model's rows above after, oldest first"""
+
+    with app.app_context():
+        return [id for (id,) in db.session.query(model.id).filter(model.id > after).order_by(model.id)]
+
+
+def last_id(app, model):
+    with app.app_context():
+        return db.session.query(func.max(model.id)).scalar() or 0
+
+
+def write_routes(app, client):
+    """(name, send, ok) for every route that writes; send(i) makes the route's i-th request.
+
+    Names end in ":write", apart from the GET side of the same endpoints.
+    Each route writes rows of its own: users, tags and posts are created,
+    edited and deleted again in that order, each request on a different row.
+    ok is the status codes a successful request returns.
+    """
+
+    stamp = int(time.time())
+    body = "Benchmark post."
+    users, tags = last_id(app, User), last_id(app, Tag)
+    yield ("show_add_users_page:write", lambda i: client.post(
+        "/users/new", data={"first_name": "Bench", "last_name": f"Writer {i}", "image_url": ""}), (302,))
+    users = new_ids(app, User, users)
+    yield ("show_edit_page:write", lambda i: client.post(
+        f"/users/{users[i]}/edit", data={"first_name": "Bench", "last_name": f"Editor {i}", "image_url": ""}),
+        (302,))
+    yield "add_tag:write", lambda i: client.post("/tags/new", data={"tag": f"bench {stamp} {i}"}), (302,)
+    tags = new_ids(app, Tag, tags)
+    yield ("edit_tag:write", lambda i: client.post(
+        f"/tags/{tags[i]}/edit", data={"name": f"bench {stamp} {i}b"}), (302,))
+
+    posts = last_id(app, Post)
+    yield ("create_post:write", lambda i: client.post(
+        f"/users/{users[i]}/posts/new", data={"title": f"Bench {i}", "content": body, "check": tags[i]}),
+        (302,))
+    posts = new_ids(app, Post, posts)
+    yield ("create_user_posts:write", lambda i: client.post(
+        f"/api/v1/users/{users[i]}/posts",
+        json={"data": [{"title": f"Batch {n}", "content": body, "tags": [f"bench {stamp} {i}b"]}
+                       for n in range(10)]}), (201,))
+    yield ("edit_post:write", lambda i: client.post(
+        f"/posts/{posts[i]}/edit", data={"title": f"Bench {i}b", "content": body, "check": tags[i]}), (302,))
+
+    yield "delete_post:write", lambda i: client.get(f"/posts/{posts[i]}/delete"), (302,)
+    yield "delete_tag:write", lambda i: client.post(f"/tags/{tags[i]}/delete"), (302,)
+    yield "delete_user:write", lambda i: client.get(f"/users/{users[i]}/delete"), (302,)
+
+
+def measure(send, runs, ok=(200,)):
+    """Times runs calls of send(i) after WARMUPS untimed ones, then traces the memory of one more"""
+
+    global statements
+
+    # reading the body runs the rest of a streamed view, and closes its request context
+    for i in range(WARMUPS):
+        send(i).get_data()
+    timings = []
+    start_statements = statements
+    for i in range(WARMUPS, WARMUPS + runs):
+        start = time.perf_counter()
+        resp = send(i)
+        resp.get_data()
+        timings.append((time.perf_counter() - start) * 1000)
+        if resp.status_code not in ok:
+            raise RuntimeError(f"{resp.request.method} {resp.request.path} returned {resp.status_code}")
+    per_request = (statements - start_statements) / runs
+
+    tracemalloc.start()
+    send(WARMUPS + runs).get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    pick = lambda q: timings[min(int(len(timings) * q), len(timings) - 1)]
+    return {"p50": statistics.median(timings), "p95": pick(0.95), "p99": pick(0.99),
+            "statements": per_request, "peak_kb": peak / 1024}
+
+
+def regressions(results, baseline, tolerance):
+    """Lists human-readable regressions of results against a stored baseline"""
+
+    found = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if now["p95"] > before["p95"] * (1 + tolerance) + 2:
+            found.append(f"{name}: p95 {before['p95']:.1f} -> {now['p95']:.1f} ms")
+        if now["statements"] > before["statements"]:
+            found.append(f"{name}: statements {before['statements']:g} -> {now['statements']:g}")
+        if now["peak_kb"] > before["peak_kb"] * (1 + tolerance) + 64:
+            found.append(f"{name}: peak memory {before['peak_kb']:.0f} -> {now['peak_kb']:.0f} KB")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="postgresql:///blogly_routes")
+    parser.add_argument("--scale", choices=datagen.SCALES, default="small")
+    parser.add_argument("--posts", type=int, help="Exact number of posts to generate.")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--with-cache", action="store_true", help="Keep the rendered-page cache on.")
+    parser.add_argument("--baseline", help="Fail if results regress against this JSON file.")
+    parser.add_argument("--save-baseline", help="Write results to this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown.")
+    args = parser.parse_args()
+
+    # the identity cache checks its shared version once, so statement counts don't depend on timing
+    app = create_app("production", SQLALCHEMY_DATABASE_URI=args.database,
+                     PAGE_CACHE_BACKEND="memory" if args.with_cache else None,
+                     IDENTITY_CACHE_SYNC_SECONDS=float("inf"))
+
+    results = {}
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        if Post.query.first() is None:
+            datagen.generate(args.posts or datagen.SCALES[args.scale])
+        samples = sample_ids()
+
+    # outside an app context, so each request gets its own context and session, as when serving
+    with app.test_client() as client:
+        print(f"{'route':<26} {'p50':>7} {'p95':>7} {'p99':>7} {'SQL':>5} {'peak KB':>8}")
+        timed = [(name, lambda i, url=url: client.get(url), (200,)) for name, url in routes(app, samples)]
+        for name, send, ok in chain(timed, write_routes(app, client)):
+            r = results[name] = measure(send, args.runs, ok)
+            print(f"{name:<26} {r['p50']:7.1f} {r['p95']:7.1f} {r['p99']:7.1f} "
+                  f"{r['statements']:5g} {r['peak_kb']:8.0f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if found:
+            print("\nREGRESSIONS:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print("\nNo regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark full-text search latency over a large synthetic posts table.
+
+Fills a dedicated Postgres database with generated posts (server-side, with
+INSERT ... SELECT generate_series) and times search_posts() for rare, medium
+and common terms.
+
+Usage: python bench_search.py [--posts 1000000] [--database postgresql:///blogly_bench]
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from app import create_app
+from models import db, User, Post
+from search import search_posts
+import migrations
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "tor", "vel", "shi", "dan", "gol", "bri", "esh", "um",
+             "fa", "nor", "qui", "zed", "hal", "pri", "ost", "wyn"]
+CHUNK = 100_000
+
+
+def vocabulary(size=5000, seed=42):
+    """Deterministic made-up words; low indexes are drawn far more often"""
+
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda w: (len(w), w))
+
+
+def fill(target, words):
+    """Tops the posts table up to target rows"""
+
+    user = User.query.first()
+    if user is None:
+        user = User(first_name="Bench", last_name="Mark")
+        db.session.add(user)
+        db.session.commit()
+
+    have = Post.query.count()
+    sql = """
+        INSERT INTO posts (title, content, user_id, created_at)
+        SELECT
+          (SELECT string_agg((CAST(:words AS text[]))[1 + floor(:n * random() ^ 3)::int], ' ')
+             FROM generate_series(1, 5) WHERE g IS NOT NULL),
+          (SELECT string_agg((CAST(:words AS text[]))[1 + floor(:n * random() ^ 3)::int], ' ')
+             FROM generate_series(1, 60) WHERE g IS NOT NULL),
+          :user_id,
+          now() - g * interval '1 minute'
+        FROM generate_series(:start, :stop) AS g
+    """
+    while have < target:
+        count = min(CHUNK, target - have)
+        db.session.execute(db.text(sql), {"words": words, "n": len(words), "user_id": user.id,
+                                          "start": have + 1, "stop": have + count})
+        db.session.commit()
+        have += count
+        print(f"  {have:,} posts")
+    db.session.execute(db.text("ANALYZE posts"))
+    db.session.commit()
+
+
+def time_query(q, runs):
+    search_posts(q)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        page = search_posts(q)
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.rollback()
+    timings.sort()
+    return page, statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--database", default="postgresql:///blogly_bench")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    # filling runs long INSERT ... SELECTs, so no statement timeout
+    app = create_app("production", SQLALCHEMY_DATABASE_URI=args.database, DB_STATEMENT_TIMEOUT_MS=0)
+
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        words = vocabulary()
+        fill(args.posts, words)
+
+        queries = {
+            "rare term": words[-1],
+            "medium term": words[len(words) // 2],
+            "common term": words[5],
+            "two terms": f"{words[40]} {words[300]}",
+            "phrase": f'"{words[3]} {words[4]}"',
+            "no match": "zzzzzz",
+        }
+
+        print(f"{'query':<12} {'p50 ms':>8} {'p95 ms':>8}  first page")
+        for label, q in queries.items():
+            page, p50, p95 = time_query(q, args.runs)
+            flag = "" if p95 < 50 else "  (over 50 ms)"
+            print(f"{label:<12} {p50:8.1f} {p95:8.1f}  {len(page.items)} hits{flag}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Startup-time benchmark for Blogly's configuration profiles.
+
+Starts a fresh interpreter per run and times importing the app module,
+create_app() and the first response to GET /users, plus the wall time of the
+whole process, for the development, testing and production profiles.
+
+Usage: python bench_startup.py [--runs 5] [--database postgresql:///blogly]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+PROFILES = ("development", "testing", "production")
+STEPS = ("import", "create_app", "first_response")
+
+
+def child(profile, database):
+    """Runs in the spawned interpreter and prints its timings as JSON"""
+
+    timings = {}
+    start = time.perf_counter()
+    from app import create_app
+    timings["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app = create_app(profile, SQLALCHEMY_DATABASE_URI=database)
+    timings["create_app"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resp = app.test_client().get("/users")
+    timings["first_response"] = time.perf_counter() - start
+    if resp.status_code != 200:
+        raise RuntimeError(f"/users returned {resp.status_code}")
+
+    print(json.dumps(timings))
+
+
+def run(profile, database):
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, __file__, "--child", profile, "--database", database],
+                         check=True, capture_output=True, text=True).stdout
+    timings = json.loads(out.splitlines()[-1])
+    timings["process"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database", default="postgresql:///blogly")
+    parser.add_argument("--child", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.database)
+
+    columns = STEPS + ("process",)
+    print(f"{'profile':<12} " + " ".join(f"{c:>15}" for c in columns) + "   (median ms)")
+    for profile in PROFILES:
+        runs = [run(profile, args.database) for _ in range(args.runs)]
+        medians = [statistics.median(r[c] for r in runs) * 1000 for c in columns]
+        print(f"{profile:<12} " + " ".join(f"{m:15.1f}" for m in medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Streaming bulk import and export of users, posts and tags.
+
+Records are read and written one chunk at a time, so memory stays flat no
+matter how large the file is. Imports commit once per batch and report how
+many records are safely stored, which is what --resume skips on a rerun.
+
+Record fields (JSONL objects or CSV columns):
+  users: id (optional), first_name, last_name, image_url
+  tags:  name
+  posts: id (optional), title, content, user_id, created_at (optional),
+         tags (list of names; "|"-separated in CSV)
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import String, bindparam, func, select, text
+from models import db, User, Post, Tag, PostTag, Feed
+from models import allocate_ids, excerpt, recount_post_counts, resolve_tag_ids
+from search import fallback_index
+
+KINDS = ("users", "tags", "posts")
+BATCH_SIZE = 5000
+
+FIELDS = {
+    "users": ["id", "first_name", "last_name", "image_url"],
+    "tags": ["id", "name"],
+    "posts": ["id", "title", "content", "user_id", "created_at", "tags"],
+}
+
+# Fields an empty CSV value leaves unset; in the others (NOT NULL text) it is an empty string
+OPTIONAL = {
+    "users": {"id", "image_url"},
+    "tags": {"id"},
+    "posts": {"id", "created_at", "tags"},
+}
+
+
+def chunked(iterable, size):
+    """Yields lists of up to size items"""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_records(fp, fmt, kind):
+    """Yields dicts of kind from a JSONL or CSV stream"""
+
+    if fmt == "csv":
+        optional = OPTIONAL[kind]
+        for row in csv.DictReader(fp):
+            yield {key: (None if value == "" and key in optional else value) for key, value in row.items()}
+    else:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_records(fp, fmt, kind, records):
+    """Writes dicts to a JSONL or CSV stream, returning how many were written"""
+
+    count = 0
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(fp, fieldnames=FIELDS[kind])
+        writer.writeheader()
+    for record in records:
+        if writer:
+            if "tags" in record:
+                record = dict(record, tags="|".join(record["tags"]))
+            writer.writerow(record)
+        else:
+            fp.write(json.dumps(record, default=_json_default) + "\n")
+        count += 1
+    return count
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can't serialize {type(value).__name__}")
+
+
+### Import ###
+
+
+def sync_sequence(conn, table):
+    """Moves a Postgres id sequence past ids that were inserted explicitly"""
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                 f"coalesce((SELECT max(id) FROM {table.name}), 0) + 1, false)"),
+            {"table": table.name})
+
+
+def insert_rows(conn, table, columns, rows):
+    """Inserts rows (tuples ordered like columns) with COPY on Postgres, executemany elsewhere"""
+
+    if not rows:
+        return
+    if conn.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            [["" if v is None else (v.isoformat() if isinstance(v, datetime) else v) for v in row]
+             for row in rows])
+        buffer.seek(0)
+        # csv writes None and "" alike, and COPY reads an unquoted empty field as NULL; keep NOT NULL text ""
+        not_null = [column for column in columns
+                    if not table.c[column].nullable and isinstance(table.c[column].type, String)]
+        options = f", FORCE_NOT_NULL ({', '.join(not_null)})" if not_null else ""
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv{options})",
+                           buffer)
+        cursor.close()
+    else:
+        conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def _split_tags(value):
+    # blank names are dropped here, so resolving and linking tags see the same names
+    if value is None:
+        return []
+    names = value.split("|") if isinstance(value, str) else value
+    return [name for name in names if name and name.strip()]
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def load_users(conn, records):
+    table = User.__table__
+    ids = iter(allocate_ids(conn, table, sum(1 for r in records if r.get("id") is None)))
+    columns = ["id", "first_name", "last_name", "image_url", "updated_at"]
+    now = conn.execute(select(func.localtimestamp())).scalar()
+    rows = [(int(r["id"]) if r.get("id") is not None else next(ids),
+             r["first_name"], r["last_name"], r.get("image_url"), now)
+            for r in records]
+    insert_rows(conn, table, columns, rows)
+    sync_sequence(conn, table)
+
+
+def load_tags(conn, records):
+    resolve_tag_ids(conn, [r["name"] for r in records])
+
+
+def load_posts(conn, records):
+    table = Post.__table__
+    ids = iter(allocate_ids(conn, table, sum(1 for r in records if r.get("id") is None)))
+    now = conn.execute(select(func.localtimestamp())).scalar()
+    tag_ids, _ = resolve_tag_ids(conn, [name for r in records for name in _split_tags(r.get("tags"))])
+
+    columns = ["id", "title", "content", "excerpt", "user_id", "created_at", "updated_at"]
+    rows, pairs = [], []
+    for r in records:
+        post_id = int(r["id"]) if r.get("id") is not None else next(ids)
+        created_at = _parse_time(r.get("created_at")) or now
+        rows.append((post_id, r["title"], r["content"], excerpt(r["content"]), int(r["user_id"]),
+                     created_at, created_at))
+        pairs.extend({(post_id, tag_ids[name.strip().lower()]) for name in _split_tags(r.get("tags"))})
+
+    insert_rows(conn, table, columns, rows)
+    insert_rows(conn, PostTag.__table__, ["post_id", "tag_id"], pairs)
+    sync_sequence(conn, table)
+
+
+LOADERS = {"users": load_users, "tags": load_tags, "posts": load_posts}
+
+
+def import_records(kind, records, batch_size=BATCH_SIZE, skip=0, on_batch=None):
+    """Loads records in batches of batch_size, one transaction per batch.
+
+    The first skip records are passed over (to resume an interrupted run).
+    on_batch(done) is called after each commit with the number of records
+    stored so far, including skipped ones. Returns that total.
+    """
+
+    loader = LOADERS[kind]
+    done = skip
+    for batch in chunked(islice(records, skip, None), batch_size):
+        with db.engine.begin() as conn:
+            loader(conn, batch)
+        done += len(batch)
+        if on_batch:
+            on_batch(done)
+
+    if kind == "posts":
+        # COPY bypasses the handlers that keep post_count and the feeds current
+        recount_post_counts()
+        Feed.rebuild()
+    invalidate_caches(kind)
+    return done
+
+
+def invalidate_caches(kind):
+    """Drops in-process caches that rows written outside the ORM session made stale"""
+
+    if kind != "users":
+        Tag.bump_version()
+        db.session.commit()
+    page_cache = db.get_app().extensions.get("page_cache")
+    if page_cache is not None:
+        page_cache.clear()
+    identity_cache = db.get_app().extensions.get("identity_cache")
+    if identity_cache is not None:
+        identity_cache.clear()
+    fallback_index.built = False
+
+
+### Export ###
+
+
+def export_records(kind, batch_size=BATCH_SIZE):
+    """Yields dicts for every row of kind, streamed with a server-side cursor"""
+
+    tables = {"users": User.__table__, "tags": Tag.__table__, "posts": Post.__table__}
+    table = tables[kind]
+    columns = [table.c[name] for name in FIELDS[kind] if name != "tags"]
+
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(
+            select(*columns).order_by(table.c.id))
+        for partition in result.mappings().partitions(batch_size):
+            rows = [dict(row) for row in partition]
+            if kind == "posts":
+                _attach_tag_names(rows)
+            yield from rows
+
+
+def _attach_tag_names(posts):
+    """Adds a tags list to each post dict with one query per chunk"""
+
+    names = {post["id"]: [] for post in posts}
+    query = (select(PostTag.__table__.c.post_id, Tag.__table__.c.name)
+             .join(Tag.__table__, Tag.__table__.c.id == PostTag.__table__.c.tag_id)
+             .where(PostTag.__table__.c.post_id.in_(bindparam("ids", expanding=True)))
+             .order_by(Tag.__table__.c.name))
+    # a separate connection, since the streaming cursor is still open on conn
+    with db.engine.connect() as lookup:
+        for post_id, name in lookup.execute(query, {"ids": list(names)}):
+            names[post_id].append(name)
+    for post in posts:
+        post["tags"] = names[post["id"]]
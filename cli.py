@@ -0,0 +1,175 @@
+"""Command line tools for Blogly, available as `flask blogly <command>`."""
+
+import os
+import sys
+from contextlib import nullcontext
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db, recount_post_counts, Feed, User
+import assets
+import avatars
+import bulk
+import deletions
+import datagen
+import migrations
+
+blogly_cli = AppGroup("blogly", help="Blogly maintenance commands.")
+
+
+@blogly_cli.command("migrate")
+def migrate():
+    """Apply pending schema migrations."""
+
+    applied = migrations.upgrade(db.engine)
+    for version, description in applied:
+        click.echo(f"Applied {version}: {description}")
+    if not applied:
+        click.echo("Schema is up to date.")
+
+
+@blogly_cli.command("check-schema")
+def check_schema():
+    """Report missing migrations and indexes; exits 1 if any."""
+
+    problems = migrations.check_schema(db.engine)
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise SystemExit(1)
+    click.echo("Schema is complete.")
+
+
+def _open(path, mode):
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _format_of(path, fmt):
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+
+@blogly_cli.command("import")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), help="Default: by extension.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True)
+@click.option("--resume", is_flag=True, help="Skip records committed by an earlier run.")
+def import_command(kind, path, fmt, batch_size, resume):
+    """Stream users, tags or posts from a JSONL/CSV file into the database.
+
+    Progress is checkpointed to PATH.progress after every committed batch.
+    """
+
+    checkpoint = None if path == "-" else f"{path}.progress"
+    skip = 0
+    if resume and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            skip = int(f.read().strip() or 0)
+        click.echo(f"Resuming after {skip:,} records")
+
+    def on_batch(done):
+        if checkpoint:
+            with open(checkpoint, "w") as f:
+                f.write(str(done))
+        click.echo(f"  {done:,} {kind} committed")
+
+    with _open(path, "r") as fp:
+        records = bulk.read_records(fp, _format_of(path, fmt), kind)
+        done = bulk.import_records(kind, records, batch_size, skip, on_batch)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    click.echo(f"Imported {done - skip:,} {kind}.")
+
+
+@blogly_cli.command("export")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("path", default="-", type=click.Path(allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), help="Default: by extension.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True)
+def export_command(kind, path, fmt, batch_size):
+    """Stream users, tags or posts to a JSONL/CSV file (stdout by default)."""
+
+    with _open(path, "w") as fp:
+        count = bulk.write_records(fp, _format_of(path, fmt), kind, bulk.export_records(kind, batch_size))
+
+    if path != "-":
+        click.echo(f"Exported {count:,} {kind}.")
+
+
+@blogly_cli.command("generate")
+@click.option("--scale", type=click.Choice(list(datagen.SCALES)), default="small", show_default=True)
+@click.option("--posts", type=int, help="Exact number of posts (overrides --scale).")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True)
+def generate_command(scale, posts, seed, batch_size):
+    """Add a synthetic, skewed dataset (10k / 1M / 10M posts)."""
+
+    def on_progress(kind, done):
+        click.echo(f"  {done:,} {kind}")
+
+    users, tags, posts = datagen.generate(posts or datagen.SCALES[scale], seed, batch_size, on_progress)
+    click.echo(f"Generated {users:,} users, {tags:,} tags and {posts:,} posts.")
+
+
+@blogly_cli.command("recount")
+def recount_command():
+    """Recompute the denormalized post counts and report drift."""
+
+    drift = recount_post_counts()
+    db.session.commit()
+    for table, rows in drift.items():
+        click.echo(f"{table}: {rows:,} row(s) had a wrong post_count" if rows else f"{table}: no drift")
+
+
+@blogly_cli.command("rebuild-feeds")
+def rebuild_feeds_command():
+    """Rebuild the home feed and every stored user and tag feed from the posts table."""
+
+    count = Feed.rebuild()
+    db.session.commit()
+    click.echo(f"Rebuilt {count:,} feed(s).")
+
+
+@blogly_cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint and precompress static/ into static/dist/ with a manifest."""
+
+    app = current_app
+    dest = app.config.get("ASSETS_FOLDER") or os.path.join(app.static_folder, "dist")
+    manifest = assets.build(app.static_folder, dest)
+    for name, hashed in manifest.items():
+        click.echo(f"{name} -> {hashed}")
+    if assets.brotli is None:
+        click.echo("brotli is not installed; wrote gzip variants only.")
+
+
+@blogly_cli.command("run-deletions")
+def run_deletions_command():
+    """Run queued background deletions of users and tags to completion."""
+
+    count = deletions.run_pending()
+    click.echo(f"Ran {count:,} deletion job(s).")
+
+
+@blogly_cli.command("fetch-avatars")
+def fetch_avatars_command():
+    """Fetch thumbnails for every image_url that has none, or whose file was evicted."""
+
+    fetcher = current_app.extensions["avatars"]
+    rows = (db.session.query(User.image_url, User.avatar, User.avatar_source)
+            .filter(User.image_url.isnot(None), User.image_url != "").distinct().all())
+    missing = {url for url, avatar, source in rows
+               if not (avatar and source == url and fetcher.store.exists(avatar))}
+    failed = 0
+    for url in sorted(missing):
+        try:
+            fetcher.refresh(url)
+        except avatars.AvatarError as e:
+            failed += 1
+            click.echo(f"{e}", err=True)
+    click.echo(f"Fetched {len(missing) - failed:,} avatar(s); {failed:,} failed.")
@@ -0,0 +1,55 @@
+"""Conditional GET (ETag / Last-Modified / 304) for Blogly's read routes."""
+
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import make_response, request
+
+
+def conditional(get_version):
+    """Answers revalidation requests from a cheap version query.
+
+    get_version receives the view's URL arguments and returns a tuple that
+    changes whenever the page would (or None when the record doesn't exist).
+    A matching If-None-Match / If-Modified-Since gets a 304 without running
+    the view; otherwise the rendered page carries ETag and Last-Modified.
+
+    Last-Modified is the newest timestamp in the version. If the version also
+    has other parts, such as a row count, a change can leave that timestamp
+    alone (deleting an older row), so If-Modified-Since is only answered for
+    versions made of timestamps alone.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = get_version(**kwargs)
+            if version is None:
+                return view(*args, **kwargs)
+
+            etag = hashlib.sha1(repr((request.full_path, tuple(version))).encode()).hexdigest()
+            stamps = [v for v in version if isinstance(v, datetime)]
+            last_modified = max(stamps).replace(tzinfo=timezone.utc, microsecond=0) if stamps else None
+            only_stamps = all(v is None or isinstance(v, datetime) for v in version)
+
+            if request.if_none_match:
+                # weak comparison, so a gzipped response (weak ETag) still revalidates
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and only_stamps and last_modified and last_modified <= since)
+
+            if not_modified:
+                resp = make_response("", 304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+
+            resp.set_etag(etag)
+            if last_modified:
+                resp.last_modified = last_modified
+            resp.cache_control.no_cache = True
+            return resp
+
+        return wrapper
+
+    return decorator
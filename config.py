@@ -0,0 +1,141 @@
+"""Configuration profiles for Blogly.
+
+Pick one with create_app("production") or the BLOGLY_CONFIG environment
+variable. Database URIs come from DATABASE_URL (and TEST_DATABASE_URL for the
+testing profile); pool and timeout settings can be overridden the same way.
+"""
+
+import os
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_float(name, default=None):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+class Config:
+    """Settings shared by every profile"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgresql:///blogly")
+
+    # Default is True, turn off to prevent overhead
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Prints all SQL statements to terminal (SQLALCHEMY_ECHO=1); too noisy for production
+    SQLALCHEMY_ECHO = os.environ.get("SQLALCHEMY_ECHO") == "1"
+
+    SECRET_KEY = os.environ.get("SECRET_KEY") or "something"
+
+    # Read replica that GET requests are routed to (see replicas.py)
+    SQLALCHEMY_BINDS = ({"replica": os.environ["REPLICA_DATABASE_URL"]}
+                        if os.environ.get("REPLICA_DATABASE_URL") else None)
+    REPLICA_STICKY_SECONDS = _env_float("REPLICA_STICKY_SECONDS", 5)
+
+    # Connection pool, per worker process; statement timeout applies to Postgres only
+    DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 10)
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "0") == "1"
+    DB_STATEMENT_TIMEOUT_MS = _env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+
+    # Run pending migrations when the app is created, instead of with `flask blogly migrate`
+    AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "0") == "1"
+
+    # The debug toolbar is opt-in with DEBUG_TOOLBAR=1
+    DEBUG_TOOLBAR = os.environ.get("DEBUG_TOOLBAR") == "1"
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Rendered-page cache: "memory" (one worker), "shared" (all workers on a host) or None
+    PAGE_CACHE_BACKEND = os.environ.get("PAGE_CACHE_BACKEND", "memory")
+    PAGE_CACHE_TTL = 300
+    # Streamed pages longer than this many characters are sent but not cached
+    PAGE_CACHE_MAX_BODY = _env_int("PAGE_CACHE_MAX_BODY", 1 << 20)
+
+    # Snapshots of User and Tag rows shared by every request in a worker (see identitycache.py); 0 turns it off
+    IDENTITY_CACHE_SIZE = _env_int("IDENTITY_CACHE_SIZE", 4096)
+    IDENTITY_CACHE_TTL = _env_float("IDENTITY_CACHE_TTL", 60)
+    # How often a worker checks whether another one has changed a cached row
+    IDENTITY_CACHE_SYNC_SECONDS = _env_float("IDENTITY_CACHE_SYNC_SECONDS", 1)
+
+    # How many post summaries each precomputed feed (home, per user, per tag) keeps
+    FEED_SIZE = _env_int("FEED_SIZE", 5)
+
+    # How many posts the Atom feeds (/feed.atom, per user, per tag) list
+    ATOM_SIZE = _env_int("ATOM_SIZE", 20)
+
+    # Users and tags with more posts than this are deleted in the background, in batches
+    DELETE_IN_BACKGROUND_OVER = _env_int("DELETE_IN_BACKGROUND_OVER", 1000)
+    DELETE_BATCH_SIZE = _env_int("DELETE_BATCH_SIZE", 1000)
+    DELETION_WORKER = True
+
+    # Most posts one POST /api/v1/users/<id>/posts may create
+    POST_BATCH_LIMIT = _env_int("POST_BATCH_LIMIT", 10000)
+
+    # Gzip HTML responses on the fly (COMPRESS_HTML=1); static assets are precompressed by build-assets
+    COMPRESS_HTML = os.environ.get("COMPRESS_HTML") == "1"
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIN_SIZE = 1024
+
+    # Local avatar thumbnails (see avatars.py); the folder defaults to instance/avatars
+    AVATAR_FOLDER = os.environ.get("AVATAR_FOLDER")
+    AVATAR_SIZE = 200
+    AVATAR_DISK_BUDGET = _env_int("AVATAR_DISK_BUDGET", 100 << 20)
+    AVATAR_FETCH_TIMEOUT = 10
+    AVATAR_MAX_SOURCE_BYTES = 10 << 20
+    # Without Pillow images are kept as they are, if they are no bigger than this
+    AVATAR_MAX_ORIGINAL_BYTES = 256 << 10
+    AVATAR_RETRY_SECONDS = 3600
+    # Fetch image_urls on loopback and private networks too; for tests against a local server only
+    AVATAR_ALLOW_PRIVATE_HOSTS = False
+    AVATAR_WORKER = True
+
+    # Log and sample statements slower than this many milliseconds (unset: off)
+    METRICS_SLOW_QUERY_MS = _env_float("METRICS_SLOW_QUERY_MS")
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") == "1"
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get("TEST_DATABASE_URL", "postgresql:///blogly_test")
+    SQLALCHEMY_ECHO = False
+    PAGE_CACHE_BACKEND = "memory"
+    DELETION_WORKER = False
+    AVATAR_WORKER = False
+    DEBUG_TB_HOSTS = ["dont-show-debug-toolbar"]
+
+
+class ProductionConfig(Config):
+    DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+    DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+    DB_STATEMENT_TIMEOUT_MS = _env_int("DB_STATEMENT_TIMEOUT_MS", 5000)
+    PAGE_CACHE_BACKEND = os.environ.get("PAGE_CACHE_BACKEND", "shared")
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the pool and timeout settings in config"""
+
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    if uri.startswith("postgresql"):
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+        if config["DB_STATEMENT_TIMEOUT_MS"]:
+            timeout = config["DB_STATEMENT_TIMEOUT_MS"]
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
@@ -0,0 +1,101 @@
+"""Synthetic data generator for Blogly.
+
+Builds skewed, realistic-looking datasets: a few prolific authors and many
+occasional ones, power-law tag popularity, and posts of varying length spread
+over the last two years. Records are generated lazily and loaded through
+bulk.import_records, so even the large scale runs in flat memory.
+"""
+
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import func
+from models import db, User
+import bulk
+
+SCALES = {
+    "small": 10_000,
+    "medium": 1_000_000,
+    "large": 10_000_000,
+}
+
+SYLLABLES = ["ba", "ko", "ri", "sen", "tal", "mor", "vi", "an", "el", "dur", "ith", "gal",
+             "fe", "lo", "nu", "or", "pe", "qua", "sha", "wen"]
+FIRST_NAMES = ["Bilbo", "Frodo", "Sam", "Merry", "Pippin", "Gandalf", "Saruman", "Arwen",
+               "Galadriel", "Eowyn", "Aragorn", "Legolas", "Gimli", "Boromir", "Faramir"]
+
+
+def make_words(rng, count):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))))
+    return sorted(words)
+
+
+def zipf_weights(count, exponent=1.1):
+    """Cumulative weights where item i is drawn in proportion to 1 / (i + 1) ** exponent"""
+
+    return list(accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+
+def dataset_shape(posts):
+    """(users, tags) for a given number of posts"""
+
+    return max(posts // 20, 10), min(max(posts // 200, 20), 2000)
+
+
+def user_records(rng, count, first_id, words):
+    for i in range(count):
+        yield {
+            "id": first_id + i,
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(words).title(),
+            "image_url": None,
+        }
+
+
+def tag_records(names):
+    for name in names:
+        yield {"name": name}
+
+
+def post_records(rng, count, user_ids, tag_names, words):
+    tag_weights = zipf_weights(len(tag_names))
+    word_weights = zipf_weights(len(words), exponent=1.0)
+    start = datetime.now() - timedelta(days=730)
+    step = timedelta(days=730) / count
+
+    for i in range(count):
+        # squaring a uniform draw gives a handful of very prolific authors
+        author = user_ids[int(len(user_ids) * rng.random() ** 2)]
+        length = int(rng.paretovariate(1.5) * 40)
+        yield {
+            "title": " ".join(rng.choices(words, cum_weights=word_weights, k=rng.randint(2, 8))).capitalize(),
+            "content": " ".join(rng.choices(words, cum_weights=word_weights, k=min(length, 5000))),
+            "user_id": author,
+            "created_at": start + step * i,
+            "tags": rng.choices(tag_names, cum_weights=tag_weights, k=rng.randint(0, 5)),
+        }
+
+
+def generate(posts, seed=0, batch_size=bulk.BATCH_SIZE, on_progress=None):
+    """Adds a synthetic dataset of the given number of posts to the database"""
+
+    rng = random.Random(seed)
+    words = make_words(rng, 3000)
+    users, tags = dataset_shape(posts)
+    tag_names = [f"{word}-{i}" for i, word in enumerate(rng.sample(words, tags))]
+
+    first_id = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    db.session.rollback()
+    user_ids = list(range(first_id, first_id + users))
+
+    def progress(kind):
+        return (lambda done: on_progress(kind, done)) if on_progress else None
+
+    bulk.import_records("users", user_records(rng, users, first_id, words), batch_size,
+                        on_batch=progress("users"))
+    bulk.import_records("tags", tag_records(tag_names), batch_size, on_batch=progress("tags"))
+    bulk.import_records("posts", post_records(rng, posts, user_ids, tag_names, words), batch_size,
+                        on_batch=progress("posts"))
+    return users, tags, posts
@@ -0,0 +1,168 @@
+"""Background deletion of users and tags with many posts.
+
+Deleting a row relies on the database's ON DELETE CASCADE for its posts and
+post_tags. That is quick for most users and tags. Past
+DELETE_IN_BACKGROUND_OVER posts, though, it would be one long transaction
+that holds locks on every row it touches. Such deletes are queued as a
+DeletionJob instead and the request returns at once. A worker thread in the
+same process then removes the rows DELETE_BATCH_SIZE at a time, in one
+short transaction per batch, and records progress on the job
+(/api/v1/deletions/<id>). The user or tag itself goes last.
+
+Jobs live in the database, and every batch is safe to repeat. A job left
+running by a stopped process is picked up again by the next worker, or by
+`flask blogly run-deletions`.
+"""
+
+import threading
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from models import db, User, Post, Tag, PostTag, Feed, DeletionJob
+
+# A running job whose progress hasn't moved for this long is presumed abandoned
+STALE_AFTER = timedelta(minutes=5)
+
+
+def should_defer(post_count):
+    """Whether deleting something with post_count posts belongs in the background"""
+    return post_count > current_app.config["DELETE_IN_BACKGROUND_OVER"]
+
+
+def enqueue(kind, target_id, total):
+    """Queues the deletion of a user or tag (or returns the job already queued for it); commits"""
+
+    job = DeletionJob.find_unfinished(kind, target_id)
+    if job is None:
+        job = DeletionJob(kind=kind, target_id=target_id, total=total)
+        db.session.add(job)
+        db.session.commit()
+
+    worker = current_app.extensions.get("deletion_worker")
+    if worker is not None:
+        worker.wake()
+    return job
+
+
+def claim():
+    """Marks the oldest pending (or abandoned) job as running and returns it, or None"""
+
+    cutoff = db.session.query(db.func.now()).scalar() - STALE_AFTER
+    job = (DeletionJob.query
+           .filter(or_(DeletionJob.status == "pending",
+                       and_(DeletionJob.status == "running", DeletionJob.updated_at < cutoff)))
+           .order_by(DeletionJob.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is not None:
+        job.status = "running"
+        db.session.commit()
+    return job
+
+
+def delete_user_posts(job, batch_size):
+    user_id = job.target_id
+    if job.feeds is None:
+        # remembered on the job, since a resumed run can't see the tags of posts already gone
+        job.feeds = Feed.names_for_user(user_id)
+        db.session.commit()
+
+    while True:
+        ids = [id for (id,) in db.session.query(Post.id).filter(Post.user_id == user_id)
+               .order_by(Post.id).limit(batch_size)]
+        if not ids:
+            break
+        Tag.subtract_posts(Post.id.in_(ids))
+        Post.query.filter(Post.id.in_(ids)).delete(synchronize_session=False)
+        User.change_post_count(user_id, -len(ids))
+        job.deleted += len(ids)
+        db.session.commit()
+
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    Feed.remove_user(user_id, job.feeds)
+
+
+def delete_tag_posts(job, batch_size):
+    tag_id = job.target_id
+    while True:
+        ids = [id for (id,) in db.session.query(PostTag.post_id).filter(PostTag.tag_id == tag_id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        PostTag.query.filter(PostTag.tag_id == tag_id, PostTag.post_id.in_(ids)).delete(
+            synchronize_session=False)
+        Tag.touch([tag_id])
+        job.deleted += len(ids)
+        db.session.commit()
+
+    Tag.query.filter_by(id=tag_id).delete(synchronize_session=False)
+    Feed.query.filter_by(name=f"tag:{tag_id}").delete(synchronize_session=False)
+    Tag.bump_version()
+
+
+DELETERS = {"user": delete_user_posts, "tag": delete_tag_posts}
+
+
+def run_job(job):
+    """Deletes a job's rows batch by batch, then its user or tag, and marks it done or failed"""
+
+    try:
+        DELETERS[job.kind](job, current_app.config["DELETE_BATCH_SIZE"])
+        job.status = "done"
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("deletion job %s failed", job.id)
+        job.status = "failed"
+        job.error = str(e)[:1000]
+        db.session.commit()
+
+
+def run_pending():
+    """Runs queued jobs until there are none left; returns how many ran"""
+
+    count = 0
+    while True:
+        job = claim()
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
+
+
+class DeletionWorker:
+    """Runs queued deletion jobs on a daemon thread, started by the first enqueue"""
+
+    def __init__(self, app, poll_seconds=60):
+        self.app = app
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="blogly-deletions", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    run_pending()
+            except Exception:
+                self.app.logger.exception("deletion worker")
+            self._wake.wait(self.poll_seconds)
+
+
+def init_deletions(app):
+    """Creates the background worker, unless DELETION_WORKER is off (jobs then wait for run-deletions)"""
+
+    if not app.config.get("DELETION_WORKER", True):
+        return None
+    worker = DeletionWorker(app)
+    app.extensions["deletion_worker"] = worker
+    return worker
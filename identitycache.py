@@ -0,0 +1,370 @@
+"""Second-level identity cache for Blogly's users and tags.
+
+Every post page shows its author's name and its tags' names. Those come
+from the same few thousand rows over and over. User.query.get() and
+Tag.query.get() (through CachedQuery) and session.get_many() try the
+identity map first and then this process-wide cache, before issuing SQL.
+Entries are column snapshots keyed by (model, primary key), kept in a
+bounded LRU. A hit is added to the session as a clean persistent object,
+just like one loaded from the database, so relationship loads such as
+post.user find it in the identity map afterwards.
+
+Snapshots are taken as rows load, except in a transaction that has written
+them or while reading from a replica, which may lag. Counters such as
+post_count change with every post, so they are left out, and reading one
+from a cached object loads it. Invalidation:
+  - A commit that flushed a change to a cached row drops that snapshot.
+  - Bulk Query.update()/delete() on a cached table drops every snapshot of
+    its model, unless it only set left-out columns.
+  - Either kind of write also bumps the shared 'identity' CacheVersion in
+    its transaction. Before serving a lookup, a process reads that version
+    from the primary if it hasn't for IDENTITY_CACHE_SYNC_SECONDS, and
+    clears its cache when it changed, so other worker processes stop serving
+    the old row within that interval. Requests that never look a row up
+    (cached pages, 304s, /static, /metrics) never read it.
+  - Entries expire after IDENTITY_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from itertools import chain
+from flask import has_request_context
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import attributes, make_transient_to_detached
+from replicas import RoutingSession, RoutingSQLAlchemy, reading_replica
+
+# CacheVersion bumped by every write that invalidates snapshots
+SHARED_VERSION = "identity"
+
+
+class IdentityCache:
+    """(model, primary key) -> immutable column snapshot, with LRU + TTL eviction"""
+
+    def __init__(self, max_entries=4096, ttl=60, clock=time.monotonic, sync_interval=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.clock = clock
+        # model -> (cached column keys, columns left out)
+        self.models = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._shared_version = None
+        self._synced_at = None
+
+    def register(self, model, volatile=()):
+        """Caches model's rows, leaving out the volatile columns"""
+
+        keys = tuple(prop.key for prop in inspect(model).column_attrs if prop.key not in volatile)
+        self.models[model] = (keys, frozenset(volatile))
+
+    def generation(self):
+        """Changes whenever anything is invalidated"""
+        return self._generation
+
+    def get(self, model, pk):
+        """The snapshot of a row, or None; counts a hit or a miss"""
+
+        key = (model, pk)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, model, pk, values, generation):
+        """Stores a snapshot unless something was invalidated since generation was read"""
+
+        key = (model, pk)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (values, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys=(), models=()):
+        """Drops the (model, pk) keys and every snapshot of models"""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            if models:
+                for key in [key for key in self._entries if key[0] in models]:
+                    del self._entries[key]
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def sync_due(self):
+        """Whether the shared version hasn't been read for sync_interval seconds"""
+
+        with self._lock:
+            return self._synced_at is None or self.clock() - self._synced_at >= self.sync_interval
+
+    def sync(self, shared_version):
+        """Clears the cache if the shared version changed since the last sync; returns whether it did"""
+
+        with self._lock:
+            self._synced_at = self.clock()
+            if shared_version == self._shared_version:
+                return False
+            self._shared_version = shared_version
+            self._entries.clear()
+            self._generation += 1
+            return True
+
+    def snapshot(self, obj):
+        """The cached columns of a loaded object, or None if some aren't loaded"""
+
+        loaded = attributes.instance_state(obj).dict
+        keys = self.models[type(obj)][0]
+        if not all(key in loaded for key in keys):
+            return None
+        return tuple(loaded[key] for key in keys)
+
+    def instance(self, model, values):
+        """A detached object with a snapshot's columns; the rest load on first access"""
+
+        obj = inspect(model).class_manager.new_instance()
+        for key, value in zip(self.models[model][0], values):
+            attributes.set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        return obj
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def metric_lines(self):
+        """Prometheus text lines for the counters"""
+
+        stats = self.stats()
+        lines = ["# HELP blogly_identity_cache_entries Snapshots in the identity cache.",
+                 "# TYPE blogly_identity_cache_entries gauge",
+                 f"blogly_identity_cache_entries {stats['entries']}"]
+        for name in ("hits", "misses", "evictions"):
+            lines.append(f"# HELP blogly_identity_cache_{name}_total Identity cache {name}.")
+            lines.append(f"# TYPE blogly_identity_cache_{name}_total counter")
+            lines.append(f"blogly_identity_cache_{name}_total {stats[name]}")
+        return lines
+
+
+# Every identity cache in the process; a commit through any app's session invalidates them all
+_caches = weakref.WeakSet()
+
+
+class IdentityCacheSession(RoutingSession):
+    """Routing session whose primary key lookups fall back to the app's identity cache"""
+
+    @property
+    def identity_cache(self):
+        return self.app.extensions.get("identity_cache")
+
+    def get_cached(self, model, pk):
+        """The object with primary key pk from the identity cache, or None.
+
+        None also when the object is already in the identity map, where the
+        ordinary lookup will find it, or was written in this transaction.
+        """
+
+        cache = self.identity_cache
+        if cache is None or model not in cache.models:
+            return None
+        key = inspect(model).identity_key_from_primary_key((pk,))
+        if key in self.identity_map or not self._may_use_cache(model, pk):
+            return None
+        if cache.sync_due():
+            self._sync_shared_version(cache)
+        values = cache.get(model, pk)
+        if values is None:
+            return None
+        instance = cache.instance(model, values)
+        self.add(instance)
+        return instance
+
+    def get_many(self, model, ids):
+        """{id: object} for primary keys, like Session.get for many.
+
+        Each one comes from the identity map or the identity cache if it can,
+        and the rest are loaded with one SELECT ... IN. Missing rows are left
+        out.
+        """
+
+        mapper = inspect(model)
+        found, missing = {}, []
+        for pk in set(ids):
+            instance = (self.identity_map.get(mapper.identity_key_from_primary_key((pk,)))
+                        or self.get_cached(model, pk))
+            if instance is None:
+                missing.append(pk)
+            else:
+                found[pk] = instance
+        if missing:
+            column = mapper.primary_key[0]
+            for instance in self.query(model).filter(column.in_(missing)):
+                found[mapper.primary_key_from_instance(instance)[0]] = instance
+        return found
+
+    def _may_use_cache(self, model, pk):
+        return ((model, pk) not in self.info.get("identity_stale", ())
+                and model not in self.info.get("identity_stale_models", ()))
+
+    def _sync_shared_version(self, cache):
+        # on its own primary connection, so it neither begins this transaction nor reads a lagging replica
+        from models import CacheVersion
+        query = select(CacheVersion.version).where(CacheVersion.name == SHARED_VERSION)
+        with self.db.get_engine(self.app).connect() as conn:
+            version = conn.execute(query).scalar()
+        cache.sync(version or 0)
+
+
+class CachedQuery(BaseQuery):
+    """Query class for cached models: get() tries the identity cache before the database"""
+
+    def get(self, ident):
+        model = self.column_descriptions[0]["entity"]
+        lookup = getattr(self.session, "get_cached", None)
+        if lookup is not None and not isinstance(ident, (tuple, list, dict)):
+            instance = lookup(model, ident)
+            if instance is not None:
+                return instance
+        return super().get(ident)
+
+
+class CachingSQLAlchemy(RoutingSQLAlchemy):
+    """RoutingSQLAlchemy whose sessions use the identity cache"""
+
+    session_class = IdentityCacheSession
+
+
+@event.listens_for(IdentityCacheSession, "after_begin")
+def remember_generation(session, transaction, connection):
+    # snapshots read in this transaction are only stored if nothing was invalidated since it began
+    cache = session.identity_cache
+    if cache is not None:
+        session.info.setdefault("identity_generation", cache.generation())
+
+
+def _bump_shared_version(session):
+    # once per transaction, and committed with the write, so other processes clear when they see it
+    if not session.info.get("identity_bumped"):
+        session.info["identity_bumped"] = True
+        from models import CacheVersion
+        CacheVersion.bump(SHARED_VERSION)
+
+
+@event.listens_for(IdentityCacheSession, "after_flush")
+def note_flushed_rows(session, flush_context):
+    cache = session.identity_cache
+    if cache is None:
+        return
+    for obj in chain(session.dirty, session.deleted):
+        if type(obj) in cache.models:
+            identity = inspect(obj).identity
+            if identity is not None:
+                session.info.setdefault("identity_stale", set()).add((type(obj), identity[0]))
+                _bump_shared_version(session)
+
+
+@event.listens_for(IdentityCacheSession, "do_orm_execute")
+def note_bulk_write(orm_execute_state):
+    # bulk Query.update()/delete() bypass the flush
+    if orm_execute_state.is_select or orm_execute_state.is_insert:
+        return
+    session = orm_execute_state.session
+    cache = session.identity_cache
+    if cache is None:
+        return
+    statement = orm_execute_state.statement
+    table = getattr(statement, "table", None)
+    columns = {getattr(column, "key", column) for column in getattr(statement, "_values", None) or ()}
+    for model, (keys, volatile) in cache.models.items():
+        # ORM statements name an annotated copy of the table, so compare names
+        if table is not None and table.name != model.__table__.name:
+            continue
+        if orm_execute_state.is_update and columns and columns <= volatile:
+            continue
+        session.info.setdefault("identity_stale_models", set()).add(model)
+        _bump_shared_version(session)
+
+
+@event.listens_for(IdentityCacheSession, "after_commit")
+def invalidate_on_commit(session):
+    keys = session.info.pop("identity_stale", None)
+    models = session.info.pop("identity_stale_models", None)
+    session.info.pop("identity_generation", None)
+    session.info.pop("identity_bumped", None)
+    if keys or models:
+        for cache in list(_caches):
+            cache.invalidate(keys or (), models or ())
+
+
+@event.listens_for(IdentityCacheSession, "after_soft_rollback")
+def forget_on_rollback(session, previous_transaction):
+    for name in ("identity_stale", "identity_stale_models", "identity_generation", "identity_bumped"):
+        session.info.pop(name, None)
+
+
+def store_snapshot(target, context, attrs=None):
+    """Load/refresh handler: caches the row as it was read"""
+
+    # no context: a bulk update set the values in Python, not from the database
+    if context is None:
+        return
+    session = context.session
+    cache = getattr(session, "identity_cache", None)
+    # a replica may not have the latest commit yet, and its rows would outlive the lag
+    if cache is None or has_request_context() and reading_replica():
+        return
+    model = type(target)
+    keys = cache.models[model][0]
+    if attrs is not None and not set(attrs).intersection(keys):
+        return
+    identity = inspect(target).identity
+    generation = session.info.get("identity_generation")
+    if identity is None or generation is None or not session._may_use_cache(model, identity[0]):
+        return
+    values = cache.snapshot(target)
+    if values is not None:
+        cache.put(model, identity[0], values, generation)
+
+
+def init_identity_cache(app):
+    """Creates the app's identity cache for users and tags (IDENTITY_CACHE_SIZE 0 turns it off)"""
+
+    size = app.config.get("IDENTITY_CACHE_SIZE", 4096)
+    if not size:
+        return None
+
+    from models import User, Tag
+
+    cache = IdentityCache(size, app.config.get("IDENTITY_CACHE_TTL", 60),
+                          sync_interval=app.config.get("IDENTITY_CACHE_SYNC_SECONDS", 1))
+    for model in (User, Tag):
+        cache.register(model, volatile=("post_count", "updated_at"))
+        if not event.contains(model, "load", store_snapshot):
+            event.listen(model, "load", store_snapshot)
+            event.listen(model, "refresh", store_snapshot)
+    app.extensions["identity_cache"] = cache
+    _caches.add(cache)
+    return cache
@@ -0,0 +1,205 @@
+"""Per-request SQL, render and latency instrumentation for Blogly.
+
+Each request is timed in three parts: SQL statements (count and time, from
+the engine's cursor events), template rendering (from Flask's template
+signals) and total latency. The numbers feed per-route histograms exposed in
+Prometheus text format at /metrics and are summarized for the browser in a
+Server-Timing header.
+
+Statements slower than METRICS_SLOW_QUERY_MS are logged and kept, with their
+bind parameters, in a bounded sample list.
+"""
+
+import time
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+from flask import Response, current_app, g, has_app_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "blogly_request_duration_seconds": ("Total request latency.", SECONDS_BUCKETS),
+    "blogly_db_duration_seconds": ("Time spent in SQL statements per request.", SECONDS_BUCKETS),
+    "blogly_render_duration_seconds": ("Time spent rendering templates per request.", SECONDS_BUCKETS),
+    "blogly_db_statements": ("SQL statements issued per request.", COUNT_BUCKETS),
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class RequestTiming:
+    """What one request spent, filled in as it runs"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_start = None
+
+
+class Metrics:
+    """Per-route histograms and slow-query samples for one process"""
+
+    def __init__(self, slow_query_ms=None, slow_query_samples=100):
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=slow_query_samples)
+        self.slow_query_total = 0
+        self.histograms = {}
+        self.lock = Lock()
+
+    def record(self, route, timing, total):
+        values = {
+            "blogly_request_duration_seconds": total,
+            "blogly_db_duration_seconds": timing.db_time,
+            "blogly_render_duration_seconds": timing.render_time,
+            "blogly_db_statements": timing.statements,
+        }
+        with self.lock:
+            for name, value in values.items():
+                key = (name, route)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+                self.histograms[key].observe(value)
+
+    def sample_slow_query(self, statement, parameters, duration):
+        with self.lock:
+            self.slow_query_total += 1
+            self.slow_queries.append({
+                "route": request.endpoint,
+                "statement": statement,
+                "parameters": parameters,
+                "ms": round(duration * 1000, 3),
+            })
+
+    def render(self):
+        """The Prometheus text exposition of every histogram"""
+
+        lines = []
+        with self.lock:
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, route), histogram in sorted(self.histograms.items()):
+                    if metric == name:
+                        lines.extend(histogram.lines(name, f'route="{route}"'))
+            lines.append("# HELP blogly_slow_queries_total Statements slower than METRICS_SLOW_QUERY_MS.")
+            lines.append("# TYPE blogly_slow_queries_total counter")
+            lines.append(f"blogly_slow_queries_total {self.slow_query_total}")
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(timing, total):
+    """Server-Timing header value for one request"""
+
+    return (f'db;dur={timing.db_time * 1000:.1f};desc="{timing.statements} queries", '
+            f"render;dur={timing.render_time * 1000:.1f}, "
+            f"total;dur={total * 1000:.1f}")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and "request_timing" in g:
+        conn.info["statement_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("statement_start", None)
+    if start is None or not has_app_context() or "request_timing" not in g:
+        return
+
+    duration = time.perf_counter() - start
+    timing = g.request_timing
+    timing.statements += 1
+    timing.db_time += duration
+
+    metrics = current_app.extensions["metrics"]
+    if metrics.slow_query_ms is not None and duration * 1000 >= metrics.slow_query_ms:
+        metrics.sample_slow_query(statement, parameters, duration)
+        current_app.logger.warning("slow query (%.1f ms) in %s: %s %r",
+                                   duration * 1000, request.endpoint, statement, parameters)
+
+
+def init_metrics(app):
+    """Hooks request timing into app and adds the /metrics endpoint"""
+
+    if not app.config.get("METRICS_ENABLED", True):
+        return None
+
+    metrics = Metrics(app.config.get("METRICS_SLOW_QUERY_MS"),
+                      app.config.get("METRICS_SLOW_QUERY_SAMPLES", 100))
+    app.extensions["metrics"] = metrics
+
+    @app.before_request
+    def start_timing():
+        g.request_timing = RequestTiming()
+
+    @app.after_request
+    def finish_timing(response):
+        timing = g.get("request_timing")
+        if timing is None:
+            return response
+        total = time.perf_counter() - timing.start
+        # headers go out before a streamed body, so its Server-Timing covers only the work so far
+        response.headers["Server-Timing"] = server_timing(timing, total)
+        route = request.endpoint or "unmatched"
+        if response.is_streamed:
+            # statements keep counting while the body streams; record once it has all been sent
+            response.call_on_close(lambda: metrics.record(route, timing, time.perf_counter() - timing.start))
+        else:
+            g.pop("request_timing")
+            metrics.record(route, timing, total)
+        return response
+
+    def start_render(sender, template, context, **extra):
+        timing = g.get("request_timing")
+        if timing is not None and timing.render_start is None:
+            timing.render_start = time.perf_counter()
+
+    def end_render(sender, template, context, **extra):
+        timing = g.get("request_timing")
+        if timing is not None and timing.render_start is not None:
+            timing.render_time += time.perf_counter() - timing.render_start
+            timing.render_start = None
+
+    # weak=False: the handlers are closures that nothing else holds on to
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(end_render, app, weak=False)
+
+    @app.route("/metrics")
+    def show_metrics():
+        """Exposes per-route histograms in Prometheus text format"""
+        body = metrics.render()
+        identity_cache = app.extensions.get("identity_cache")
+        if identity_cache is not None:
+            body += "\n".join(identity_cache.metric_lines()) + "\n"
+        return Response(body, mimetype="text/plain; version=0.0.4")
+
+    return metrics
@@ -0,0 +1,354 @@
+"""Versioned schema migrations for Blogly.
+
+Each migration is a function that receives a Connection inside a transaction.
+Applied versions are recorded in the schema_migrations table, so running
+upgrade() repeatedly only applies what is pending.
+"""
+
+import re
+from contextlib import contextmanager
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, JSON, MetaData, String, Table, Text, func,
+                        bindparam, inspect, select, text)
+from models import EXCERPT_LENGTH, IDEMPOTENCY_KEY_LENGTH, excerpt
+
+MIGRATIONS = []
+
+# Rows per statement when a migration fills in a new column from Python
+BACKFILL_BATCH_SIZE = 1000
+
+# Indexes the hot lookup paths rely on, by name and the table they belong to
+REQUIRED_INDEXES = {
+    "ix_post_tags_tag_id_post_id": "post_tags",
+    "ix_posts_created_at_id": "posts",
+    "ix_posts_user_id_created_at": "posts",
+    "uq_posts_user_id_idempotency_key": "posts",
+    "uq_tags_name_lower": "tags",
+    "ix_users_last_name_first_name_id": "users",
+    "ix_users_post_count_id": "users",
+    "ix_tags_post_count_id": "tags",
+}
+
+# Indexes that only exist on Postgres
+POSTGRES_INDEXES = {
+    "ix_posts_search_vector": "posts",
+}
+
+
+def migration(version, description):
+    """Registers a migration function under a version number"""
+
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return decorator
+
+
+@migration(1, "Create users, posts, tags and post_tags")
+def create_tables(conn):
+    metadata = MetaData()
+    Table("users", metadata,
+          Column("id", Integer, primary_key=True, autoincrement=True),
+          Column("first_name", String(50), nullable=False),
+          Column("last_name", String(50), nullable=False),
+          Column("image_url", Text))
+    Table("posts", metadata,
+          Column("id", Integer, primary_key=True, autoincrement=True),
+          Column("title", Text, nullable=False),
+          Column("content", Text, nullable=False),
+          Column("created_at", DateTime, server_default=func.now()),
+          Column("user_id", Integer, ForeignKey("users.id"), nullable=False))
+    Table("tags", metadata,
+          Column("id", Integer, primary_key=True, autoincrement=True),
+          Column("name", String(50), nullable=False))
+    Table("post_tags", metadata,
+          Column("post_id", Integer, ForeignKey("posts.id"), primary_key=True),
+          Column("tag_id", Integer, ForeignKey("tags.id"), primary_key=True))
+    metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, "Index tag, feed, author and name lookups")
+def add_lookup_indexes(conn):
+    # tag names used to be unique only as typed, and the index below makes them unique ignoring case
+    _merge_case_duplicate_tags(conn)
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_post_tags_tag_id_post_id ON post_tags (tag_id, post_id)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_posts_created_at_id ON posts (created_at DESC, id)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_posts_user_id_created_at ON posts (user_id, created_at)")
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_tags_name_lower ON tags (lower(name))")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_users_last_name_first_name_id ON users (last_name, first_name, id)")
+
+
+# The tag kept for each name, ignoring case: the oldest, where there is more than one
+_KEPT_TAGS = "SELECT lower(name) AS lname, min(id) AS id FROM tags GROUP BY lower(name) HAVING count(*) > 1"
+
+
+def _merge_case_duplicate_tags(conn):
+    """Folds tags whose names differ only by case ("Python", "python") into the oldest of them"""
+
+    conn.exec_driver_sql(
+        "INSERT INTO post_tags (post_id, tag_id) "
+        "SELECT DISTINCT post_tags.post_id, kept.id FROM post_tags "
+        "JOIN tags ON tags.id = post_tags.tag_id "
+        f"JOIN ({_KEPT_TAGS}) kept ON kept.lname = lower(tags.name) AND kept.id <> tags.id "
+        "WHERE NOT EXISTS (SELECT 1 FROM post_tags existing "
+        "WHERE existing.post_id = post_tags.post_id AND existing.tag_id = kept.id)")
+    duplicates = ("SELECT tags.id FROM tags "
+                  f"JOIN ({_KEPT_TAGS}) kept ON kept.lname = lower(tags.name) AND kept.id <> tags.id")
+    conn.exec_driver_sql(f"DELETE FROM post_tags WHERE tag_id IN ({duplicates})")
+    conn.exec_driver_sql(f"DELETE FROM tags WHERE id IN ({duplicates})")
+
+
+@migration(3, "Add updated_at to users, posts and tags")
+def add_updated_at(conn):
+    for table, initial in (("users", "CURRENT_TIMESTAMP"), ("posts", "created_at"),
+                           ("tags", "CURRENT_TIMESTAMP")):
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP")
+        conn.exec_driver_sql(f"UPDATE {table} SET updated_at = {initial}")
+        if conn.dialect.name == "postgresql":
+            conn.exec_driver_sql(f"ALTER TABLE {table} ALTER COLUMN updated_at SET DEFAULT now()")
+
+
+@migration(4, "Add cache_versions counters")
+def add_cache_versions(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS cache_versions ("
+        "name VARCHAR(50) PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    conn.exec_driver_sql("INSERT INTO cache_versions (name, version) VALUES ('tags', 0)")
+
+
+@migration(5, "Add full-text search vector to posts (Postgres only)")
+def add_search_vector(conn):
+    if conn.dialect.name != "postgresql":
+        return
+    conn.exec_driver_sql(
+        "ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED")
+    conn.exec_driver_sql("CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)")
+
+
+@migration(6, "Add denormalized post_count to users and tags")
+def add_post_counts(conn):
+    for table, count in (("users", "SELECT count(*) FROM posts WHERE posts.user_id = users.id"),
+                         ("tags", "SELECT count(*) FROM post_tags WHERE post_tags.tag_id = tags.id")):
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0")
+        conn.exec_driver_sql(f"UPDATE {table} SET post_count = ({count})")
+        conn.exec_driver_sql(f"CREATE INDEX ix_{table}_post_count_id ON {table} (post_count, id)")
+
+
+@migration(7, "Add precomputed post feeds")
+def add_feeds(conn):
+    # Feeds fill in on the next post change or `flask blogly rebuild-feeds`; until then pages build them
+    Table("feeds", MetaData(),
+          Column("name", String(50), primary_key=True),
+          Column("entries", JSON, nullable=False),
+          Column("updated_at", DateTime, server_default=func.now())).create(conn, checkfirst=True)
+
+
+# (table, column, parent) for each foreign key that cascades deletes from its parent
+CASCADING_FOREIGN_KEYS = (("posts", "user_id", "users"), ("post_tags", "post_id", "posts"),
+                          ("post_tags", "tag_id", "tags"))
+
+
+@migration(8, "Cascade deletes through foreign keys; add deletion_jobs")
+def add_delete_cascades(conn):
+    if conn.dialect.name == "postgresql":
+        for table, column, parent in CASCADING_FOREIGN_KEYS:
+            name = next(fk["name"] for fk in inspect(conn).get_foreign_keys(table)
+                        if fk["constrained_columns"] == [column])
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table} DROP CONSTRAINT {name}, ADD CONSTRAINT {name} "
+                f"FOREIGN KEY ({column}) REFERENCES {parent} (id) ON DELETE CASCADE")
+    else:
+        # SQLite can't alter a constraint; rebuild the tables, parents before children
+        for table in ("posts", "post_tags"):
+            _rebuild_sqlite_table(conn, table, lambda sql: re.sub(
+                r"(REFERENCES \w+ \(id\))(?! ON DELETE)", r"\1 ON DELETE CASCADE", sql))
+
+    Table("deletion_jobs", MetaData(),
+          Column("id", Integer, primary_key=True, autoincrement=True),
+          Column("kind", String(10), nullable=False),
+          Column("target_id", Integer, nullable=False),
+          Column("status", String(10), nullable=False, server_default="pending"),
+          Column("total", Integer, nullable=False),
+          Column("deleted", Integer, nullable=False),
+          Column("feeds", JSON),
+          Column("error", Text),
+          Column("created_at", DateTime, server_default=func.now()),
+          Column("updated_at", DateTime, server_default=func.now())).create(conn, checkfirst=True)
+
+
+@migration(9, "Add local avatar thumbnails to users")
+def add_avatars(conn):
+    # Filled in by the avatar fetcher as pages are viewed, or by `flask blogly fetch-avatars`
+    conn.exec_driver_sql("ALTER TABLE users ADD COLUMN avatar VARCHAR(40)")
+    conn.exec_driver_sql("ALTER TABLE users ADD COLUMN avatar_source TEXT")
+
+
+@migration(10, "Add stored post excerpts")
+def add_post_excerpts(conn):
+    conn.exec_driver_sql(f"ALTER TABLE posts ADD COLUMN excerpt VARCHAR({EXCERPT_LENGTH + 1})")
+    if conn.dialect.name == "postgresql":
+        # the same cut as models.excerpt(): at the last space within EXCERPT_LENGTH characters
+        conn.exec_driver_sql(
+            f"UPDATE posts SET excerpt = CASE WHEN char_length(content) <= {EXCERPT_LENGTH} THEN content "
+            f"ELSE regexp_replace(left(content, {EXCERPT_LENGTH}), ' [^ ]*$', '') || '\u2026' END")
+        return
+
+    posts = Table("posts", MetaData(), Column("id", Integer), Column("content", Text), Column("excerpt", Text))
+    update = posts.update().where(posts.c.id == bindparam("post_id")).values(excerpt=bindparam("text"))
+    last_id = 0
+    while True:
+        rows = conn.execute(select(posts.c.id, posts.c.content).where(posts.c.id > last_id)
+                            .order_by(posts.c.id).limit(BACKFILL_BATCH_SIZE)).all()
+        if not rows:
+            break
+        conn.execute(update, [{"post_id": id, "text": excerpt(content)} for id, content in rows])
+        last_id = rows[-1].id
+
+
+@migration(11, "Add idempotency keys to posts")
+def add_idempotency_keys(conn):
+    conn.exec_driver_sql(f"ALTER TABLE posts ADD COLUMN idempotency_key VARCHAR({IDEMPOTENCY_KEY_LENGTH})")
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX uq_posts_user_id_idempotency_key ON posts (user_id, idempotency_key)")
+
+
+@migration(12, "Add the identity cache's shared version")
+def add_identity_cache_version(conn):
+    # bumped by writes from then on; inserting it on first use could race between transactions
+    conn.exec_driver_sql(
+        "INSERT INTO cache_versions (name, version) SELECT 'identity', 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM cache_versions WHERE name = 'identity')")
+
+
+def _rebuild_sqlite_table(conn, table, change):
+    """Recreates a SQLite table from change(its CREATE TABLE sql), keeping rows and indexes.
+
+    This is SQLite's documented procedure for schema changes ALTER TABLE can't
+    make; upgrade() runs it with foreign key enforcement off.
+    """
+
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :t"),
+                       {"t": table}).scalar()
+    indexes = [row[0] for row in conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :t AND sql IS NOT NULL"),
+        {"t": table})]
+    conn.exec_driver_sql(re.sub(rf"^CREATE TABLE \"?{table}\"?", f"CREATE TABLE {table}_new", change(sql)))
+    conn.exec_driver_sql(f"INSERT INTO {table}_new SELECT * FROM {table}")
+    conn.exec_driver_sql(f"DROP TABLE {table}")
+    conn.exec_driver_sql(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for index in indexes:
+        conn.exec_driver_sql(index)
+
+
+@contextmanager
+def _foreign_keys_off(conn):
+    """Turns off SQLite's foreign key enforcement around a schema change (a no-op in a transaction)"""
+
+    if conn.dialect.name != "sqlite":
+        yield
+        return
+    conn.exec_driver_sql("PRAGMA foreign_keys = OFF")
+    try:
+        yield
+    finally:
+        conn.exec_driver_sql("PRAGMA foreign_keys = ON")
+
+
+def _check_foreign_keys(conn):
+    """Fails the migration if it left rows that break a foreign key (SQLite, where they weren't enforced)"""
+
+    if conn.dialect.name == "sqlite":
+        problems = conn.exec_driver_sql("PRAGMA foreign_key_check").fetchall()
+        if problems:
+            raise RuntimeError(f"foreign key violations after migration: {problems[:5]}")
+
+
+def _ensure_version_table(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, description TEXT NOT NULL, "
+        "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+
+
+def _lock(conn):
+    """Serializes concurrent upgrades (e.g. several workers starting at once)"""
+
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("SELECT pg_advisory_xact_lock(7410001)")
+
+
+def applied_versions(conn):
+    """Returns the set of migration versions recorded in the database"""
+
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+
+def _record(conn, version, description):
+    conn.execute(text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                 {"v": version, "d": description})
+
+
+def upgrade(engine):
+    """Applies pending migrations in order, each in its own transaction.
+
+    Returns the list of (version, description) that were applied.
+    """
+
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        with engine.connect() as conn, _foreign_keys_off(conn), conn.begin():
+            _lock(conn)
+            if version in applied_versions(conn):
+                continue
+            fn(conn)
+            _check_foreign_keys(conn)
+            _record(conn, version, description)
+        applied.append((version, description))
+    return applied
+
+
+def stamp(engine):
+    """Marks every migration as applied, for schemas built with db.create_all()"""
+
+    with engine.begin() as conn:
+        _lock(conn)
+        done = applied_versions(conn)
+        for version, description, fn in MIGRATIONS:
+            if version not in done:
+                _record(conn, version, description)
+
+
+def existing_indexes(conn):
+    """Returns the names of the indexes present in the live schema"""
+
+    if conn.dialect.name == "postgresql":
+        rows = conn.exec_driver_sql(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")
+    else:
+        rows = conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")
+    return {row[0] for row in rows}
+
+
+def check_schema(engine):
+    """Reports problems with the live schema as a list of messages (empty if fine)"""
+
+    with engine.connect() as conn:
+        pending = [(v, d) for v, d, fn in MIGRATIONS if v not in applied_versions(conn)]
+        present = existing_indexes(conn)
+        required = dict(REQUIRED_INDEXES)
+        if conn.dialect.name == "postgresql":
+            required.update(POSTGRES_INDEXES)
+
+    problems = [f"migration {v} not applied: {d}" for v, d in pending]
+    problems += [f"missing index {name} on {table}"
+                 for name, table in required.items() if name not in present]
+    return problems
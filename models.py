@@ -1,18 +1,49 @@
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import DDL, bindparam, desc, event, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import deferred, joinedload, selectinload, undefer, validates
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import functions
+from pagination import paginate
+from identitycache import CachedQuery, CachingSQLAlchemy
 
-db = SQLAlchemy()
+db = CachingSQLAlchemy()
 
 def connect_db(app):
   db.app = app
   db.init_app(app)
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+  """SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to"""
+  if type(dbapi_connection).__module__ == 'sqlite3':
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys = ON')
+    cursor.close()
+
+@compiles(functions.now, 'sqlite')
+def sqlite_now_with_milliseconds(element, compiler, **kw):
+  """SQLite's CURRENT_TIMESTAMP has whole seconds, so two edits in a second would share a version"""
+  return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'NOW')"
+
+def select_columns(model, columns, keys):
+  """The model's query, or a query for rows of columns plus any missing key columns"""
+  if columns is None:
+    return model.query
+  missing = [key for key in keys if not any(key is column for column in columns)]
+  return db.session.query(*columns, *missing)
+
 """Models for Blogly."""
 
 class User(db.Model):
   """Creates user model"""
 
   __tablename__ = "users"
+  query_class = CachedQuery
 
   def __repr__(self):
     """Show info about user"""
@@ -23,13 +54,69 @@ class User(db.Model):
   first_name = db.Column(db.String(50),nullable = False)
   last_name = db.Column(db.String(50),nullable = False)
   image_url = db.Column(db.Text)
+  # Local thumbnail file (see avatars.py) and the image_url it was made from
+  avatar = db.Column(db.String(40))
+  avatar_source = db.Column(db.Text)
+  # Also moved by every post_count change and by touch(), so it versions the user page
+  updated_at = db.Column(db.DateTime, default = db.func.now(), server_default = db.func.now(),
+    onupdate = db.func.now())
+  post_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0')
 
-  posts = db.relationship('Post', cascade = "all,delete-orphan", backref = 'user')
+  # passive_deletes: the database's ON DELETE CASCADE removes posts and post_tags, not the ORM
+  posts = db.relationship('Post', cascade = "all,delete-orphan", backref = 'user', passive_deletes = True)
 
   def get_full_name(self):
     """Get full name of user"""
     return f"{self.first_name} {self.last_name}"
 
+  @classmethod
+  def page_keys(cls, sort=None):
+    """Get the keyset columns and direction for a users listing: by name, or most posts first"""
+    if sort == 'popular':
+      return (cls.post_count, cls.id), True
+    return (cls.last_name, cls.first_name, cls.id), False
+
+  @classmethod
+  def get_page(cls, after=None, before=None, columns=None, sort=None):
+    """Get a page of users in page_keys(sort) order, as rows if columns are given"""
+    keys, descending = cls.page_keys(sort)
+    return paginate(select_columns(cls, columns, keys), keys, after, before, descending=descending)
+
+  @classmethod
+  def change_post_count(cls, user_id, delta):
+    """Add delta to a user's post_count in the current transaction"""
+    cls.query.filter_by(id = user_id).update(
+      {cls.post_count: cls.post_count + delta}, synchronize_session = False)
+
+  @classmethod
+  def touch(cls, user_id):
+    """Move a user's updated_at in the current transaction, for a post change their page shows"""
+    cls.query.filter_by(id = user_id).update({cls.updated_at: db.func.now()}, synchronize_session = False)
+
+  @classmethod
+  def get_version(cls, user_id):
+    """Get what the user page depends on: (updated_at,), which adding, deleting or retitling a post moves"""
+    return db.session.query(cls.updated_at).filter(cls.id == user_id).first()
+
+  @classmethod
+  def get_list_version(cls):
+    """Get what the users listing depends on: (newest change, user count)"""
+    return db.session.query(db.func.max(cls.updated_at), db.func.count(cls.id)).one()
+
+
+EXCERPT_LENGTH = 200
+
+def excerpt(text):
+  """Shorten text to at most EXCERPT_LENGTH characters, cut at a word boundary"""
+  if text is None or len(text) <= EXCERPT_LENGTH:
+    return text
+  return text[:EXCERPT_LENGTH].rsplit(' ', 1)[0] + '\u2026'
+
+IDEMPOTENCY_KEY_LENGTH = 100
+TAG_NAME_LENGTH = 50
+
+# What each item given to Post.create_batch may have
+BATCH_FIELDS = ('title', 'content', 'tags', 'created_at', 'idempotency_key')
 
 class Post(db.Model):
   """Creates post model"""
@@ -38,40 +125,372 @@ class Post(db.Model):
 
   def __repr__(self):
     u = self
-    return f"<Post id={u.id} title={u.title} content={u.content} created_at={u.created_at}>"
+    return f"<Post id={u.id} title={u.title} created_at={u.created_at}>"
 
   id = db.Column(db.Integer, primary_key = True,autoincrement=True)
   title = db.Column(db.Text, nullable = False)
-  content = db.Column(db.Text, nullable = False)
+  # Articles are unbounded, so only pages that show one load it: query with undefer(Post.content)
+  content = deferred(db.Column(db.Text, nullable = False))
+  # What listings and feeds show instead, kept in step with content by set_excerpt
+  excerpt = db.Column(db.String(EXCERPT_LENGTH + 1))
   created_at = db.Column(db.DateTime, server_default = db.func.now())
-  user_id = db.Column(db.Integer, db.ForeignKey('users.id'),nullable=False)
+  updated_at = db.Column(db.DateTime, default = db.func.now(), server_default = db.func.now(),
+    onupdate = db.func.now())
+  user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete = 'CASCADE'),nullable=False)
+  # Set by clients of create_batch, so a retried batch doesn't create a post twice; unique per user
+  idempotency_key = db.Column(db.String(IDEMPOTENCY_KEY_LENGTH))
+
+  post_tags = db.relationship('PostTag',cascade = "all,delete", backref = 'posts', passive_deletes = True)
 
-  post_tags = db.relationship('PostTag',cascade = "all,delete", backref = 'posts')
+  @validates('content')
+  def set_excerpt(self, key, content):
+    """Store the excerpt whenever content is assigned"""
+    self.excerpt = excerpt(content)
+    return content
+
+  @classmethod
+  def with_user_and_tags(cls):
+    """Loader strategy for rendering posts: author joined, tags in one SELECT ... IN"""
+    return cls.query.options(
+      joinedload(cls.user),
+      selectinload(cls.post_tags).joinedload(PostTag.tags))
+
+  @classmethod
+  def get_for_page(cls, post_id):
+    """Get a post with its content and tags for the post page.
+
+    The author and tags come from the identity cache when they are there, so
+    a page whose rows are cached takes two queries, and at most four.
+    """
+    post = cls.query.options(undefer(cls.content), selectinload(cls.post_tags)).get(post_id)
+    if post is not None:
+      set_committed_value(post, 'user', db.session().get_many(User, [post.user_id]).get(post.user_id))
+    if post is not None and post.post_tags:
+      tags = db.session().get_many(Tag, [post_tag.tag_id for post_tag in post.post_tags])
+      for post_tag in post.post_tags:
+        set_committed_value(post_tag, 'tags', tags.get(post_tag.tag_id))
+    return post
 
   @classmethod
   def get_newest_posts(cls):
     """Get the 5 newest post"""
-    return cls.query.order_by(desc('created_at')).limit(5).all()
+    return cls.with_user_and_tags().order_by(desc('created_at')).limit(5).all()
+
+  @classmethod
+  def get_version(cls, post_id):
+    """Get what the post page depends on: post, author and tag changes plus tag count"""
+    return (db.session.query(cls.updated_at, User.updated_at, db.func.max(Tag.updated_at),
+        db.func.count(PostTag.tag_id))
+      .join(User, User.id == cls.user_id)
+      .outerjoin(PostTag, PostTag.post_id == cls.id)
+      .outerjoin(Tag, Tag.id == PostTag.tag_id)
+      .filter(cls.id == post_id)
+      .group_by(cls.id, User.id)
+      .first())
+
+  def touch_listing_pages(self):
+    """Mark the pages listing this post's title, its author's and its tags', as changed"""
+    User.touch(self.user_id)
+    Tag.touch(select(PostTag.tag_id).where(PostTag.post_id == self.id))
+
+  def set_tags(self, tag_ids):
+    """Make the post's tags exactly tag_ids, touching only the pairs that changed.
+
+    Unknown ids are ignored. Returns the (added, removed) sets of tag ids;
+    nothing is committed.
+    """
+    wanted = set()
+    if tag_ids:
+      wanted = {id for (id,) in db.session.query(Tag.id).filter(Tag.id.in_(set(tag_ids)))}
+
+    if self.id is None:
+      db.session.flush()
+      current = set()
+    else:
+      current = {id for (id,) in db.session.query(PostTag.tag_id).filter_by(post_id = self.id)}
+
+    added, removed = wanted - current, current - wanted
+    if removed:
+      PostTag.query.filter(PostTag.post_id == self.id, PostTag.tag_id.in_(removed)).delete(
+        synchronize_session = False)
+    if added:
+      db.session.execute(PostTag.__table__.insert(),
+        [{'post_id': self.id, 'tag_id': tag_id} for tag_id in added])
+    Tag.change_post_counts(added, 1)
+    Tag.change_post_counts(removed, -1)
+    if added or removed:
+      db.session.expire(self, ['post_tags'])
+      self.updated_at = db.func.now()
+
+    return added, removed
+
+  @staticmethod
+  def parse_batch_item(item):
+    """Check one create_batch item; returns (values, errors)"""
+    if not isinstance(item, dict):
+      return {}, ['must be an object']
+    errors = [f'unknown field {name}' for name in item if name not in BATCH_FIELDS]
+
+    title, content = item.get('title'), item.get('content')
+    if not isinstance(title, str) or not title.strip():
+      errors.append('title is required')
+    if not isinstance(content, str):
+      errors.append('content is required')
+
+    tags = item.get('tags') or []
+    if not isinstance(tags, list) or not all(isinstance(n, str) and 0 < len(n.strip()) <= TAG_NAME_LENGTH
+        for n in tags):
+      errors.append(f'tags must be a list of names of 1 to {TAG_NAME_LENGTH} characters')
+      tags = []
+
+    key = item.get('idempotency_key')
+    if key is not None and not (isinstance(key, str) and 0 < len(key) <= IDEMPOTENCY_KEY_LENGTH):
+      errors.append(f'idempotency_key must be a string of 1 to {IDEMPOTENCY_KEY_LENGTH} characters')
+
+    created_at = item.get('created_at')
+    if created_at is not None:
+      try:
+        created_at = datetime.fromisoformat(created_at)
+      except (TypeError, ValueError):
+        errors.append('created_at must be an ISO 8601 time')
+      else:
+        if created_at.tzinfo:
+          created_at = created_at.astimezone(timezone.utc).replace(tzinfo = None)
+
+    return {'title': title, 'content': content, 'tags': [name.strip() for name in tags],
+      'idempotency_key': key, 'created_at': created_at}, errors
+
+  @classmethod
+  def create_batch(cls, user_id, items):
+    """Create many posts for a user with a handful of multi-row statements.
+
+    items are dicts of BATCH_FIELDS: title, content and optionally tags (by
+    name, created when missing), created_at (ISO 8601) and idempotency_key.
+    An item whose key the user already used is not inserted again. Returns
+    one result per item, {'status': 'created' or 'existing', 'id': id}. If
+    any item is invalid nothing is written; each result is then
+    {'status': 'invalid', 'errors': [...]} or {'status': 'skipped'}.
+    post_count and the feeds are kept current; nothing is committed.
+    """
+    parsed = [cls.parse_batch_item(item) for item in items]
+    keys = [values.get('idempotency_key') for values, _ in parsed]
+    repeated = Counter(key for key in keys if isinstance(key, str))
+    for key, (_, errors) in zip(keys, parsed):
+      if isinstance(key, str) and repeated[key] > 1:
+        errors.append('idempotency_key is repeated in the batch')
+    if any(errors for _, errors in parsed):
+      return [{'status': 'invalid', 'errors': errors} if errors else {'status': 'skipped'}
+        for _, errors in parsed]
+
+    posts = [values for values, _ in parsed]
+    results = [None] * len(posts)
+    conn = db.session.connection()
+    # Postgres skips used keys with ON CONFLICT, so they're only looked up when it reports some
+    existing = {} if conn.dialect.name == 'postgresql' else cls.find_by_keys(user_id,
+      [p['idempotency_key'] for p in posts if p['idempotency_key']])
+    new = [i for i, p in enumerate(posts) if p['idempotency_key'] not in existing]
+
+    ids = allocate_ids(conn, cls.__table__, len(new))
+    tag_ids, tags_created = resolve_tag_ids(conn, [name for i in new for name in posts[i]['tags']])
+    now = conn.execute(select(db.func.localtimestamp())).scalar()
+    rows = [{'id': post_id, 'title': p['title'], 'content': p['content'], 'excerpt': excerpt(p['content']),
+        'user_id': user_id, 'idempotency_key': p['idempotency_key'], 'created_at': p['created_at'] or now,
+        'updated_at': now}
+      for post_id, p in zip(ids, (posts[i] for i in new))]
+    inserted = cls._insert_rows(rows)
+
+    # keys used before, or by another request between our lookup and insert
+    existing.update(cls.find_by_keys(user_id, [row['idempotency_key'] for row in rows
+      if row['id'] not in inserted and row['idempotency_key']]))
+    for i, p in enumerate(posts):
+      if p['idempotency_key'] in existing:
+        results[i] = {'status': 'existing', 'id': existing[p['idempotency_key']]}
+    created = [row for row in rows if row['id'] in inserted]
+    pairs = []
+    for row, i in zip(rows, new):
+      if row['id'] in inserted:
+        results[i] = {'status': 'created', 'id': row['id']}
+        pairs.extend((row['id'], tag_id) for tag_id in sorted({tag_ids[n.lower()] for n in posts[i]['tags']}))
+    cls._insert_post_tags(pairs)
+
+    if created:
+      User.change_post_count(user_id, len(created))
+      per_tag = Counter(tag_id for _, tag_id in pairs)
+      for delta in set(per_tag.values()):
+        Tag.change_post_counts([id for id, n in per_tag.items() if n == delta], delta)
+      user = db.session.query(User.first_name, User.last_name).filter(User.id == user_id).one()
+      Feed.add_posts(user_id, [SummaryRow(row['id'], row['title'], row['excerpt'], row['created_at'],
+        user_id, user.first_name, user.last_name) for row in created], pairs)
+    if tags_created:
+      Tag.bump_version()
+    return results
+
+  @classmethod
+  def find_by_keys(cls, user_id, keys):
+    """Get {idempotency_key: post id} for the keys a user has already used"""
+    if not keys:
+      return {}
+    return dict(db.session.query(cls.idempotency_key, cls.id)
+      .filter(cls.user_id == user_id, cls.idempotency_key.in_(set(keys))))
+
+  @classmethod
+  def _insert_rows(cls, rows):
+    """Insert post rows with explicit ids; returns the set of ids inserted.
+
+    On Postgres this is one multi-row INSERT ... SELECT FROM unnest(arrays)
+    ON CONFLICT DO NOTHING RETURNING id, so rows whose idempotency key was
+    taken meanwhile are skipped; elsewhere such a row fails the transaction.
+    """
+    if not rows:
+      return set()
+    if db.session.connection().dialect.name != 'postgresql':
+      db.session.execute(cls.__table__.insert(), rows)
+      return {row['id'] for row in rows}
+
+    # one array per column keeps the statement's size and parse time flat however many rows there are
+    returned = db.session.execute(text(
+      "INSERT INTO posts (id, title, content, excerpt, user_id, idempotency_key, created_at, updated_at) "
+      "SELECT id, title, content, excerpt, :user_id, key, created_at, :updated_at FROM unnest("
+      "CAST(:ids AS INTEGER[]), CAST(:titles AS TEXT[]), CAST(:contents AS TEXT[]), "
+      "CAST(:excerpts AS TEXT[]), CAST(:keys AS TEXT[]), CAST(:created AS TIMESTAMP[])) "
+      "AS batch (id, title, content, excerpt, key, created_at) "
+      "ON CONFLICT (user_id, idempotency_key) DO NOTHING RETURNING id"), {
+        'user_id': rows[0]['user_id'], 'updated_at': rows[0]['updated_at'],
+        'ids': [row['id'] for row in rows], 'titles': [row['title'] for row in rows],
+        'contents': [row['content'] for row in rows], 'excerpts': [row['excerpt'] for row in rows],
+        'keys': [row['idempotency_key'] for row in rows], 'created': [row['created_at'] for row in rows]})
+    return {id for (id,) in returned}
+
+  @staticmethod
+  def _insert_post_tags(pairs):
+    """Insert (post_id, tag_id) pairs: one INSERT from two arrays on Postgres"""
+    if not pairs:
+      return
+    if db.session.connection().dialect.name != 'postgresql':
+      db.session.execute(PostTag.__table__.insert(), [{'post_id': p, 'tag_id': t} for p, t in pairs])
+      return
+    db.session.execute(text("INSERT INTO post_tags (post_id, tag_id) "
+      "SELECT * FROM unnest(CAST(:post_ids AS INTEGER[]), CAST(:tag_ids AS INTEGER[]))"),
+      {'post_ids': [p for p, _ in pairs], 'tag_ids': [t for _, t in pairs]})
+
+  @classmethod
+  def stream_titles(cls, user_id, batch_size=500):
+    """Get a user's posts as (id, title) rows, newest first, fetched batch_size at a time
+    from a server-side cursor as they are iterated"""
+    return (db.session.query(cls.id, cls.title).filter(cls.user_id == user_id)
+      .order_by(cls.created_at.desc()).yield_per(batch_size))
+
+  @classmethod
+  def get_page(cls, after=None, before=None, columns=None, user_id=None):
+    """Get a page of posts (optionally one user's), newest first, ordered by (created_at, id)"""
+    keys = (cls.created_at, cls.id)
+    query = select_columns(cls, columns, keys)
+    if user_id is not None:
+      query = query.filter(cls.user_id == user_id)
+    return paginate(query, keys, after, before, descending=True)
+
+  @classmethod
+  def get_page_for_tag(cls, tag_id, after=None, before=None, columns=None):
+    """Get a page of a tag's posts, newest first, ordered by (created_at, id)"""
+    keys = (cls.created_at, cls.id)
+    query = (select_columns(cls, columns, keys).join(PostTag, PostTag.post_id == cls.id)
+      .filter(PostTag.tag_id == tag_id))
+    return paginate(query, keys, after, before, descending=True)
 
 class Tag(db.Model):
   """Creates tag model"""
 
   __tablename__ = "tags"
+  query_class = CachedQuery
 
   def __repr__(self):
     u = self
     return f"<Tag id={u.id} name={u.name}>"
 
   id = db.Column(db.Integer, primary_key = True, autoincrement = True)
-  name = db.Column(db.String(50), nullable = False)
+  name = db.Column(db.String(TAG_NAME_LENGTH), nullable = False)
+  # Also moved by every post_count change and by touch(), so it versions the tag page
+  updated_at = db.Column(db.DateTime, default = db.func.now(), server_default = db.func.now(),
+    onupdate = db.func.now())
+  post_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0')
 
-  post_tags = db.relationship('PostTag',cascade = "all,delete", backref = 'tags')
-  posts = db.relationship('Post',secondary='post_tags',backref='tags')
+  post_tags = db.relationship('PostTag',cascade = "all,delete", backref = 'tags', passive_deletes = True)
+  posts = db.relationship('Post',secondary='post_tags',backref=db.backref('tags', passive_deletes = True),
+    passive_deletes = True)
+
+  @classmethod
+  def page_keys(cls, sort=None):
+    """Get the keyset columns and direction for a tags listing: by name, or most posts first"""
+    if sort == 'popular':
+      return (cls.post_count, cls.id), True
+    return (cls.name, cls.id), False
+
+  @classmethod
+  def get_page(cls, after=None, before=None, columns=None, sort=None):
+    """Get a page of tags in page_keys(sort) order, as rows if columns are given"""
+    keys, descending = cls.page_keys(sort)
+    return paginate(select_columns(cls, columns, keys), keys, after, before, descending=descending)
+
+  @classmethod
+  def change_post_counts(cls, tag_ids, delta):
+    """Add delta to the post_count of each tag in tag_ids, in the current transaction"""
+    if tag_ids:
+      cls.query.filter(cls.id.in_(tag_ids)).update(
+        {cls.post_count: cls.post_count + delta}, synchronize_session = False)
+
+  @classmethod
+  def subtract_user_posts(cls, user_id):
+    """Take a user's posts out of their tags' post_count, before the user is deleted"""
+    cls.subtract_posts(Post.user_id == user_id)
+
+  @classmethod
+  def subtract_posts(cls, condition):
+    """Take the posts matching condition out of their tags' post_count, before they are deleted"""
+    tag_ids = (db.session.query(PostTag.tag_id).join(Post, Post.id == PostTag.post_id)
+      .filter(condition))
+    per_tag = (db.session.query(db.func.count()).select_from(PostTag)
+      .join(Post, Post.id == PostTag.post_id)
+      .filter(condition, PostTag.tag_id == cls.id)
+      .scalar_subquery())
+    cls.query.filter(cls.id.in_(tag_ids.subquery())).update(
+      {cls.post_count: cls.post_count - per_tag}, synchronize_session = False)
+
+  @classmethod
+  def touch(cls, tag_ids):
+    """Move the updated_at of each tag in tag_ids (a list or a select) in the current transaction"""
+    cls.query.filter(cls.id.in_(tag_ids)).update({cls.updated_at: db.func.now()}, synchronize_session = False)
+
+  @classmethod
+  def get_version(cls, tag_id):
+    """Get what the tag page depends on: (updated_at,), which tagging, untagging or retitling a post moves"""
+    return db.session.query(cls.updated_at).filter(cls.id == tag_id).first()
+
+  @classmethod
+  def get_list_version(cls):
+    """Get what the tags listing depends on: (newest change, tag count)"""
+    return db.session.query(db.func.max(cls.updated_at), db.func.count(cls.id)).one()
+
+  # (version, tags) snapshot shared by every request in this process
+  _all_tags = (None, ())
 
   @classmethod
   def get_all_tags(cls):
-    """Gets all tags"""
-    return cls.query.all()
+    """Gets all tags as an immutable tuple of (id, name) rows.
+
+    The snapshot is rebuilt only when the shared 'tags' version changes, so
+    every worker process sees add/edit/delete from any other.
+    """
+    version = CacheVersion.get('tags')
+    cached_version, tags = cls._all_tags
+    if cached_version != version:
+      tags = tuple(TagRow(*row) for row in db.session.query(cls.id, cls.name).order_by(cls.name, cls.id))
+      cls._all_tags = (version, tags)
+    return tags
+
+  @classmethod
+  def bump_version(cls):
+    """Invalidate every process's get_all_tags snapshot; commit with the tag change"""
+    CacheVersion.bump('tags')
 
 class PostTag(db.Model):
   """Creates model to identify tag to each post"""
@@ -82,5 +501,346 @@ class PostTag(db.Model):
     u = self
     return f"<PostTag post_id={u.post_id} tag_id={u.tag_id}>"
 
-  post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key = True)
-  tag_id = db.Column(db.Integer, db.ForeignKey('tags.id'), primary_key = True)
+  post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete = 'CASCADE'), primary_key = True)
+  tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete = 'CASCADE'), primary_key = True)
+
+
+TagRow = namedtuple('TagRow', ['id', 'name'])
+SummaryRow = namedtuple('SummaryRow', ['id', 'title', 'excerpt', 'created_at', 'user_id', 'first_name',
+  'last_name'])
+
+class CacheVersion(db.Model):
+  """Creates counters that tell worker processes when a cached snapshot is stale"""
+
+  __tablename__ = "cache_versions"
+
+  def __repr__(self):
+    u = self
+    return f"<CacheVersion name={u.name} version={u.version}>"
+
+  name = db.Column(db.String(50), primary_key = True)
+  version = db.Column(db.Integer, nullable = False, default = 0)
+
+  @classmethod
+  def get(cls, name):
+    """Get the current version of a cached snapshot"""
+    return db.session.query(cls.version).filter_by(name = name).scalar() or 0
+
+  @classmethod
+  def bump(cls, name):
+    """Increment a version in the current transaction; its row is created with the table"""
+    cls.query.filter_by(name = name).update(
+      {cls.version: cls.version + 1}, synchronize_session = False)
+
+
+class Feed(db.Model):
+  """Creates precomputed feeds: the newest post summaries for the home page, a user or a tag.
+
+  Feeds are named 'home', 'user:<id>' and 'tag:<id>'. Each row holds up to
+  FEED_SIZE summaries (id, title, excerpt, created_at, user_id, author,
+  tag_ids), newest first, so a page reads its feed with one key lookup.
+  Post handlers keep them current with update_post(); a feed that was never
+  stored is built from the posts table instead.
+  """
+
+  __tablename__ = "feeds"
+
+  def __repr__(self):
+    u = self
+    return f"<Feed name={u.name} entries={len(u.entries)}>"
+
+  name = db.Column(db.String(50), primary_key = True)
+  entries = db.Column(db.JSON, nullable = False)
+  updated_at = db.Column(db.DateTime, default = db.func.now(), server_default = db.func.now(),
+    onupdate = db.func.now())
+
+  @staticmethod
+  def size():
+    """Get how many summaries a feed keeps"""
+    return db.get_app().config["FEED_SIZE"]
+
+  @staticmethod
+  def names_for(user_id, tag_ids=()):
+    """Get the names of the feeds a post by user_id with tag_ids appears in"""
+    return ['home', f'user:{user_id}', *(f'tag:{id}' for id in sorted(set(tag_ids)))]
+
+  @staticmethod
+  def select_posts(name, columns, limit):
+    """Get the statement for columns of a feed's newest posts, joined to their authors.
+
+    name can also be 'post:<id>' to select one post.
+    """
+    statement = select(*columns).select_from(Post).join(User, User.id == Post.user_id)
+    kind, _, id = name.partition(':')
+    if kind == 'user':
+      statement = statement.filter(Post.user_id == int(id))
+    elif kind == 'tag':
+      statement = (statement.join(PostTag, PostTag.post_id == Post.id)
+        .filter(PostTag.tag_id == int(id)))
+    elif kind == 'post':
+      statement = statement.filter(Post.id == int(id))
+    return statement.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit)
+
+  @classmethod
+  def select_summaries(cls, name, limit):
+    """Get the statement for a feed's newest posts as summary rows"""
+    return cls.select_posts(name, (Post.id, Post.title, Post.excerpt, Post.created_at,
+      Post.updated_at, Post.user_id, User.first_name, User.last_name), limit)
+
+  @staticmethod
+  def select_tag_ids(post_ids):
+    """Get the statement for the (post_id, tag_id) pairs of post_ids"""
+    return select(PostTag.post_id, PostTag.tag_id).filter(PostTag.post_id.in_(post_ids))
+
+  @staticmethod
+  def select_tag_names(entries):
+    """Get the statement for the (id, name) of every tag the entries mention"""
+    return select(Tag.id, Tag.name).filter(Tag.id.in_({id for e in entries for id in e['tag_ids']}))
+
+  @staticmethod
+  def summarize(rows, tag_pairs):
+    """Turn summary rows and their (post_id, tag_id) pairs into stored entries"""
+    tag_ids = {}
+    for post_id, tag_id in tag_pairs:
+      tag_ids.setdefault(post_id, []).append(tag_id)
+    return [{
+      'id': row.id,
+      'title': row.title,
+      'excerpt': row.excerpt,
+      'created_at': row.created_at.isoformat() if row.created_at else None,
+      'user_id': row.user_id,
+      'author': f"{row.first_name} {row.last_name}",
+      'tag_ids': sorted(tag_ids.get(row.id, ())),
+    } for row in rows]
+
+  @staticmethod
+  def decode(entries, tag_names):
+    """Turn stored entries into what templates render: created_at as a datetime, tags by name"""
+    names = dict(tag_names)
+    return [dict(e,
+        created_at = datetime.fromisoformat(e['created_at']) if e['created_at'] else None,
+        tags = sorted(names[id] for id in e['tag_ids'] if id in names))
+      for e in entries]
+
+  @classmethod
+  def build(cls, name, limit=None):
+    """Get a feed's entries straight from the posts table"""
+    rows = db.session.execute(cls.select_summaries(name, limit or cls.size())).all()
+    pairs = db.session.execute(cls.select_tag_ids([row.id for row in rows])).all() if rows else []
+    return cls.summarize(rows, pairs)
+
+  @classmethod
+  def get_entries(cls, name):
+    """Get a feed's summaries, newest first, with one key lookup plus one for tag names"""
+    entries = db.session.query(cls.entries).filter_by(name = name).scalar()
+    if entries is None:
+      entries = cls.build(name)
+    tag_names = db.session.execute(cls.select_tag_names(entries)).all() if entries else []
+    return cls.decode(entries[:cls.size()], tag_names)
+
+  @classmethod
+  def update_post(cls, post_id, user_id, old_tag_ids=()):
+    """Bring every feed the post is or was in up to date, after it was created, edited or deleted.
+
+    old_tag_ids are the tags the post just lost. Feeds that were never
+    stored are built. Nothing is committed.
+    """
+    summaries = cls.build(f'post:{post_id}', 1)
+    tag_ids = set(old_tag_ids) | {id for e in summaries for id in e['tag_ids']}
+    wanted = {name: summaries for name in cls.names_for(user_id, summaries[0]['tag_ids'])} if summaries else {}
+
+    cls._apply(cls.names_for(user_id, tag_ids),
+      lambda name, entries: [e for e in entries if e['id'] != post_id] + wanted.get(name, []),
+      create = True)
+
+  @classmethod
+  def add_posts(cls, user_id, rows, tag_pairs):
+    """Put a user's newly created posts into their feeds: summary rows and (post_id, tag_id) pairs.
+
+    Only the newest FEED_SIZE of them can enter any one feed, so only those
+    are summarized. Feeds that were never stored are built. Nothing is
+    committed.
+    """
+    size = cls.size()
+    tag_ids = {}
+    for post_id, tag_id in tag_pairs:
+      tag_ids.setdefault(post_id, []).append(tag_id)
+    newest = {}
+    for row in sorted(rows, key = lambda row: (row.created_at, row.id), reverse = True):
+      names = [name for name in cls.names_for(user_id, tag_ids.get(row.id, ()))
+        if len(newest.setdefault(name, [])) < size]
+      if names:
+        entry, = cls.summarize([row], [(row.id, id) for id in tag_ids.get(row.id, ())])
+        for name in names:
+          newest[name].append(entry)
+    cls._apply(sorted(newest), lambda name, entries: entries + newest[name], create = True)
+
+  @classmethod
+  def names_for_user(cls, user_id):
+    """Get the names of the feeds a user's posts can appear in"""
+    tag_ids = (db.session.query(PostTag.tag_id).join(Post, Post.id == PostTag.post_id)
+      .filter(Post.user_id == user_id).distinct())
+    return cls.names_for(user_id, [id for (id,) in tag_ids])
+
+  @classmethod
+  def rename_author(cls, user):
+    """Show a user's new name in the stored feeds their posts are in"""
+    author = user.get_full_name()
+    cls._apply(cls.names_for_user(user.id),
+      lambda name, entries: [dict(e, author = author) if e['user_id'] == user.id else e for e in entries])
+
+  @classmethod
+  def remove_user(cls, user_id, names):
+    """Take a deleted user's posts out of the stored feeds in names (from names_for_user)"""
+    cls.query.filter_by(name = f'user:{user_id}').delete(synchronize_session = False)
+    cls._apply([name for name in names if name != f'user:{user_id}'],
+      lambda name, entries: [e for e in entries if e['user_id'] != user_id])
+
+  @classmethod
+  def rebuild(cls):
+    """Rebuild the home feed and every stored feed from the posts table; returns how many"""
+    names = {'home'} | {name for (name,) in db.session.query(cls.name)}
+    cls._apply(sorted(names), None, create = True)
+    return len(names)
+
+  @classmethod
+  def _apply(cls, names, change, create=False):
+    """Replace each named feed's entries with change(name, entries), under a row lock.
+
+    A feed that was full but shrank is rebuilt, since older posts move up
+    into it; change=None rebuilds every feed. Missing feeds are built only
+    if create is set.
+    """
+    size = cls.size()
+    stored = {feed.name: feed for feed in cls.query.filter(cls.name.in_(names)).with_for_update()}
+    for name in names:
+      feed = stored.get(name)
+      if feed is None and create:
+        feed = cls._create(name, size)
+      if feed is None or change is None:
+        if feed is not None:
+          feed.entries = cls.build(name, size)
+        continue
+
+      entries = sorted(change(name, feed.entries), key = lambda e: (e['created_at'] or '', e['id']),
+        reverse = True)
+      if len(feed.entries) >= size > len(entries):
+        entries = cls.build(name, size)
+      feed.entries = entries[:size]
+
+  @classmethod
+  def _create(cls, name, size):
+    """Store a newly built feed, or lock the one another transaction stored first"""
+    try:
+      with db.session.begin_nested():
+        db.session.add(cls(name = name, entries = cls.build(name, size)))
+      return None
+    except IntegrityError:
+      return cls.query.filter_by(name = name).with_for_update().one()
+
+
+class DeletionJob(db.Model):
+  """Creates queued deletions of users and tags with too many posts to delete within a request"""
+
+  __tablename__ = "deletion_jobs"
+
+  def __repr__(self):
+    u = self
+    return f"<DeletionJob id={u.id} kind={u.kind} target_id={u.target_id} status={u.status}>"
+
+  id = db.Column(db.Integer, primary_key = True, autoincrement = True)
+  kind = db.Column(db.String(10), nullable = False)
+  target_id = db.Column(db.Integer, nullable = False)
+  status = db.Column(db.String(10), nullable = False, default = 'pending', server_default = 'pending')
+  total = db.Column(db.Integer, nullable = False, default = 0)
+  deleted = db.Column(db.Integer, nullable = False, default = 0)
+  feeds = db.Column(db.JSON)
+  error = db.Column(db.Text)
+  created_at = db.Column(db.DateTime, server_default = db.func.now())
+  updated_at = db.Column(db.DateTime, default = db.func.now(), server_default = db.func.now(),
+    onupdate = db.func.now())
+
+  @classmethod
+  def find_unfinished(cls, kind, target_id):
+    """Get the pending or running job for a user or tag, if there is one"""
+    return (cls.query.filter_by(kind = kind, target_id = target_id)
+      .filter(cls.status.in_(('pending', 'running'))).first())
+
+
+# Secondary indexes for the hot lookup paths, kept in step with migrations.py
+db.Index('ix_post_tags_tag_id_post_id', PostTag.tag_id, PostTag.post_id)
+db.Index('ix_posts_created_at_id', Post.created_at.desc(), Post.id)
+db.Index('ix_posts_user_id_created_at', Post.user_id, Post.created_at)
+db.Index('uq_posts_user_id_idempotency_key', Post.user_id, Post.idempotency_key, unique = True)
+db.Index('uq_tags_name_lower', db.func.lower(Tag.name), unique = True)
+db.Index('ix_users_last_name_first_name_id', User.last_name, User.first_name, User.id)
+db.Index('ix_users_post_count_id', User.post_count, User.id)
+db.Index('ix_tags_post_count_id', Tag.post_count, Tag.id)
+
+# Full-text search vector on Postgres; search.py falls back to an in-process index elsewhere
+SEARCH_VECTOR_DDL = (
+  "ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+  "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+  "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED",
+  "CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)")
+
+for statement in SEARCH_VECTOR_DDL:
+  event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect = 'postgresql'))
+
+# The versions CacheVersion.bump() increments; migrations 4 and 12 add them to existing databases
+CACHE_VERSION_NAMES = ('tags', 'identity')
+
+event.listen(CacheVersion.__table__, 'after_create', DDL(
+  "INSERT INTO cache_versions (name, version) VALUES " +
+  ", ".join(f"('{name}', 0)" for name in CACHE_VERSION_NAMES)))
+
+def recount_post_counts():
+  """Recompute users.post_count and tags.post_count with one set-based UPDATE each.
+
+  Only rows whose stored count is wrong are written. Returns how many had
+  drifted, as {'users': n, 'tags': n}; nothing is committed.
+  """
+  actual = {
+    User: db.session.query(db.func.count(Post.id)).filter(Post.user_id == User.id).scalar_subquery(),
+    Tag: db.session.query(db.func.count(PostTag.post_id)).filter(PostTag.tag_id == Tag.id)
+      .scalar_subquery(),
+  }
+  return {model.__tablename__: model.query.filter(model.post_count != count).update(
+      {model.post_count: count}, synchronize_session = False)
+    for model, count in actual.items()}
+
+def allocate_ids(conn, table, count):
+  """Reserve count primary keys for rows inserted with explicit ids"""
+  if not count:
+    return []
+  if conn.dialect.name == 'postgresql':
+    rows = conn.execute(
+      text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :n)"),
+      {'table': table.name, 'n': count})
+    return [row[0] for row in rows]
+  start = (conn.execute(select(db.func.max(table.c.id))).scalar() or 0) + 1
+  return list(range(start, start + count))
+
+def resolve_tag_ids(conn, names):
+  """Map tag names (case-insensitively) to ids, creating missing tags in bulk.
+
+  Returns ({lowercased name: id}, whether any tag was created).
+  """
+  wanted = {}
+  for name in names:
+    if name and name.strip():
+      wanted.setdefault(name.strip().lower(), name.strip())
+  if not wanted:
+    return {}, False
+
+  tags = Tag.__table__
+  lookup = (select(db.func.lower(tags.c.name), tags.c.id)
+    .where(db.func.lower(tags.c.name).in_(bindparam('names', expanding = True))))
+  found = dict(conn.execute(lookup, {'names': list(wanted)}).all())
+
+  missing = [{'name': wanted[key]} for key in wanted if key not in found]
+  if missing:
+    dialect = postgresql if conn.dialect.name == 'postgresql' else sqlite
+    conn.execute(dialect.insert(tags).on_conflict_do_nothing(), missing)
+    found.update(conn.execute(lookup, {'names': [m['name'].lower() for m in missing]}).all())
+  return found, bool(missing)
@@ -0,0 +1,296 @@
+"""Rendered-page cache for Blogly's read routes.
+
+Views decorated with @cached_page keep their rendered HTML in a backend with
+LRU + TTL eviction; @cached_stream does the same for views that stream their
+body in chunks. Any commit that touched users, posts, tags or post_tags
+clears the cache, so a page is never served stale after an edit.
+
+With a read replica, a client that just wrote skips the cache while its
+reads stick to the primary, and pages read from the replica in the
+REPLICA_STICKY_SECONDS after a clear are not stored, since the replica may
+not have the write yet.
+
+Backends:
+  MemoryBackend - per-process dict; use with a single worker process
+  SharedBackend - SQLite file shared by all worker processes on the host
+"""
+
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from replicas import reading_replica, sticky_to_primary
+
+# A shared page's last use is recorded at most this often, so hits don't take the write lock
+TOUCH_INTERVAL = 60
+
+
+class MemoryBackend:
+    """In-process LRU dict with per-entry expiry"""
+
+    def __init__(self, max_entries=1024, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._cleared_at = None
+
+    def generation(self):
+        return self._generation
+
+    def cleared_within(self, seconds):
+        cleared_at = self._cleared_at
+        return cleared_at is not None and self.clock() - cleared_at < seconds
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._cleared_at = self.clock()
+
+
+class SharedBackend:
+    """Approximate LRU + TTL store in a local SQLite file, shared across worker processes"""
+
+    def __init__(self, path, max_entries=1024, clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.clock = clock
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, last_used REAL NOT NULL)")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS generation (n INTEGER NOT NULL, cleared_at REAL)")
+        if "cleared_at" not in {row[1] for row in self._conn().execute("PRAGMA table_info(generation)")}:
+            self._conn().execute("ALTER TABLE generation ADD COLUMN cleared_at REAL")
+        self._conn().execute(
+            "INSERT INTO generation SELECT 0, NULL WHERE NOT EXISTS (SELECT 1 FROM generation)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn, now = self._conn(), self.clock()
+        row = conn.execute("SELECT value, expires_at, last_used FROM pages WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at, last_used = row
+        if expires_at <= now:
+            conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            return None
+        if now - last_used > TOUCH_INTERVAL:
+            conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (now, key))
+        return value
+
+    def set(self, key, value, ttl):
+        conn, now = self._conn(), self.clock()
+        conn.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (key, value, now + ttl, now))
+        conn.execute(
+            "DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY last_used DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def generation(self):
+        return self._conn().execute("SELECT n FROM generation").fetchone()[0]
+
+    def cleared_within(self, seconds):
+        cleared_at = self._conn().execute("SELECT cleared_at FROM generation").fetchone()[0]
+        return cleared_at is not None and self.clock() - cleared_at < seconds
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM pages")
+        conn.execute("UPDATE generation SET n = n + 1, cleared_at = ?", (self.clock(),))
+        conn.execute("COMMIT")
+
+
+class PageCache:
+    """Caches rendered pages by request path and clears them on relevant commits"""
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def generation(self):
+        """Changes whenever the cache is cleared"""
+        return self.backend.generation()
+
+    def cleared_within(self, seconds):
+        """Whether the cache was cleared less than seconds ago"""
+        return self.backend.cleared_within(seconds)
+
+    def set(self, key, value, generation):
+        """Stores a page unless the cache was cleared while it was being rendered"""
+        if self.backend.generation() == generation:
+            self.backend.set(key, value, self.ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def init_page_cache(app):
+    """Creates the configured page cache and hooks its invalidation into the ORM"""
+
+    kind = app.config.get("PAGE_CACHE_BACKEND", "memory")
+    size = app.config.get("PAGE_CACHE_SIZE", 1024)
+
+    if not kind:
+        return None
+    if kind == "shared":
+        backend = SharedBackend(app.config.get("PAGE_CACHE_PATH", "/tmp/blogly-pages.sqlite"), size)
+    else:
+        backend = MemoryBackend(size)
+
+    cache = PageCache(backend, app.config.get("PAGE_CACHE_TTL", 300))
+    app.extensions["page_cache"] = cache
+    _listen_for_writes(cache)
+    return cache
+
+
+# Every page cache in the process; the ORM listeners are registered once and clear them all
+_caches = weakref.WeakSet()
+
+
+def _listen_for_writes(cache):
+    listening = bool(_caches)
+    _caches.add(cache)
+    if listening:
+        return
+
+    from models import User, Post, Tag, PostTag
+
+    watched = (User, Post, Tag, PostTag)
+
+    @event.listens_for(Session, "after_flush")
+    def mark_flushed(session, flush_context):
+        changed = list(session.new) + list(session.dirty) + list(session.deleted)
+        if any(isinstance(obj, watched) for obj in changed):
+            session.info["pages_stale"] = True
+
+    @event.listens_for(Session, "do_orm_execute")
+    def mark_bulk_write(orm_execute_state):
+        # bulk Query.update()/delete() and Core inserts bypass the flush
+        if not orm_execute_state.is_select:
+            orm_execute_state.session.info["pages_stale"] = True
+
+    @event.listens_for(Session, "after_commit")
+    def clear_on_commit(session):
+        if session.info.pop("pages_stale", False):
+            for each in list(_caches):
+                each.clear()
+
+    @event.listens_for(Session, "after_soft_rollback")
+    def forget_on_rollback(session, previous_transaction):
+        session.info.pop("pages_stale", None)
+
+
+def cached_page(view):
+    """Serves a GET view's rendered HTML from the page cache when present"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get("page_cache")
+        if cache is None or request.method != "GET":
+            return view(*args, **kwargs)
+
+        key = request.full_path
+        page = None if sticky_to_primary() else cache.get(key)
+        if page is None:
+            generation = cache.generation()
+            storable = _may_store(cache)
+            page = view(*args, **kwargs)
+            if storable and isinstance(page, str):
+                cache.set(key, page, generation)
+        return page
+
+    return wrapper
+
+
+def cached_stream(mimetype):
+    """Like cached_page, for GET views that return a generator of text chunks.
+
+    A miss streams the chunks to the client as they are produced and stores
+    the whole body once the last one has been sent, unless it grew past
+    PAGE_CACHE_MAX_BODY characters; a hit sends the stored body.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions.get("page_cache")
+            key = request.full_path
+            body = cache.get(key) if cache is not None and not sticky_to_primary() else None
+            if body is not None:
+                return Response(body, mimetype=mimetype)
+
+            storable = cache is not None and _may_store(cache)
+            # read before the view runs: it may query before returning its generator
+            generation = cache.generation() if storable else None
+            chunks = view(*args, **kwargs)
+            if storable:
+                limit = current_app.config.get("PAGE_CACHE_MAX_BODY", 1 << 20)
+                chunks = _store_when_sent(cache, key, chunks, generation, limit)
+            return Response(stream_with_context(chunks), mimetype=mimetype)
+
+        return wrapper
+
+    return decorator
+
+
+def _may_store(cache):
+    # a replica may not have the write that cleared the cache yet, and its page would outlive the lag
+    sticky_seconds = current_app.config.get("REPLICA_STICKY_SECONDS", 5)
+    return not (reading_replica() and cache.cleared_within(sticky_seconds))
+
+
+def _store_when_sent(cache, key, chunks, generation, limit):
+    body, size = [], 0
+    for chunk in chunks:
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                # too big to keep; stop copying so the stream stays flat in memory
+                body = None
+        yield chunk
+    # not reached if the client disconnects mid-stream, so partial bodies are never cached
+    if body is not None:
+        cache.set(key, "".join(body), generation)
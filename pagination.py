@@ -0,0 +1,115 @@
+"""Keyset (cursor) pagination for Blogly listings."""
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+
+PER_PAGE = 20
+
+
+class InvalidCursor(ValueError):
+    """Raised when a page cursor can't be decoded"""
+
+
+class KeysetPage:
+    """One page of a keyset-paginated listing"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Encodes a tuple of key values as an opaque, URL-safe cursor"""
+
+    values = [{"t": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor made by encode_cursor back into key values"""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        return [datetime.fromisoformat(v["t"]) if isinstance(v, dict) else v for v in values]
+    except (ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+def _fits(column, value):
+    """Whether a cursor value can be compared with column, so a cursor from another sort is rejected"""
+
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        return True
+    if isinstance(value, bool):
+        return expected is bool
+    if expected is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, expected)
+
+
+class Keyset:
+    """The cursor filter, ordering and page-building for one keyset page.
+
+    apply() works on a Query or a select(), so sync and async callers share it;
+    page() turns the up to per_page + 1 rows that came back into a KeysetPage.
+    """
+
+    def __init__(self, keys, after=None, before=None, per_page=PER_PAGE, descending=False):
+        self.keys = keys
+        self.per_page = per_page
+        self.backward = before is not None and after is None
+        self.cursor = before if self.backward else after
+        self.ascending = descending == self.backward
+
+    def apply(self, query):
+        if self.cursor is not None:
+            values = decode_cursor(self.cursor)
+            if len(values) != len(self.keys) or not all(map(_fits, self.keys, values)):
+                raise InvalidCursor(self.cursor)
+            row, bound = tuple_(*self.keys), tuple_(*values)
+            query = query.filter(row > bound if self.ascending else row < bound)
+
+        order = [col.asc() if self.ascending else col.desc() for col in self.keys]
+        return query.order_by(None).order_by(*order).limit(self.per_page + 1)
+
+    def page(self, items):
+        def key_of(item):
+            return [getattr(item, col.key) for col in self.keys]
+
+        items = list(items)
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+
+        if self.backward:
+            items.reverse()
+            prev_cursor = encode_cursor(key_of(items[0])) if has_more else None
+            next_cursor = encode_cursor(key_of(items[-1])) if items else None
+        else:
+            next_cursor = encode_cursor(key_of(items[-1])) if has_more else None
+            prev_cursor = encode_cursor(key_of(items[0])) if self.cursor and items else None
+
+        return KeysetPage(items, next_cursor, prev_cursor)
+
+
+def paginate(query, keys, after=None, before=None, per_page=PER_PAGE, descending=False):
+    """Returns a KeysetPage of query ordered by the unique key columns in keys.
+
+    Pages are found with a row-value comparison against the cursor, so page N
+    costs the same index range scan as page 1. Only one of after/before is used.
+    """
+
+    keyset = Keyset(keys, after, before, per_page, descending)
+    return keyset.page(keyset.apply(query).all())
@@ -0,0 +1,58 @@
+"""Per-route SQL statement budgets for Blogly."""
+
+from functools import wraps
+from types import GeneratorType
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a view issues more SQL statements than its budget allows"""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """Counts statements issued while a budgeted view is running"""
+
+    if has_app_context() and "query_count" in g:
+        g.query_count += 1
+
+
+def query_budget(limit):
+    """Caps the number of SQL statements a view (including its template) may issue.
+
+    For a view that returns a generator, such as stream_template(), the
+    statements issued while the body streams count too. They are checked once
+    the last chunk has been produced.
+
+    Exceeding the budget raises QueryBudgetExceeded when the app is testing or
+    QUERY_BUDGET_ENFORCE is set, otherwise it is logged as a warning.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.query_count = 0
+            result = view(*args, **kwargs)
+            if isinstance(result, GeneratorType):
+                return _check_when_streamed(view.__name__, limit, result)
+            _check(view.__name__, limit, g.pop("query_count"))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _check_when_streamed(name, limit, chunks):
+    yield from chunks
+    _check(name, limit, g.pop("query_count"))
+
+
+def _check(name, limit, count):
+    if count > limit:
+        message = f"{name} issued {count} SQL statements (budget {limit})"
+        if current_app.testing or current_app.config.get("QUERY_BUDGET_ENFORCE"):
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
@@ -0,0 +1,93 @@
+"""Read-replica routing for Blogly.
+
+When SQLALCHEMY_BINDS has a "replica" entry (set REPLICA_DATABASE_URL), the
+session sends statements issued while handling GET and HEAD requests to the
+replica and everything else, including every flush, to the primary.
+
+Reads stay on the primary for REPLICA_STICKY_SECONDS after a request that
+wrote, so the page a POST redirects to shows the write even while the
+replica lags. GET views that write must be marked with @use_primary.
+"""
+
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.orm import Session
+
+READ_METHODS = ("GET", "HEAD")
+
+
+class RoutingSession(SignallingSession):
+    """Session that binds to the replica engine while the request is reading"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if not self._flushing and has_request_context() and reading_replica():
+            return self.db.get_engine(current_app, bind="replica")
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions that route reads to a replica"""
+
+    session_class = RoutingSession
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=self.session_class, db=self, **options)
+
+
+def reading_replica():
+    """Whether this request's reads go to the replica"""
+    return g.get("db_target") == "replica"
+
+
+def sticky_to_primary():
+    """Whether this client wrote within the last REPLICA_STICKY_SECONDS"""
+    return session.get("primary_until", 0) > time.time()
+
+
+def use_primary(view):
+    """Keeps a GET view that writes (or must not see replica lag) on the primary"""
+
+    view.use_primary = True
+    return view
+
+
+def init_replicas(app):
+    """Routes reads to the "replica" bind, if the app has one"""
+
+    if "replica" not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        return False
+    sticky_seconds = app.config.get("REPLICA_STICKY_SECONDS", 5)
+
+    @app.before_request
+    def choose_database():
+        view = app.view_functions.get(request.endpoint)
+        if (request.method in READ_METHODS
+                and not getattr(view, "use_primary", False)
+                and not sticky_to_primary()):
+            g.db_target = "replica"
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.pop("db_wrote", False):
+            session["primary_until"] = time.time() + sticky_seconds
+        return response
+
+    return True
+
+
+@event.listens_for(Session, "after_flush")
+def note_flush(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def note_bulk_write(orm_execute_state):
+    if not orm_execute_state.is_select and has_request_context():
+        g.db_wrote = True
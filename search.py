@@ -0,0 +1,251 @@
+"""Full-text search over post titles and content.
+
+On Postgres, posts.search_vector is a generated tsvector column (title
+weighted A, content weighted B) with a GIN index, so it is always current
+and ranking happens in the database. Other databases (the SQLite test
+setups) use an in-process InvertedIndex that is kept current from ORM
+events.
+"""
+
+import re
+import threading
+from markupsafe import Markup, escape
+from sqlalchemy import REAL, cast, event, func, inspect, literal_column, tuple_
+from sqlalchemy.orm import Session
+from models import db, Post
+from pagination import InvalidCursor, KeysetPage, decode_cursor, encode_cursor
+
+PER_PAGE = 10
+# Matches ranked per query on Postgres; past this, the best of the N newest are shown
+RANK_CANDIDATES = 5000
+SNIPPET_OPTIONS = "StartSel=\x02, StopSel=\x03, MaxWords=30, MinWords=10, MaxFragments=2"
+TITLE_WEIGHT = 1.0
+CONTENT_WEIGHT = 0.4
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+# (suffix, replacement) tried in order by stem(); the stem must keep 3 letters
+SUFFIXES = (("ies", "y"), ("ing", ""), ("ed", ""), ("s", ""))
+
+
+class SearchHit:
+    """One ranked search result"""
+
+    def __init__(self, id, title, rank, snippet):
+        self.id = id
+        self.title = title
+        self.rank = rank
+        self.snippet = snippet
+
+
+def stem(word):
+    """Strips a plural or verb ending, so "dragons" matches "dragon" as with Postgres' english config"""
+
+    if word.endswith("ss"):
+        return word
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def tokenize(text):
+    """Lowercased, stemmed word tokens of text"""
+
+    return [stem(word) for word in TOKEN.findall((text or "").lower())]
+
+
+def highlight(snippet):
+    """Escapes a snippet and turns the \\x02/\\x03 match markers into <mark> tags"""
+
+    return Markup(str(escape(snippet)).replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
+
+class InvertedIndex:
+    """Term -> {post_id: weighted frequency} index for databases without tsvector"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._docs = {}
+        self.built = False
+
+    def build(self, rows):
+        """Replaces the index with (id, title, content) rows"""
+
+        with self._lock:
+            self._postings, self._docs = {}, {}
+            for id, title, content in rows:
+                self._add(id, title, content)
+            self.built = True
+
+    def update(self, id, title, content):
+        with self._lock:
+            self._remove(id)
+            self._add(id, title, content)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _add(self, id, title, content):
+        terms = self._docs[id] = {}
+        for weight, text in ((TITLE_WEIGHT, title), (CONTENT_WEIGHT, content)):
+            for term in tokenize(text):
+                terms[term] = terms.get(term, 0) + weight
+        for term, score in terms.items():
+            self._postings.setdefault(term, {})[id] = score
+
+    def _remove(self, id):
+        for term in self._docs.pop(id, {}):
+            postings = self._postings.get(term)
+            postings.pop(id, None)
+            if not postings:
+                del self._postings[term]
+
+    def search(self, terms):
+        """Returns [(score, id)] of posts containing every term, best first"""
+
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in set(terms)]
+        if not postings or not all(postings):
+            return []
+        postings.sort(key=len)
+        ids = set(postings[0]).intersection(*postings[1:])
+        return sorted(((sum(p[id] for p in postings), id) for id in ids), reverse=True)
+
+
+fallback_index = InvertedIndex()
+
+
+@event.listens_for(Session, "after_flush")
+def collect_post_changes(session, flush_context):
+    if not fallback_index.built:
+        return
+    changes = session.info.setdefault("search_changes", {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Post) and (obj in session.new or _text_changed(obj)):
+            changes[obj.id] = (obj.title, obj.content)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes[obj.id] = None
+
+
+def _text_changed(post):
+    # a post dirtied only by its tags or updated_at keeps its entry, and deferred content stays unloaded
+    attrs = inspect(post).attrs
+    return attrs.title.history.has_changes() or attrs.content.history.has_changes()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def collect_bulk_post_changes(orm_execute_state):
+    # Query.update()/delete() and Core inserts (Post.create_batch) on posts can't be applied row by row
+    if fallback_index.built and not orm_execute_state.is_select:
+        if (any(m.class_ is Post for m in orm_execute_state.all_mappers)
+                or getattr(orm_execute_state.statement, "table", None) is Post.__table__):
+            orm_execute_state.session.info["search_rebuild"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def apply_post_changes(session):
+    changes = session.info.pop("search_changes", {})
+    if session.info.pop("search_rebuild", False):
+        fallback_index.built = False
+        return
+    for id, doc in changes.items():
+        if doc is None:
+            fallback_index.remove(id)
+        else:
+            fallback_index.update(id, *doc)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_post_changes(session, previous_transaction):
+    session.info.pop("search_changes", None)
+    session.info.pop("search_rebuild", None)
+
+
+def search_posts(q, after=None, per_page=PER_PAGE):
+    """Returns a KeysetPage of SearchHits for q, ranked best first"""
+
+    if not tokenize(q):
+        return KeysetPage([])
+    if db.session().get_bind().dialect.name == "postgresql":
+        return _search_postgres(q, after, per_page)
+    return _search_fallback(q, after, per_page)
+
+
+def _decode_rank_cursor(cursor):
+    """The (rank, id) a search cursor holds, or InvalidCursor if it holds anything else"""
+
+    values = decode_cursor(cursor)
+    if (len(values) != 2 or isinstance(values[0], bool) or not isinstance(values[0], (int, float))
+            or isinstance(values[1], bool) or not isinstance(values[1], int)):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def _search_postgres(q, after, per_page):
+    tsquery = func.websearch_to_tsquery("english", q)
+    vector = literal_column("posts.search_vector")
+
+    # Rank a bounded candidate set so very common terms cost the same as rare ones; newest
+    # first, so the set is the same on every page and the cursor neither repeats nor skips rows
+    candidates = (db.session.query(Post.id.label("id"), vector.label("vector"))
+                  .filter(vector.op("@@")(tsquery))
+                  .order_by(Post.id.desc())
+                  .limit(RANK_CANDIDATES)
+                  .subquery())
+    rank = func.ts_rank_cd(candidates.c.vector, tsquery)
+
+    top = db.session.query(candidates.c.id, rank.label("rank"))
+    if after is not None:
+        values = _decode_rank_cursor(after)
+        # ts_rank_cd returns real; compare as real so the cursor row matches itself
+        top = top.filter(tuple_(rank, candidates.c.id) < tuple_(cast(values[0], REAL), values[1]))
+    top = top.order_by(rank.desc(), candidates.c.id.desc()).limit(per_page + 1).subquery()
+
+    # Headlines are only generated for the rows on this page
+    snippet = func.ts_headline("english", Post.content, tsquery, SNIPPET_OPTIONS)
+    rows = (db.session.query(Post.id, Post.title, top.c.rank, snippet.label("snippet"))
+            .join(top, top.c.id == Post.id)
+            .order_by(top.c.rank.desc(), Post.id.desc())
+            .all())
+
+    hits = [SearchHit(r.id, r.title, r.rank, highlight(r.snippet)) for r in rows[:per_page]]
+    next_cursor = encode_cursor([hits[-1].rank, hits[-1].id]) if len(rows) > per_page else None
+    return KeysetPage(hits, next_cursor)
+
+
+def _search_fallback(q, after, per_page):
+    if not fallback_index.built:
+        fallback_index.build(db.session.query(Post.id, Post.title, Post.content))
+
+    terms = tokenize(q)
+    ranked = fallback_index.search(terms)
+    if after is not None:
+        bound = tuple(_decode_rank_cursor(after))
+        ranked = [hit for hit in ranked if hit < bound]
+
+    page = ranked[:per_page]
+    rows = {}
+    if page:
+        ids = [id for score, id in page]
+        rows = {r.id: r for r in db.session.query(Post.id, Post.title, Post.content).filter(Post.id.in_(ids))}
+
+    hits = [SearchHit(id, rows[id].title, score, _snippet(rows[id].content, terms))
+            for score, id in page if id in rows]
+    next_cursor = encode_cursor(list(page[-1])) if len(ranked) > per_page else None
+    return KeysetPage(hits, next_cursor)
+
+
+def _snippet(content, terms, width=80):
+    """A window of content around the first word matching a term, with matches marked"""
+
+    content = content or ""
+    terms = set(terms)
+    starts = [m.start() for m in TOKEN.finditer(content) if stem(m.group(0).lower()) in terms]
+    start = max(starts[0] - width // 2, 0) if starts else 0
+    text = content[start:start + width]
+    marked = TOKEN.sub(lambda m: f"\x02{m.group(0)}\x03" if stem(m.group(0).lower()) in terms
+                       else m.group(0), text)
+    return highlight(("…" if start else "") + marked + ("…" if start + width < len(content) else ""))
@@ -1,11 +1,15 @@
 """Seed file to make sample data for users db."""
 
 from models import User, Post, Tag, PostTag, db
-from app import app
+from app import create_app
+import migrations
+
+app = create_app()
 
 # Create all tables
 db.drop_all()
 db.create_all()
+migrations.stamp(db.engine)
 
 # If table isn't empty, empty it
 User.query.delete()
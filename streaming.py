@@ -0,0 +1,31 @@
+"""Streamed template rendering for Blogly's large pages.
+
+stream_template() renders with Jinja's generate(), so the response starts
+as soon as the first chunk of HTML exists and the page is never held in
+memory as a whole. Paired with a query that streams rows from a server-side
+cursor (Query.yield_per), memory stays flat however long the listing is.
+Return it from a view decorated with @cached_stream, or wrap it in
+Response(stream_with_context(...)).
+"""
+
+from flask import current_app
+
+CHUNK_SIZE = 8192
+
+
+def stream_template(template_name, **context):
+    """Yields the rendered template in chunks of about CHUNK_SIZE characters"""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    chunk, size = [], 0
+    for piece in template.generate(context):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk)
@@ -0,0 +1,85 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from app import create_app
+from models import db
+import assets
+
+
+class BuildTestCase(TestCase):
+    """Tests fingerprinting and precompression"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.dir.name, "static")
+        os.makedirs(os.path.join(self.source, "css"))
+        with open(os.path.join(self.source, "css", "site.css"), "w") as f:
+            f.write("body { margin: 0; }\n" * 50)
+        self.dest = os.path.join(self.source, "dist")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_build_writes_hashed_files_and_manifest(self):
+        """Test the manifest maps names to hashed copies with a gzip variant"""
+        manifest = assets.build(self.source, self.dest)
+        hashed = manifest["css/site.css"]
+
+        self.assertRegex(hashed, r"^css/site\.[0-9a-f]{12}\.css$")
+        with open(os.path.join(self.dest, assets.MANIFEST)) as f:
+            self.assertEqual(json.load(f), manifest)
+        with open(os.path.join(self.dest, hashed + ".gz"), "rb") as f:
+            self.assertEqual(gzip.decompress(f.read()), b"body { margin: 0; }\n" * 50)
+
+        # rebuilding skips dist/ and gives the same names
+        self.assertEqual(assets.build(self.source, self.dest), manifest)
+
+
+class ServeTestCase(TestCase):
+    """Tests asset_url and the precompressed static handler"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.app = create_app("testing")
+        cls.manifest = assets.build(cls.app.static_folder, cls.dir.name)
+        cls.app = create_app("testing", ASSETS_FOLDER=cls.dir.name, COMPRESS_HTML=True, COMPRESS_MIN_SIZE=0)
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def test_serves_best_encoding_with_immutable_caching(self):
+        """Test the handler picks br, then gzip, then identity"""
+        url = self.app.extensions["assets"].url("styles.css")
+        self.assertEqual(url, f"/static/dist/{self.manifest['styles.css']}")
+
+        with self.app.test_client() as client:
+            expected = [("br", "br")] if assets.brotli else []
+            expected += [("gzip, deflate", "gzip"), ("identity", None)]
+            for accept, encoding in expected:
+                resp = client.get(url, headers={"Accept-Encoding": accept})
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers.get("Content-Encoding"), encoding)
+                self.assertIn("immutable", resp.headers["Cache-Control"])
+                self.assertEqual(resp.mimetype, "text/css")
+
+            self.assertEqual(client.get("/static/dist/styles.0000.css").status_code, 404)
+
+    def test_compresses_html(self):
+        """Test HTML pages are gzipped on the fly with a weak ETag that still revalidates"""
+        with self.app.test_client() as client:
+            resp = client.get("/users", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertIn(self.manifest["styles.css"], gzip.decompress(resp.get_data()).decode())
+            self.assertTrue(resp.headers["ETag"].startswith("W/"))
+
+            resp = client.get("/users", headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
@@ -0,0 +1,199 @@
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from app import create_app
+from models import db, User, Post
+import avatars
+
+
+def png(width, height, rgb):
+    """A small valid PNG, so the tests don't depend on Pillow to make one"""
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    rows = b"".join(b"\x00" + bytes(rgb) * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+class ImageHost(BaseHTTPRequestHandler):
+    """Stands in for a third-party image host: serves FILES and counts requests"""
+
+    FILES = {}
+    REDIRECTS = {}
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path in self.REDIRECTS:
+            self.send_response(302)
+            self.send_header("Location", self.REDIRECTS[self.path])
+            self.end_headers()
+            return
+        body = self.FILES.get(self.path)
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Type", "image/png")
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, *args):
+        pass
+
+
+app = create_app("testing")
+db.drop_all()
+db.create_all()
+
+
+class AvatarTestCase(TestCase):
+    """Tests fetching, storing and serving avatar thumbnails"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHost)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.host = f"http://127.0.0.1:{cls.server.server_port}"
+        ImageHost.FILES = {"/red.png": png(4, 4, (255, 0, 0)), "/blue.png": png(4, 4, (0, 0, 255)),
+                           "/text.png": b"not an image"}
+        ImageHost.REDIRECTS = {"/moved.png": "/red.png"}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Give each test its own avatar folder and one user"""
+        self.dir = tempfile.TemporaryDirectory()
+        # the image host is on 127.0.0.1
+        self.app = create_app("testing", AVATAR_FOLDER=self.dir.name, AVATAR_ALLOW_PRIVATE_HOSTS=True)
+        self.avatars = self.app.extensions["avatars"]
+        ImageHost.hits.clear()
+
+        Post.query.delete()
+        User.query.delete()
+        user = User(first_name="Bilbo", last_name="Baggins", image_url=f"{self.host}/red.png")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.dir.cleanup()
+
+    def test_page_shows_placeholder_until_fetched(self):
+        """Test the page never hotlinks image_url and switches to the stored thumbnail"""
+        with self.app.test_client() as client:
+            html = client.get(f"/users/{self.user_id}").get_data(as_text=True)
+            self.assertNotIn("red.png", html)
+            self.assertIn(self.avatars.placeholder_url, html)
+
+            with self.app.app_context():
+                name = self.avatars.refresh(f"{self.host}/red.png")
+            html = client.get(f"/users/{self.user_id}").get_data(as_text=True)
+
+        self.assertRegex(name, r"^[0-9a-f]{16}\.(jpg|png)$")
+        self.assertIn(f'src="/avatars/{name}"', html)
+        self.assertTrue(os.path.exists(os.path.join(self.dir.name, name)))
+
+    def test_serves_with_immutable_caching(self):
+        """Test the handler sends the stored file, revalidates and rejects unknown names"""
+        with self.app.app_context():
+            name = self.avatars.refresh(f"{self.host}/red.png")
+
+        with self.app.test_client() as client:
+            resp = client.get(f"/avatars/{name}")
+            self.assertEqual(resp.mimetype, "image/jpeg" if avatars.Image else "image/png")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(client.get(f"/avatars/{name}", headers={"If-None-Match": f'"{name}"'}).status_code, 304)
+            self.assertEqual(client.get("/avatars/0123456789abcdef.png").status_code, 404)
+            self.assertEqual(client.get("/avatars/..%2Fapp.py").status_code, 404)
+
+    def test_changed_url_is_fetched_again(self):
+        """Test an edited image_url falls back to the placeholder and gets a new file"""
+        with self.app.app_context():
+            red = self.avatars.refresh(f"{self.host}/red.png")
+            user = User.query.get(self.user_id)
+            user.image_url = f"{self.host}/blue.png"
+            db.session.commit()
+
+            self.assertEqual(self.avatars.url(user), self.avatars.placeholder_url)
+            blue = self.avatars.refresh(f"{self.host}/blue.png")
+
+        self.assertNotEqual(red, blue)
+        self.assertEqual(User.query.get(self.user_id).avatar, blue)
+
+    def test_bad_images_are_rejected(self):
+        """Test missing, non-image and non-http URLs leave the user without an avatar"""
+        with self.app.app_context():
+            for url in (f"{self.host}/missing.png", f"{self.host}/text.png", "file:///etc/passwd"):
+                with self.assertRaises(avatars.AvatarError):
+                    self.avatars.refresh(url)
+
+        self.assertIsNone(User.query.get(self.user_id).avatar)
+
+    def test_redirects_are_not_followed(self):
+        with self.app.app_context():
+            with self.assertRaises(avatars.AvatarError):
+                self.avatars.refresh(f"{self.host}/moved.png")
+
+        self.assertEqual(ImageHost.hits, ["/moved.png"])
+
+    def test_private_hosts_are_refused(self):
+        """Test loopback, private and metadata addresses aren't fetched without AVATAR_ALLOW_PRIVATE_HOSTS"""
+        public_only = create_app("testing", AVATAR_FOLDER=self.dir.name).extensions["avatars"]
+        urls = (f"{self.host}/red.png", f"http://localhost:{self.server.server_port}/red.png",
+                "http://169.254.169.254/latest/meta-data/", "http://10.0.0.1/a.png",
+                "http://[::ffff:127.0.0.1]/a.png", "http://[::1]/a.png")
+        with self.app.app_context():
+            for url in urls:
+                with self.assertRaises(avatars.AvatarError, msg=url):
+                    public_only.refresh(url)
+
+        self.assertEqual(ImageHost.hits, [])
+
+    def test_worker_fetches_each_url_once(self):
+        """Test page views queue one background fetch that fills in the avatar"""
+        self.avatars.worker = True
+        user = User.query.get(self.user_id)
+        for _ in range(3):
+            self.avatars.url(user)
+        self.avatars._queue.join()
+
+        self.assertEqual(ImageHost.hits, ["/red.png"])
+        db.session.expire_all()
+        self.assertIsNotNone(User.query.get(self.user_id).avatar)
+
+
+class AvatarStoreTestCase(TestCase):
+    """Tests the content-addressed folder and its LRU budget"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = avatars.AvatarStore(self.dir.name, budget=250)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_same_content_is_stored_once(self):
+        self.assertEqual(self.store.put(b"a" * 100, "png"), self.store.put(b"a" * 100, "png"))
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test going over budget removes the file used longest ago, not the newest"""
+        old, used = self.store.put(b"a" * 100, "png"), self.store.put(b"b" * 100, "png")
+        now = time.time()
+        os.utime(self.store.path(old), (now - 7200, now - 7200))
+        os.utime(self.store.path(used), (now - 9000, now - 9000))
+        self.assertTrue(self.store.exists(used))
+
+        new = self.store.put(b"c" * 100, "png")
+
+        self.assertEqual(sorted(os.listdir(self.dir.name)), sorted([used, new]))
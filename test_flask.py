@@ -1,16 +1,20 @@
-from unittest import TestCase
+import asyncio
+from datetime import datetime
+import os
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
-from app import app
-from models import db, User, Post, Tag
+from sqlalchemy import event, text
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_ECHO'] = False
+from app import create_app
+from asyncread import create_asgi_app
+from models import db, User, Post, Tag, PostTag, Feed, DeletionJob
+from pagination import encode_cursor
+from querybudget import QueryBudgetExceeded, query_budget
+import deletions
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+# Test database, no SQL echo, and Flask errors as real errors rather than HTML pages
+app = create_app("testing")
 
 db.drop_all()
 db.create_all()
@@ -21,6 +25,7 @@ class UserViewsTestCase(TestCase):
 
     def setUp(self):
         """Add sample user and post"""
+        Feed.query.delete()
         Post.query.delete()
         User.query.delete()
 
@@ -70,6 +75,48 @@ class UserViewsTestCase(TestCase):
             self.assertIn('Mrs. Tester\'s Bio', html)
             self.assertIn('hello', html)
 
+    def test_user_page_streams(self):
+        """Test the user page is streamed, and cached only while it is small"""
+        cache = app.extensions["page_cache"]
+        cache.clear()
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user_id}")
+
+            self.assertTrue(resp.is_streamed)
+            self.assertIn('hello', resp.get_data(as_text=True))
+            self.assertIn('hello', cache.get(f"/users/{self.user_id}?"))
+
+            cache.clear()
+            app.config["PAGE_CACHE_MAX_BODY"] = 100
+            try:
+                self.assertIn('hello', client.get(f"/users/{self.user_id}").get_data(as_text=True))
+            finally:
+                app.config["PAGE_CACHE_MAX_BODY"] = 1 << 20
+
+            self.assertIsNone(cache.get(f"/users/{self.user_id}?"))
+
+    def test_user_page_cleared_while_loading_is_not_stored(self):
+        """Test a clear between the view's first query and its body leaves the page out of the cache"""
+        cache = app.extensions["page_cache"]
+        cache.clear()
+        # the request's session, created under app, must load the user from the database
+        app.extensions["identity_cache"].clear()
+        db.session.remove()
+
+        def clear_on_user_lookup(conn, cursor, statement, *args):
+            if "users.first_name" in statement:
+                cache.clear()
+
+        with app.test_client() as client:
+            engine = db.get_engine(app)
+            event.listen(engine, "before_cursor_execute", clear_on_user_lookup)
+            try:
+                client.get(f"/users/{self.user_id}").get_data()
+            finally:
+                event.remove(engine, "before_cursor_execute", clear_on_user_lookup)
+
+        self.assertIsNone(cache.get(f"/users/{self.user_id}?"))
+
     def test_create_user(self):
         """Test addition of new user"""
         with app.test_client() as client:
@@ -99,11 +146,49 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('Tester, Mrs.', html)
 
+            # deleting them again, or any missing user, still just redirects
+            resp = client.get(f"/users/{self.user_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+
+    def test_conditional_get(self):
+        """Test revalidation returns 304 until the user is edited"""
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user_id}")
+            etag = resp.headers["ETag"]
+
+            self.assertIsNotNone(resp.last_modified)
+
+            resp = client.get(f"/users/{self.user_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            updated_user = {"first_name": "Updated", "last_name": "Tester"}
+            client.post(f"/users/{self.user_id}/edit", data=updated_user)
+            resp = client.get(f"/users/{self.user_id}", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_if_modified_since_ignored_with_counts(self):
+        """Test deleting an older user isn't hidden by an unchanged Last-Modified"""
+        with app.test_client() as client:
+            resp = client.get("/users")
+            since = resp.headers["Last-Modified"]
+            older = User(first_name="Older", last_name="User")
+            older.updated_at = datetime(2000, 1, 1)
+            db.session.add(older)
+            db.session.commit()
+
+            resp = client.get("/users", headers={"If-Modified-Since": since})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("User, Older", resp.get_data(as_text=True))
+
 class PostViewsTestCase(TestCase):
     """Test views for posts"""
 
     def setUp(self):
         """Add sample user and post"""
+        Feed.query.delete()
         Post.query.delete()
         User.query.delete()
 
@@ -177,11 +262,44 @@ class PostViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('hello', html)
 
+    def test_listing_pages_change_with_their_posts(self):
+        """Test the user and tag pages get new ETags when a post they list is added, retitled or removed"""
+        Tag.query.filter(Tag.name == "listed").delete(synchronize_session=False)
+        tag = Tag(name="listed")
+        db.session.add(tag)
+        db.session.commit()
+        tag_id = tag.id
+
+        with app.test_client() as client:
+            def etags():
+                return [client.get(path).headers["ETag"] for path in (f"/users/{self.user_id}", f"/tags/{tag_id}")]
+
+            def changed(before):
+                return [old != new for old, new in zip(before, etags())]
+
+            before = etags()
+            client.post(f"/users/{self.user_id}/posts/new", data={"title": "Test2", "content": "c", "check": tag_id})
+            self.assertEqual(changed(before), [True, True])
+
+            before = etags()
+            client.post(f"/posts/{self.post_id}/edit", data={"title": "Renamed", "content": "yo"})
+            self.assertEqual(changed(before), [True, False])
+
+            before = etags()
+            client.post(f"/posts/{self.post_id}/edit", data={"title": "Renamed", "content": "yo", "check": tag_id})
+            self.assertEqual(changed(before), [False, True])
+
+            before = etags()
+            client.get(f"/posts/{self.post_id}/delete")
+            self.assertEqual(changed(before), [True, True])
+
 class TagsViewsTestCase(TestCase):
     """Test views for tags"""
 
     def setUp(self):
         """Add sample user, post, and tag"""
+        PostTag.query.delete()
+        Feed.query.delete()
         Post.query.delete()
         Tag.query.delete()
         User.query.delete()
@@ -202,9 +320,11 @@ class TagsViewsTestCase(TestCase):
         tag_two = Tag(name = 'random')
         db.session.add(tag_one)
         db.session.add(tag_two)
+        Tag.bump_version()
         db.session.commit()
 
         self.tag_one_id = tag_one.id
+        self.tag_two_id = tag_two.id
 
     def tearDown(self):
         """Clean up any fouled transaction."""
@@ -235,6 +355,12 @@ class TagsViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('newtag', html)
 
+            resp = client.post(f"/tags/new", data = {"tag":"NewTag"})
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 409)
+            self.assertIn('already exists', html)
+
     def test_edit_tags(self):
         with app.test_client() as client:
             resp = client.get(f"/tags/{self.tag_one_id}/edit")
@@ -250,6 +376,39 @@ class TagsViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('edittag', html)
 
+    def test_post_tags(self):
+        """Test tagging a post on create and changing its tags on edit"""
+        with app.test_client() as client:
+            new_post = {"title": "Tagged", "content": "words",
+                        "check": [self.tag_one_id, self.tag_two_id]}
+            client.post(f"/users/{self.user_id}/posts/new", data=new_post)
+            post = Post.query.filter_by(title="Tagged").one()
+
+            self.assertEqual({pt.tag_id for pt in post.post_tags}, {self.tag_one_id, self.tag_two_id})
+
+            html = client.get(f"/posts/{post.id}/edit").get_data(as_text=True)
+            self.assertIn(f'value="{self.tag_one_id}"\n        checked', html)
+
+            edited = {"title": "Tagged", "content": "words", "check": [self.tag_two_id]}
+            resp = client.post(f"/posts/{post.id}/edit", data=edited, follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('random', html)
+            self.assertNotIn('introduction', html)
+
+    def test_cached_tag_page_invalidated_by_edit(self):
+        """Test a cached page is reused and then refreshed after an edit"""
+        with app.test_client() as client:
+            self.assertIn('introduction', client.get(f"/tags/{self.tag_one_id}").get_data(as_text=True))
+            self.assertIsNotNone(app.extensions["page_cache"].get(f"/tags/{self.tag_one_id}?"))
+
+            client.post(f"/tags/{self.tag_one_id}/edit", data={"name": "renamed"})
+            html = client.get(f"/tags/{self.tag_one_id}").get_data(as_text=True)
+
+            self.assertIn('renamed', html)
+            self.assertNotIn('introduction', html)
+
     def test_delete_tags(self):
         with app.test_client() as client:
             resp = client.post(f"/tags/{self.tag_one_id}/delete", follow_redirects = True)
@@ -257,4 +416,849 @@ class TagsViewsTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('introduction', html)
-            self.assertIn('random', html)
\ No newline at end of file
+            self.assertIn('random', html)
+
+            # deleting it again, or any missing tag, still just redirects
+            resp = client.post(f"/tags/{self.tag_one_id}/delete")
+            self.assertEqual(resp.status_code, 302)
+
+class QueryBudgetTestCase(TestCase):
+    """Test that read pages issue a constant number of queries"""
+
+    def setUp(self):
+        """Add a user with several tagged posts"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Mrs.", last_name="Tester")
+        tags = [Tag(name=f"tag{i}") for i in range(3)]
+        db.session.add(user)
+        db.session.add_all(tags)
+        Tag.bump_version()
+        db.session.commit()
+
+        self.user_id = user.id
+        self.tag_id = tags[0].id
+
+        for i in range(6):
+            post = Post(title=f"post{i}", content="yo", user_id=self.user_id)
+            post.post_tags = [PostTag(tag_id=tag.id) for tag in tags]
+            db.session.add(post)
+        db.session.commit()
+
+        self.post_id = post.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_budget_covers_streamed_body(self):
+        """Test statements a streamed body runs count against the view's budget"""
+
+        @query_budget(0)
+        def streaming_view():
+            def chunks():
+                db.session.execute(text("SELECT 1"))
+                yield "done"
+            return chunks()
+
+        with app.test_request_context():
+            chunks = streaming_view()
+            with self.assertRaises(QueryBudgetExceeded):
+                list(chunks)
+
+    def test_read_pages_within_budget(self):
+        """Budgets are enforced under TESTING, so a 200 means the page stayed within it"""
+        with app.test_client() as client:
+            for url in ["/", "/users", f"/users/{self.user_id}", f"/posts/{self.post_id}",
+                        "/tags", f"/tags/{self.tag_id}"]:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200, url)
+
+
+class PaginationTestCase(TestCase):
+    """Test keyset pagination of the users listing"""
+
+    def setUp(self):
+        """Add more users than fit on one page"""
+        Feed.query.delete()
+        Post.query.delete()
+        User.query.delete()
+
+        users = [User(first_name=f"First{i:02}", last_name="Pager") for i in range(25)]
+        db.session.add_all(users)
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_next_and_previous_pages(self):
+        """Test following next and previous cursors"""
+        with app.test_client() as client:
+            html = client.get("/users").get_data(as_text=True)
+
+            self.assertIn('Pager, First19', html)
+            self.assertNotIn('Pager, First20', html)
+            self.assertNotIn('Previous', html)
+
+            next_link = html.split('href="?after=')[1].split('"')[0]
+            resp = client.get(f"/users?after={next_link}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Pager, First24', html)
+            self.assertNotIn('Pager, First19', html)
+            self.assertNotIn('Next', html)
+
+            prev_link = html.split('href="?before=')[1].split('"')[0]
+            html = client.get(f"/users?before={prev_link}").get_data(as_text=True)
+
+            self.assertIn('Pager, First00', html)
+            self.assertIn('Pager, First19', html)
+            self.assertNotIn('Pager, First20', html)
+
+    def test_invalid_cursor(self):
+        """Test a garbled cursor is rejected"""
+        with app.test_client() as client:
+            resp = client.get("/users?after=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cursor_from_another_sort(self):
+        """Test a name-sorted cursor replayed with sort=popular is rejected, not sent to the database"""
+        with app.test_client() as client:
+            resp = client.get(f"/tags?sort=popular&after={encode_cursor(['foo', 1])}")
+
+            self.assertEqual(resp.status_code, 400)
+
+
+class SearchViewsTestCase(TestCase):
+    """Test full-text search of posts"""
+
+    def setUp(self):
+        """Add posts mentioning dragons in the title or the content"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        db.session.add(user)
+        db.session.commit()
+
+        db.session.add_all([
+            Post(title="Dragon hunting", content="A long trip east", user_id=user.id),
+            Post(title="Breakfast", content="Second breakfast, then a <b>dragon</b> appeared", user_id=user.id),
+            Post(title="Gardening", content="Nothing about lizards", user_id=user.id),
+        ] + [Post(title=f"Note {i}", content="more dragons", user_id=user.id) for i in range(10)])
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_search_ranks_and_highlights(self):
+        """Test matches are listed, title matches first, with escaped highlighted snippets"""
+        with app.test_client() as client:
+            resp = client.get("/search?q=dragon")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index('Dragon hunting'), html.index('Note'))
+            self.assertNotIn('Gardening', html)
+            self.assertIn('<mark>', html)
+
+            next_link = html.split('&after=')[1].split('"')[0]
+            second = client.get(f"/search?q=dragon&after={next_link}").get_data(as_text=True)
+
+            self.assertNotIn('Dragon hunting', second)
+            self.assertIn('Breakfast', html + second)
+            self.assertNotIn('<b>dragon</b>', html + second)
+
+    def test_candidates_are_the_newest_matches(self):
+        """Test a capped candidate set is the same newest posts on every request"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("the candidate cap only applies to Postgres")
+        with patch("search.RANK_CANDIDATES", 3), app.test_client() as client:
+            html = client.get("/search?q=dragon").get_data(as_text=True)
+
+        self.assertEqual([f"Note {i}" in html for i in range(10)], [False] * 7 + [True] * 3)
+
+    def test_bad_search_cursor(self):
+        """Test a cursor without a numeric rank and integer id is rejected"""
+        with app.test_client() as client:
+            for values in (["high", 1], [0.5, "1"], [0.5]):
+                resp = client.get(f"/search?q=dragon&after={encode_cursor(values)}")
+
+                self.assertEqual(resp.status_code, 400, values)
+
+    def test_empty_search(self):
+        """Test a blank query renders the form without results"""
+        with app.test_client() as client:
+            resp = client.get("/search?q=")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('No posts match', resp.get_data(as_text=True))
+
+
+class MetricsTestCase(TestCase):
+    """Test per-request instrumentation"""
+
+    def setUp(self):
+        """Start from no users"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        User.query.delete()
+        db.session.add(User(first_name="Bilbo", last_name="Baggins"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction and stop sampling."""
+
+        db.session.rollback()
+        app.extensions["metrics"].slow_query_ms = None
+
+    def test_server_timing_and_metrics(self):
+        """Test responses report their timing and routes get histograms"""
+        with app.test_client() as client:
+            resp = client.get("/users")
+
+            # the version check for conditional GETs plus the page itself
+            self.assertIn('desc="2 queries"', resp.headers["Server-Timing"])
+            self.assertNotIn('render;dur=0.0,', resp.headers["Server-Timing"])
+
+            text = client.get("/metrics").get_data(as_text=True)
+
+            self.assertIn('# TYPE blogly_request_duration_seconds histogram', text)
+            self.assertIn('blogly_db_statements_bucket{route="blogly.show_users_page",le="2"}', text)
+            self.assertIn('blogly_render_duration_seconds_count{route="blogly.show_users_page"}', text)
+
+    def test_streamed_page_counts_statements_sent_while_streaming(self):
+        """Test a streamed page is recorded once sent, with the query its body ran"""
+        user_id = User.query.first().id
+        app.extensions["page_cache"].clear()
+        histograms = app.extensions["metrics"].histograms
+        key = ("blogly_db_statements", "blogly.show_user_details")
+        before = (histograms[key].count, histograms[key].sum) if key in histograms else (0, 0)
+        statements = []
+        listener = lambda *args: statements.append(1)
+        with app.test_client() as client:
+            event.listen(db.engine, "before_cursor_execute", listener)
+            try:
+                resp = client.get(f"/users/{user_id}")
+                resp.get_data()
+                resp.close()
+            finally:
+                event.remove(db.engine, "before_cursor_execute", listener)
+
+        self.assertGreaterEqual(len(statements), 2)
+        self.assertEqual((histograms[key].count, histograms[key].sum),
+                         (before[0] + 1, before[1] + len(statements)))
+
+    def test_slow_query_sampling(self):
+        """Test statements over the threshold are kept with their parameters"""
+        metrics = app.extensions["metrics"]
+        metrics.slow_query_ms = 0
+        with app.test_client() as client:
+            client.get("/users")
+
+            self.assertEqual(metrics.slow_queries[-1]["route"], "blogly.show_users_page")
+            self.assertIn("FROM users", metrics.slow_queries[-1]["statement"])
+
+
+class APITestCase(TestCase):
+    """Test the JSON API"""
+
+    def setUp(self):
+        """Add a user with tagged posts"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        tags = [Tag(name="Adventure"), Tag(name="Food")]
+        db.session.add(user)
+        db.session.add_all(tags)
+        Tag.bump_version()
+        db.session.commit()
+
+        self.user_id = user.id
+        self.tag_id = tags[0].id
+        for i in range(25):
+            post = Post(title=f"Post {i}", content="There and back again", user_id=user.id)
+            post.post_tags = [PostTag(tag_id=tag.id) for tag in tags]
+            db.session.add(post)
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_sparse_fields_and_pages(self):
+        """Test only requested fields are returned and cursors walk the listing"""
+        with app.test_client() as client:
+            resp = client.get("/api/v1/posts?fields=title")
+            body = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(body["data"]), 20)
+            self.assertEqual(set(body["data"][0]), {"id", "title"})
+
+            rest = client.get(body["links"]["next"]).get_json()
+
+            self.assertEqual(len(rest["data"]), 5)
+            self.assertIn("fields=title", rest["links"]["prev"])
+
+    def test_include_user_and_tags(self):
+        """Test compound documents include each related row once"""
+        with app.test_client() as client:
+            body = client.get(f"/api/v1/tags/{self.tag_id}/posts?include=user,tags&fields[tags]=name").get_json()
+
+            self.assertEqual(body["data"][0]["user_id"], self.user_id)
+            self.assertEqual(len(body["data"][0]["tag_ids"]), 2)
+            self.assertEqual([u["last_name"] for u in body["included"]["users"]], ["Baggins"])
+            self.assertEqual(sorted(t["name"] for t in body["included"]["tags"]), ["Adventure", "Food"])
+
+    def test_errors(self):
+        """Test bad fields, includes and ids are JSON errors"""
+        with app.test_client() as client:
+            self.assertEqual(client.get("/api/v1/users?fields=password").status_code, 400)
+            self.assertEqual(client.get("/api/v1/tags?include=posts").status_code, 400)
+            self.assertEqual(client.get("/api/v1/posts?after=nope").get_json()["error"], "Invalid page cursor")
+            self.assertEqual(client.get("/api/v1/users/0").status_code, 404)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test GET requests read from the replica and writes stick to the primary"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create an app with a second local database as its replica"""
+        uri = os.environ.get("TEST_REPLICA_DATABASE_URL", "postgresql:///blogly_test_replica")
+        name = uri.rsplit("/", 1)[1]
+        with db.get_engine(app).connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if not conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": name}).first():
+                conn.execute(text(f'CREATE DATABASE "{name}"'))
+
+        cls.app = create_app("testing", SQLALCHEMY_BINDS={"replica": uri}, PAGE_CACHE_BACKEND=None)
+        cls.cached_app = create_app("testing", SQLALCHEMY_BINDS={"replica": uri})
+        db.app = app
+        cls.replica = db.get_engine(cls.app, bind="replica")
+        db.Model.metadata.drop_all(cls.replica)
+        db.Model.metadata.create_all(cls.replica)
+
+    def setUp(self):
+        """Give each database a user the other doesn't have"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        User.query.delete()
+        db.session.add(User(first_name="Primary", last_name="Only"))
+        db.session.commit()
+
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.delete())
+            conn.execute(User.__table__.insert(), {"first_name": "Replica", "last_name": "Only"})
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_reads_go_to_replica_until_a_write(self):
+        """Test the redirect after a POST reads from the primary, later GETs from the replica"""
+        with self.app.test_client() as client:
+            html = client.get("/users").get_data(as_text=True)
+
+            self.assertIn("Replica", html)
+            self.assertNotIn("Primary", html)
+
+            resp = client.post("/users/new", data={"first_name": "Samwise", "last_name": "Gamgee"},
+                               follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Samwise", html)
+            self.assertIn("Primary", html)
+
+            with client.session_transaction() as session:
+                session["primary_until"] = 0
+            html = client.get("/users").get_data(as_text=True)
+
+            self.assertIn("Replica", html)
+            self.assertNotIn("Samwise", html)
+
+    def test_page_cache_keeps_read_your_writes(self):
+        """Test a writer skips the page cache, and replica pages right after a write aren't kept"""
+        Tag.query.delete()
+        db.session.commit()
+        with self.replica.begin() as conn:
+            conn.execute(Tag.__table__.delete())
+        cache = self.cached_app.extensions["page_cache"]
+
+        with self.cached_app.test_client() as writer, self.cached_app.test_client() as reader:
+            writer.post("/tags/new", data={"tag": "quest"})
+            self.assertNotIn("quest", reader.get("/tags").get_data(as_text=True))
+            self.assertIsNone(cache.get("/tags?"))
+
+            cache.set("/tags?", "stale", cache.generation())
+            self.assertIn("quest", writer.get("/tags").get_data(as_text=True))
+
+
+
+try:
+    import asyncpg, asgiref
+    HAVE_ASYNC = True
+except ImportError:
+    HAVE_ASYNC = False
+
+
+@skipUnless(HAVE_ASYNC, "needs asyncpg and asgiref")
+class AsyncReadTestCase(TestCase):
+    """Test the async read routes render the same pages as the sync views"""
+
+    def setUp(self):
+        """Add a user with a tagged post"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        tag = Tag(name="Adventure")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        post = Post(title="There and back", content="A hobbit's tale", user_id=user.id)
+        post.post_tags = [PostTag(tag_id=tag.id)]
+        db.session.add(post)
+        db.session.commit()
+
+        self.paths = ["/", "/users", f"/users/{user.id}", f"/posts/{post.id}", "/tags", f"/tags/{tag.id}"]
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def get_all(self, asgi_app, paths):
+        """(status, body) for each GET, sent straight to the ASGI app"""
+
+        async def get(path):
+            sent = []
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                sent.append(message)
+
+            path, _, query = path.partition("?")
+            scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+                     "headers": [], "http_version": "1.1", "scheme": "http", "root_path": "",
+                     "server": ("localhost", 80), "client": ("127.0.0.1", 1)}
+            await asgi_app(scope, receive, send)
+            body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+            return sent[0]["status"], body.decode()
+
+        async def run():
+            results = [await get(path) for path in paths]
+            await asgi_app.engine.dispose()
+            return results
+
+        return asyncio.run(run())
+
+    def test_async_pages_match_sync(self):
+        """Test each read page renders the same content on both paths, and writes fall through"""
+        asgi_app = create_asgi_app("testing", PAGE_CACHE_BACKEND=None)
+        results = self.get_all(asgi_app, self.paths + ["/posts/0", "/users/new"])
+
+        with app.test_client() as client:
+            for path, (status, body) in zip(self.paths, results):
+                self.assertEqual(status, 200)
+                self.assertEqual(body, client.get(path).get_data(as_text=True).strip())
+
+        self.assertEqual(results[-2][0], 404)
+        self.assertIn("Add New User", results[-1][1])
+
+
+class PostCountTestCase(TestCase):
+    """Test users' and tags' post_count follow every post change"""
+
+    def setUp(self):
+        """Add two users and two tags"""
+        PostTag.query.delete()
+        Feed.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        users = [User(first_name="Bilbo", last_name="Baggins"), User(first_name="Sam", last_name="Gamgee")]
+        tags = [Tag(name="Adventure"), Tag(name="Food")]
+        db.session.add_all(users + tags)
+        Tag.bump_version()
+        db.session.commit()
+
+        self.user_id, self.other_id = users[0].id, users[1].id
+        self.tag_ids = [tag.id for tag in tags]
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def counts(self):
+        db.session.expire_all()
+        return ([User.query.get(id).post_count for id in (self.user_id, self.other_id)],
+                [Tag.query.get(id).post_count for id in self.tag_ids])
+
+    def test_counts_follow_posts(self):
+        """Test create, edit and delete of posts and users keep the counts exact"""
+        adventure, food = self.tag_ids
+        with app.test_client() as client:
+            for i in range(2):
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": f"Trip {i}", "content": "x", "check": [adventure, food]})
+            client.post(f"/users/{self.other_id}/posts/new", data={"title": "Taters", "content": "x", "check": [food]})
+
+            self.assertEqual(self.counts(), ([2, 1], [2, 3]))
+
+            post_id = Post.query.filter_by(title="Trip 0").one().id
+            client.post(f"/posts/{post_id}/edit", data={"title": "Trip 0", "content": "x", "check": [adventure]})
+
+            self.assertEqual(self.counts(), ([2, 1], [2, 2]))
+
+            client.get(f"/posts/{post_id}/delete")
+
+            self.assertEqual(self.counts(), ([1, 1], [1, 2]))
+
+            client.get(f"/users/{self.user_id}/delete")
+            db.session.expire_all()
+
+            self.assertEqual([Tag.query.get(id).post_count for id in self.tag_ids], [0, 1])
+
+    def test_sort_by_popularity(self):
+        """Test listings show counts and can put the busiest first"""
+        with app.test_client() as client:
+            client.post(f"/users/{self.other_id}/posts/new",
+                        data={"title": "Taters", "content": "x", "check": [self.tag_ids[1]]})
+            html = client.get("/users?sort=popular").get_data(as_text=True)
+
+            self.assertLess(html.index("Gamgee"), html.index("Baggins"))
+            self.assertIn("(1 posts)", html)
+
+            html = client.get("/tags?sort=popular").get_data(as_text=True)
+
+            self.assertLess(html.index("Food"), html.index("Adventure"))
+
+
+class FeedTestCase(TestCase):
+    """Test the precomputed feeds follow post, user and tag changes"""
+
+    def setUp(self):
+        """Add a user, a tag and six posts through the handlers"""
+        Feed.query.delete()
+        PostTag.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        tag = Tag(name="Adventure")
+        db.session.add_all([user, tag])
+        Tag.bump_version()
+        db.session.commit()
+        self.user_id, self.tag_id = user.id, tag.id
+
+        with app.test_client() as client:
+            for i in range(6):
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": f"Trip {i}", "content": "There and back " * 30, "check": [self.tag_id]})
+        self.post_ids = [id for (id,) in db.session.query(Post.id).order_by(Post.id)]
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def titles(self, name):
+        db.session.expire_all()
+        return [entry["title"] for entry in Feed.query.get(name).entries]
+
+    def test_feeds_keep_newest_posts(self):
+        """Test home, user and tag feeds hold the FEED_SIZE newest summaries"""
+        newest = [f"Trip {i}" for i in range(5, 0, -1)]
+        for name in ("home", f"user:{self.user_id}", f"tag:{self.tag_id}"):
+            self.assertEqual(self.titles(name), newest)
+
+        entry = Feed.get_entries("home")[0]
+        self.assertEqual((entry["author"], entry["tags"]), ("Bilbo Baggins", ["Adventure"]))
+        self.assertLessEqual(len(entry["excerpt"]), 201)
+
+        with app.test_client() as client:
+            html = client.get("/").get_data(as_text=True)
+
+        self.assertIn("Trip 5", html)
+        self.assertNotIn("Trip 0", html)
+
+    def test_feeds_follow_edits_and_deletes(self):
+        """Test edits update entries in place and deletes pull older posts back in"""
+        with app.test_client() as client:
+            client.post(f"/posts/{self.post_ids[5]}/edit", data={"title": "Homeward", "content": "x"})
+
+            self.assertEqual(self.titles("home")[0], "Homeward")
+            self.assertEqual(self.titles(f"tag:{self.tag_id}")[0], "Trip 4")
+            self.assertEqual(self.titles(f"tag:{self.tag_id}")[-1], "Trip 0")
+
+            client.get(f"/posts/{self.post_ids[4]}/delete")
+
+            self.assertEqual(self.titles("home"), ["Homeward", "Trip 3", "Trip 2", "Trip 1", "Trip 0"])
+
+            client.post(f"/users/{self.user_id}/edit", data={"first_name": "Mr.", "last_name": "Underhill"})
+
+            self.assertEqual(Feed.get_entries(f"tag:{self.tag_id}")[0]["author"], "Mr. Underhill")
+
+            client.get(f"/users/{self.user_id}/delete")
+
+            self.assertEqual(self.titles("home"), [])
+            self.assertIsNone(Feed.query.get(f"user:{self.user_id}"))
+
+
+class AtomFeedTestCase(TestCase):
+    """Test the Atom feeds"""
+
+    def setUp(self):
+        """Add a user with a tagged post"""
+        Feed.query.delete()
+        PostTag.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        tag = Tag(name="Adventure")
+        db.session.add_all([user, tag])
+        Tag.bump_version()
+        db.session.commit()
+        self.user_id, self.tag_id = user.id, tag.id
+
+        with app.test_client() as client:
+            client.post(f"/users/{self.user_id}/posts/new",
+                        data={"title": "There & Back", "content": "A hobbit's tale", "check": [self.tag_id]})
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_feeds(self):
+        """Test site, user and tag feeds list the post as escaped Atom"""
+        with app.test_client() as client:
+            for path in ("/feed.atom", f"/users/{self.user_id}/feed.atom", f"/tags/{self.tag_id}/feed.atom"):
+                resp = client.get(path)
+                xml = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.mimetype, "application/atom+xml")
+                self.assertIn("<title>There &amp; Back</title>", xml)
+                self.assertIn('<category term="Adventure"/>', xml)
+                self.assertIn("<name>Bilbo Baggins</name>", xml)
+                self.assertTrue(xml.rstrip().endswith("</updated>\n</feed>"))
+
+            self.assertEqual(client.get("/users/0/feed.atom").status_code, 404)
+
+    def test_revalidation_and_invalidation(self):
+        """Test an unchanged feed revalidates with 304 and a new post changes it"""
+        with app.test_client() as client:
+            etag = client.get("/feed.atom").headers["ETag"]
+
+            resp = client.get("/feed.atom", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.post(f"/users/{self.user_id}/posts/new", data={"title": "Second Breakfast", "content": "x"})
+            resp = client.get("/feed.atom", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Second Breakfast", resp.get_data(as_text=True))
+
+
+class DeletionTestCase(TestCase):
+    """Test cascading and background deletion of users and tags"""
+
+    def setUp(self):
+        """Add two users and two tags; lower the background threshold to 2 posts"""
+        DeletionJob.query.delete()
+        Feed.query.delete()
+        PostTag.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        users = [User(first_name="Bilbo", last_name="Baggins"), User(first_name="Sam", last_name="Gamgee")]
+        tags = [Tag(name="Adventure"), Tag(name="Food")]
+        db.session.add_all(users + tags)
+        Tag.bump_version()
+        db.session.commit()
+        self.user_id, self.other_id = users[0].id, users[1].id
+        self.tag_ids = [tag.id for tag in tags]
+
+        app.config.update(DELETE_IN_BACKGROUND_OVER=2, DELETE_BATCH_SIZE=2)
+        with app.test_client() as client:
+            for i in range(3):
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": f"Trip {i}", "content": "x", "check": self.tag_ids})
+            client.post(f"/users/{self.other_id}/posts/new",
+                        data={"title": "Taters", "content": "x", "check": [self.tag_ids[1]]})
+
+    def tearDown(self):
+        """Restore the thresholds and clean up any fouled transaction."""
+
+        app.config.update(DELETE_IN_BACKGROUND_OVER=1000, DELETE_BATCH_SIZE=1000)
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_small_delete_cascades(self):
+        """Test a user under the threshold is deleted at once, posts and tags by the database"""
+        with app.test_client() as client:
+            client.get(f"/users/{self.other_id}/delete")
+
+        self.assertEqual(Post.query.filter_by(user_id=self.other_id).count(), 0)
+        self.assertEqual(PostTag.query.count(), 6)
+        self.assertEqual(DeletionJob.query.count(), 0)
+
+    def test_large_user_delete_runs_in_background(self):
+        """Test a big user is queued, then removed in batches with counts and feeds kept right"""
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.user_id}/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNotNone(User.query.get(self.user_id))
+            job = DeletionJob.query.one()
+            status = client.get(f"/api/v1/deletions/{job.id}").get_json()["data"]
+            self.assertEqual((status["status"], status["total"], status["deleted"]), ("pending", 3, 0))
+
+            with app.app_context():
+                self.assertEqual(deletions.run_pending(), 1)
+            status = client.get(f"/api/v1/deletions/{job.id}").get_json()["data"]
+
+        self.assertEqual((status["status"], status["deleted"]), ("done", 3))
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.user_id))
+        self.assertEqual(Post.query.count(), 1)
+        self.assertEqual([Tag.query.get(id).post_count for id in self.tag_ids], [0, 1])
+        self.assertEqual([e["title"] for e in Feed.query.get("home").entries], ["Taters"])
+
+    def test_large_tag_delete_runs_in_background(self):
+        """Test a big tag is queued once and its post_tags removed in batches"""
+        food = self.tag_ids[1]
+        with app.test_client() as client:
+            client.post(f"/tags/{food}/delete")
+            client.post(f"/tags/{food}/delete")
+
+        self.assertEqual(DeletionJob.query.count(), 1)
+        with app.app_context():
+            deletions.run_pending()
+
+        db.session.expire_all()
+        self.assertIsNone(Tag.query.get(food))
+        self.assertEqual(PostTag.query.count(), 3)
+        self.assertEqual(DeletionJob.query.one().deleted, 4)
+
+
+class PostBatchTestCase(TestCase):
+    """Test creating posts in bulk through the API"""
+
+    def setUp(self):
+        """Add a user and one existing tag"""
+        Feed.query.delete()
+        PostTag.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+
+        user = User(first_name="Bilbo", last_name="Baggins")
+        db.session.add_all([user, Tag(name="Adventure")])
+        Tag.bump_version()
+        db.session.commit()
+        self.user_id = user.id
+        self.url = f"/api/v1/users/{self.user_id}/posts"
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_batch_creates_posts_tags_counts_and_feeds(self):
+        """Test one request writes every post with its tags and keeps the denormalized data right"""
+        posts = [{"title": f"Day {i}", "content": "walked " * 80, "tags": ["adventure", "Walks"],
+                  "idempotency_key": f"day-{i}"} for i in range(7)]
+        posts.append({"title": "Old", "content": "x", "created_at": "2001-12-19T00:00:00"})
+        with app.test_client() as client:
+            resp = client.post(self.url, json={"data": posts})
+
+        self.assertEqual(resp.status_code, 201)
+        results = resp.get_json()["data"]
+        self.assertEqual([r["status"] for r in results], ["created"] * 8)
+        self.assertEqual(Post.query.get(results[0]["id"]).title, "Day 0")
+        self.assertEqual(Post.query.get(results[7]["id"]).created_at.year, 2001)
+
+        self.assertEqual(User.query.get(self.user_id).post_count, 8)
+        self.assertEqual(sorted((t.name, t.post_count) for t in Tag.query), [("Adventure", 7), ("Walks", 7)])
+        self.assertEqual(PostTag.query.count(), 14)
+        self.assertEqual([e["title"] for e in Feed.get_entries("home")], [f"Day {i}" for i in range(6, 1, -1)])
+        self.assertTrue(Feed.get_entries("home")[0]["excerpt"].endswith("…"))
+
+    def test_retried_batch_is_not_duplicated(self):
+        """Test items with used idempotency keys report the existing post"""
+        posts = [{"title": "One", "content": "x", "idempotency_key": "a"}]
+        with app.test_client() as client:
+            first = client.post(self.url, json={"data": posts}).get_json()["data"]
+            resp = client.post(self.url, json={"data": posts + [{"title": "Two", "content": "y"}]})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()["data"][0], {"status": "existing", "id": first[0]["id"]})
+        self.assertEqual(resp.get_json()["data"][1]["status"], "created")
+        self.assertEqual(Post.query.count(), 2)
+        self.assertEqual(User.query.get(self.user_id).post_count, 2)
+
+    def test_invalid_batch_writes_nothing(self):
+        """Test one bad item rejects the batch, with errors reported per item"""
+        posts = [{"title": "Fine", "content": "x"}, {"title": "", "content": "x", "tags": "x"},
+                 {"title": "Dup", "content": "x", "idempotency_key": "k"},
+                 {"title": "Dup", "content": "x", "idempotency_key": "k"}]
+        with app.test_client() as client:
+            resp = client.post(self.url, json={"data": posts})
+            self.assertEqual(client.post(self.url, json={"posts": posts}).status_code, 400)
+            self.assertEqual(client.post("/api/v1/users/0/posts", json={"data": posts}).status_code, 404)
+
+        self.assertEqual(resp.status_code, 422)
+        results = resp.get_json()["data"]
+        self.assertEqual([r["status"] for r in results], ["skipped", "invalid", "invalid", "invalid"])
+        self.assertIn("title is required", results[1]["errors"])
+        self.assertIn("idempotency_key is repeated in the batch", results[3]["errors"])
+        self.assertEqual(Post.query.count(), 0)
@@ -0,0 +1,231 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from app import create_app
+from identitycache import IdentityCache, SHARED_VERSION
+from models import db, User, Post, Tag, PostTag, Feed, CacheVersion
+
+# No page cache, so every request renders and its statements can be counted
+app = create_app("testing", PAGE_CACHE_BACKEND=None)
+db.drop_all()
+db.create_all()
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StatementCounter:
+    """Counts the SQL statements sent while it is active"""
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(db.engine, "before_cursor_execute", self.count_statement)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, "before_cursor_execute", self.count_statement)
+
+    def count_statement(self, *args):
+        self.count += 1
+
+
+class IdentityCacheTestCase(TestCase):
+    """Tests LRU and TTL eviction, counters and the invalidation guard"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = IdentityCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_lru_eviction(self):
+        for pk in (1, 2):
+            self.cache.put(User, pk, (pk,), self.cache.generation())
+        self.cache.get(User, 1)
+        self.cache.put(User, 3, (3,), self.cache.generation())
+
+        self.assertEqual(self.cache.get(User, 1), (1,))
+        self.assertIsNone(self.cache.get(User, 2))
+        self.assertEqual(self.cache.stats(), {"entries": 2, "hits": 2, "misses": 1, "evictions": 1})
+
+    def test_ttl_expiry(self):
+        self.cache.put(Tag, 1, ("fun",), self.cache.generation())
+        self.clock.now += 11
+
+        self.assertIsNone(self.cache.get(Tag, 1))
+
+    def test_invalidation_skips_snapshots_read_before_it(self):
+        """Test a row read before an invalidation isn't stored after it"""
+        generation = self.cache.generation()
+        self.cache.invalidate(models=(User,))
+        self.cache.put(User, 1, ("stale",), generation)
+
+        self.assertIsNone(self.cache.get(User, 1))
+
+    def test_sync_is_due_once_per_interval(self):
+        self.assertTrue(self.cache.sync_due())
+        self.cache.sync(1)
+        self.clock.now += 0.5
+        self.assertFalse(self.cache.sync_due())
+        self.clock.now += 0.5
+
+        self.assertTrue(self.cache.sync_due())
+
+
+class CachedLookupTestCase(TestCase):
+    """Tests Query.get and relationship loads served from the cache, and their invalidation"""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        self.cache = app.extensions["identity_cache"]
+        # statement counts below don't include a version check unless a test asks for one
+        self.sync_interval, self.cache.sync_interval = self.cache.sync_interval, 3600
+
+        Feed.query.delete()
+        Post.query.delete()
+        User.query.delete()
+        Tag.query.delete()
+        user = User(first_name="Bilbo", last_name="Baggins")
+        tag = Tag(name="adventure")
+        db.session.add_all([user, tag])
+        db.session.commit()
+        post = Post(title="There and Back", content="A hobbit's tale", user_id=user.id)
+        post.post_tags.append(PostTag(tag_id=tag.id))
+        db.session.add(post)
+        db.session.commit()
+        self.user_id, self.tag_id, self.post_id = user.id, tag.id, post.id
+        # as if a request had already seen the version bumped by the writes above
+        self.cache.sync(CacheVersion.get(SHARED_VERSION))
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.cache.sync_interval = self.sync_interval
+        self.ctx.pop()
+
+    def warm(self):
+        """Loads the rows into the cache and starts a fresh session"""
+        User.query.get(self.user_id)
+        Tag.query.get(self.tag_id)
+        db.session.remove()
+
+    def test_get_is_served_from_cache(self):
+        self.warm()
+        with StatementCounter() as statements:
+            user = User.query.get(self.user_id)
+            tag = Tag.query.get(self.tag_id)
+
+        self.assertEqual((user.get_full_name(), tag.name), ("Bilbo Baggins", "adventure"))
+        self.assertEqual(statements.count, 0)
+
+    def test_get_many_serves_relationship_loads(self):
+        """Test objects get_many takes from the cache are in the identity map for lazy loads"""
+        self.warm()
+        post = Post.query.get(self.post_id)
+        with StatementCounter() as statements:
+            # held, since the identity map only keeps unmodified objects while they are referenced
+            authors = db.session().get_many(User, [post.user_id])
+            name = post.user.get_full_name()
+
+        self.assertEqual(name, "Bilbo Baggins")
+        self.assertEqual(statements.count, 0)
+
+    def test_post_page_takes_two_queries_when_cached(self):
+        with app.test_client() as client:
+            client.get(f"/posts/{self.post_id}")
+            with StatementCounter() as statements:
+                html = client.get(f"/posts/{self.post_id}").get_data(as_text=True)
+
+        self.assertIn("Bilbo Baggins", html)
+        self.assertIn("adventure", html)
+        # Post.get_version, the post and its post_tags
+        self.assertEqual(statements.count, 3)
+
+    def test_counters_are_not_cached(self):
+        """Test post_count is read from the database, so new posts don't go stale or invalidate"""
+        self.warm()
+        User.change_post_count(self.user_id, 5)
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(User.query.get(self.user_id).post_count, 5)
+        self.assertEqual(self.cache.stats()["entries"], 2)
+
+    def test_edits_invalidate(self):
+        self.warm()
+        with app.test_client() as client:
+            client.post(f"/users/{self.user_id}/edit",
+                        data={"first_name": "Frodo", "last_name": "Baggins", "image_url": ""})
+            client.post(f"/tags/{self.tag_id}/edit", data={"name": "quest"})
+        db.session.remove()
+
+        self.assertEqual(User.query.get(self.user_id).first_name, "Frodo")
+        self.assertEqual(Tag.query.get(self.tag_id).name, "quest")
+
+    def test_deletes_invalidate(self):
+        self.warm()
+        with app.test_client() as client:
+            client.post(f"/tags/{self.tag_id}/delete")
+            client.get(f"/users/{self.user_id}/delete")
+        db.session.remove()
+
+        self.assertIsNone(User.query.get(self.user_id))
+        self.assertIsNone(Tag.query.get(self.tag_id))
+
+    def test_writes_bump_the_shared_version(self):
+        version = CacheVersion.get(SHARED_VERSION)
+        with app.test_client() as client:
+            client.post(f"/tags/{self.tag_id}/edit", data={"name": "quest"})
+            client.post(f"/users/{self.user_id}/posts/new", data={"title": "Again", "content": "More"})
+        db.session.remove()
+
+        # the new post only changed post_count, which isn't cached
+        self.assertEqual(CacheVersion.get(SHARED_VERSION), version + 1)
+
+    def test_other_processes_edits_clear_the_cache(self):
+        """Test an edit committed elsewhere is seen by the next request, not after the TTL"""
+        self.warm()
+        with db.engine.begin() as conn:
+            conn.execute(User.__table__.update().values(first_name="Frodo"))
+            conn.execute(CacheVersion.__table__.update().where(CacheVersion.name == SHARED_VERSION)
+                         .values(version=CacheVersion.version + 1))
+        self.cache.sync_interval = 0
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.user_id}").get_data(as_text=True)
+
+        self.assertIn("Frodo", html)
+
+    def test_replica_reads_are_not_cached(self):
+        with app.test_request_context(), patch("identitycache.reading_replica", return_value=True):
+            User.query.get(self.user_id)
+
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_uncommitted_changes_are_not_cached(self):
+        """Test rows read back after a flush are kept out of the cache until the commit"""
+        user = User.query.get(self.user_id)
+        user.first_name = "Lobelia"
+        db.session.flush()
+        db.session.expire(user)
+        self.assertEqual(User.query.get(self.user_id).first_name, "Lobelia")
+        db.session.rollback()
+        db.session.remove()
+
+        self.assertEqual(User.query.get(self.user_id).first_name, "Bilbo")
+
+    def test_metrics_expose_counters(self):
+        self.warm()
+        User.query.get(self.user_id)
+        with app.test_client() as client:
+            text = client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn(f"blogly_identity_cache_hits_total {self.cache.hits}", text)
+        self.assertIn("blogly_identity_cache_entries 2", text)
@@ -1,11 +1,17 @@
+import io
 from unittest import TestCase
 
-from app import app
-from models import db, User, Post, Tag
+from app import create_app
+from models import db, User, Post, Tag, PostTag
+from models import EXCERPT_LENGTH, excerpt, recount_post_counts
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import undefer
+import bulk
+import datagen
+import migrations
 
 # Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_ECHO'] = False
+app = create_app("testing")
 
 db.drop_all()
 db.create_all()
@@ -71,6 +77,7 @@ class PostModelTestCase(TestCase):
         ]
 
         db.session.bulk_save_objects(tags)
+        Tag.bump_version()
         db.session.commit()
 
     def tearDown(self):
@@ -83,6 +90,184 @@ class PostModelTestCase(TestCase):
         all_tags = Tag.get_all_tags()
 
         self.assertEqual(len(all_tags), 3)
-        self.assertIn(Tag.query.all()[0], all_tags)
-        self.assertIn(Tag.query.all()[1], all_tags)
-        self.assertIn(Tag.query.all()[2], all_tags)
+        self.assertIn((Tag.query.all()[0].id, Tag.query.all()[0].name), all_tags)
+        self.assertIn((Tag.query.all()[1].id, Tag.query.all()[1].name), all_tags)
+        self.assertIn((Tag.query.all()[2].id, Tag.query.all()[2].name), all_tags)
+
+    def test_get_all_tags_snapshot_reused_until_bumped(self):
+        """Test the snapshot is only rebuilt after the tags version changes"""
+        first = Tag.get_all_tags()
+        self.assertIs(Tag.get_all_tags(), first)
+
+        db.session.add(Tag(name = "four"))
+        Tag.bump_version()
+        db.session.commit()
+
+        self.assertEqual(len(Tag.get_all_tags()), 4)
+
+class PostContentTestCase(TestCase):
+    """Tests deferred content and the stored excerpt"""
+
+    def setUp(self):
+        """Add a user with one long post"""
+        Post.query.delete()
+        User.query.delete()
+
+        user = User(first_name = "Test", last_name = "Case")
+        post = Post(title = "Long", content = "word " * 100, user = user)
+        db.session.add(post)
+        db.session.commit()
+        self.post_id = post.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+
+        db.session.rollback()
+
+    def test_excerpt_follows_content(self):
+        """Test the excerpt is written with the content and replaced when it changes"""
+        post = Post.query.get(self.post_id)
+        self.assertEqual(post.excerpt, excerpt("word " * 100))
+        self.assertLessEqual(len(post.excerpt), EXCERPT_LENGTH + 1)
+
+        post.content = "Shorter now"
+        db.session.commit()
+
+        self.assertEqual(Post.query.get(self.post_id).excerpt, "Shorter now")
+
+    def test_content_is_loaded_only_on_request(self):
+        """Test listings leave content unloaded and undefer() opts in"""
+        db.session.expunge_all()
+        listed = Post.query.filter_by(id = self.post_id).one()
+        self.assertNotIn("content", inspect(listed).dict)
+        self.assertNotIn("word word", repr(listed))
+
+        db.session.expunge_all()
+        shown = Post.query.options(undefer(Post.content)).get(self.post_id)
+        self.assertEqual(inspect(shown).dict["content"], "word " * 100)
+
+class MigrationsTestCase(TestCase):
+    """Tests schema migration bookkeeping"""
+
+    def test_check_schema_reports_missing_index(self):
+        """Test a dropped index is reported until it is recreated"""
+        migrations.stamp(db.engine)
+        self.assertEqual(migrations.check_schema(db.engine), [])
+
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP INDEX ix_posts_created_at_id")
+        try:
+            self.assertIn("missing index ix_posts_created_at_id on posts",
+                          migrations.check_schema(db.engine))
+        finally:
+            with db.engine.begin() as conn:
+                migrations.add_lookup_indexes(conn)
+
+        self.assertEqual(migrations.check_schema(db.engine), [])
+
+    def test_case_duplicate_tags_are_merged_before_unique_index(self):
+        """Test "Python" and "python" become one tag, keeping every post's tags"""
+        engine = create_engine("sqlite://")
+        with engine.begin() as conn:
+            migrations.create_tables(conn)
+            conn.exec_driver_sql("INSERT INTO users (id, first_name, last_name) VALUES (1, 'Bilbo', 'Baggins')")
+            conn.exec_driver_sql("INSERT INTO posts (id, title, content, user_id) VALUES "
+                                 "(1, 'a', 'x', 1), (2, 'b', 'x', 1), (3, 'c', 'x', 1)")
+            conn.exec_driver_sql("INSERT INTO tags (id, name) VALUES (1, 'Python'), (2, 'python'), "
+                                 "(3, 'PYTHON'), (4, 'Rust')")
+            conn.exec_driver_sql("INSERT INTO post_tags (post_id, tag_id) VALUES "
+                                 "(1, 1), (1, 2), (2, 2), (2, 3), (3, 4)")
+
+            migrations.add_lookup_indexes(conn)
+
+            self.assertEqual(conn.exec_driver_sql("SELECT id, name FROM tags ORDER BY id").all(),
+                             [(1, "Python"), (4, "Rust")])
+            self.assertEqual(conn.exec_driver_sql("SELECT post_id, tag_id FROM post_tags ORDER BY 1, 2").all(),
+                             [(1, 1), (2, 1), (3, 4)])
+
+class BulkTestCase(TestCase):
+    """Tests streaming import and export"""
+
+    def setUp(self):
+        """Start from empty tables"""
+        db.session.rollback()
+        PostTag.query.delete()
+        Post.query.delete()
+        Tag.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction and the tag associations."""
+
+        db.session.rollback()
+        PostTag.query.delete()
+        db.session.commit()
+
+    def test_import_and_export_round_trip(self):
+        """Test posts are imported in batches with tags resolved by name"""
+        users = io.StringIO('{"first_name": "Bilbo", "last_name": "Baggins"}\n')
+        bulk.import_records("users", bulk.read_records(users, "jsonl", "users"))
+        user_id = User.query.one().id
+
+        posts = io.StringIO(
+            "title,content,user_id,tags\n"
+            f"One,first,{user_id},Adventure|Funny\n"
+            f"Two,second,{user_id},adventure| \n"
+            f"Three,third,{user_id},\n"
+            f"Four,,{user_id},\n")
+        done = []
+        bulk.import_records("posts", bulk.read_records(posts, "csv", "posts"), batch_size=2,
+                            on_batch=done.append)
+
+        self.assertEqual(done, [2, 4])
+        self.assertEqual(sorted(t.name for t in Tag.query.all()), ["Adventure", "Funny"])
+        self.assertEqual(PostTag.query.count(), 3)
+
+        exported = list(bulk.export_records("posts", batch_size=2))
+        self.assertEqual([p["title"] for p in exported], ["One", "Two", "Three", "Four"])
+        self.assertEqual(exported[0]["tags"], ["Adventure", "Funny"])
+        # empty content is kept as "", not turned into a NULL the column rejects
+        self.assertEqual(exported[3]["content"], "")
+
+        # exported CSV reads back the same
+        out = io.StringIO()
+        bulk.write_records(out, "csv", "posts", exported)
+        out.seek(0)
+        self.assertEqual([r["content"] for r in bulk.read_records(out, "csv", "posts")],
+                         ["first", "second", "third", ""])
+
+        # ids handed out by the import must not collide with later ORM inserts
+        db.session.add(Post(title="Five", content="fifth", user_id=user_id))
+        db.session.commit()
+
+    def test_resume_skips_committed_records(self):
+        """Test a resumed import starts after the checkpoint"""
+        records = [{"name": f"tag{i}"} for i in range(5)]
+        bulk.import_records("tags", iter(records), batch_size=2, skip=3)
+
+        self.assertEqual(sorted(t.name for t in Tag.query.all()), ["tag3", "tag4"])
+
+    def test_generate_is_deterministic(self):
+        """Test generated datasets have the expected shape and repeat for a seed"""
+        self.assertEqual(datagen.generate(200, seed=1, batch_size=50), (10, 20, 200))
+        self.assertEqual(User.query.count(), 10)
+        self.assertEqual(Post.query.count(), 200)
+        first = [p.title for p in Post.query.order_by(Post.id).limit(5)]
+
+        self.setUp()
+        datagen.generate(200, seed=1, batch_size=50)
+        self.assertEqual([p.title for p in Post.query.order_by(Post.id).limit(5)], first)
+
+    def test_import_recounts_posts(self):
+        """Test post_count is exact after a bulk import, and recount finds no drift"""
+        datagen.generate(100, seed=2, batch_size=30)
+        user = User.query.order_by(User.post_count.desc()).first()
+
+        self.assertEqual(user.post_count, Post.query.filter_by(user_id=user.id).count())
+        self.assertEqual(recount_post_counts(), {"users": 0, "tags": 0})
+
+        User.query.filter_by(id=user.id).update({User.post_count: 0})
+
+        self.assertEqual(recount_post_counts(), {"users": 1, "tags": 0})
+        db.session.commit()
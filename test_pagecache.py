@@ -0,0 +1,144 @@
+import gc
+import os
+import tempfile
+import weakref
+from unittest import TestCase
+
+from sqlalchemy.orm import Session
+
+from pagecache import MemoryBackend, SharedBackend, PageCache, TOUCH_INTERVAL, _listen_for_writes
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MemoryBackendTestCase(TestCase):
+    """Tests LRU and TTL eviction of the in-process backend"""
+
+    def make_backend(self, clock):
+        return MemoryBackend(max_entries=2, clock=clock)
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        backend = self.make_backend(clock)
+        backend.set("/", "home", ttl=10)
+
+        self.assertEqual(backend.get("/"), "home")
+        clock.now += 11
+        self.assertIsNone(backend.get("/"))
+
+    def test_lru_eviction(self):
+        backend = self.make_backend(FakeClock())
+        backend.set("/a", "a", ttl=10)
+        backend.set("/b", "b", ttl=10)
+        backend.get("/a")
+        backend.set("/c", "c", ttl=10)
+
+        self.assertEqual(backend.get("/a"), "a")
+        self.assertIsNone(backend.get("/b"))
+        self.assertEqual(backend.get("/c"), "c")
+
+    def test_clear_skips_pages_rendered_before_it(self):
+        cache = PageCache(self.make_backend(FakeClock()), ttl=10)
+        generation = cache.generation()
+        cache.clear()
+        cache.set("/", "stale", generation)
+
+        self.assertIsNone(cache.get("/"))
+
+
+    def test_cleared_within(self):
+        clock = FakeClock()
+        cache = PageCache(self.make_backend(clock), ttl=10)
+        self.assertFalse(cache.cleared_within(5))
+
+        cache.clear()
+        clock.now += 4
+        self.assertTrue(cache.cleared_within(5))
+        clock.now += 1
+        self.assertFalse(cache.cleared_within(5))
+
+
+class SharedBackendTestCase(MemoryBackendTestCase):
+    """Runs the same checks against the SQLite-file backend"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def make_backend(self, clock):
+        return SharedBackend(self.path, max_entries=2, clock=clock)
+
+    def test_lru_eviction(self):
+        """Test a read moves a page up only once its last use is TOUCH_INTERVAL old"""
+        clock = FakeClock()
+        backend = self.make_backend(clock)
+        backend.set("/a", "a", ttl=10 * TOUCH_INTERVAL)
+        clock.now += 1
+        backend.set("/b", "b", ttl=10 * TOUCH_INTERVAL)
+        clock.now += TOUCH_INTERVAL
+        backend.get("/a")
+        clock.now += 1
+        backend.set("/c", "c", ttl=10 * TOUCH_INTERVAL)
+
+        self.assertEqual(backend.get("/a"), "a")
+        self.assertIsNone(backend.get("/b"))
+        self.assertEqual(backend.get("/c"), "c")
+
+    def test_recent_hits_dont_write(self):
+        clock = FakeClock()
+        backend = self.make_backend(clock)
+        backend.set("/", "home", ttl=10)
+        changes = backend._conn().total_changes
+        clock.now += 1
+        backend.get("/")
+        backend.get("/")
+
+        self.assertEqual(backend._conn().total_changes, changes)
+
+    def test_shared_between_instances(self):
+        clock = FakeClock()
+        one, two = self.make_backend(clock), self.make_backend(clock)
+        one.set("/tags", "tags", ttl=10)
+
+        self.assertEqual(two.get("/tags"), "tags")
+        two.clear()
+        self.assertIsNone(one.get("/tags"))
+
+
+class InvalidationTestCase(TestCase):
+    """Tests the commit listeners shared by every page cache in the process"""
+
+    def test_commit_clears_every_cache(self):
+        caches = [PageCache(MemoryBackend(), ttl=10) for _ in range(2)]
+        for cache in caches:
+            _listen_for_writes(cache)
+            cache.set("/", "home", cache.generation())
+
+        session = Session()
+        session.info["pages_stale"] = True
+        session.commit()
+
+        self.assertEqual([cache.get("/") for cache in caches], [None, None])
+
+    def test_listeners_dont_keep_caches_alive(self):
+        """Test a later cache adds no listeners of its own, so an app's cache goes away with it"""
+        cache = PageCache(MemoryBackend(), ttl=10)
+        _listen_for_writes(cache)
+        ref = weakref.ref(cache)
+        del cache
+        gc.collect()
+
+        self.assertIsNone(ref())
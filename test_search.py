@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from search import InvertedIndex, tokenize, highlight
+
+
+class InvertedIndexTestCase(TestCase):
+    """Tests the in-process search index used when Postgres isn't available"""
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.build([
+            (1, "Dragon hunting", "A long trip east"),
+            (2, "Breakfast", "Then a dragon appeared, a red dragon"),
+            (3, "Gardening", "Red roses"),
+        ])
+
+    def test_title_matches_rank_first(self):
+        ids = [id for score, id in self.index.search(["dragon"])]
+        self.assertEqual(ids, [1, 2])
+
+    def test_all_terms_required(self):
+        ids = [id for score, id in self.index.search(["red", "dragon"])]
+        self.assertEqual(ids, [2])
+
+    def test_update_and_remove(self):
+        self.index.update(3, "Gardening with dragons", "Red roses")
+        self.index.remove(1)
+
+        self.assertEqual([id for score, id in self.index.search(tokenize("gardening dragons"))], [3])
+        self.assertEqual([id for score, id in self.index.search(tokenize("hunting"))], [])
+
+    def test_tokenize_and_highlight(self):
+        self.assertEqual(tokenize("Red, red DRAGON!"), ["red", "red", "dragon"])
+        self.assertEqual(highlight("<b>\x02x\x03</b>"), "&lt;b&gt;<mark>x</mark>&lt;/b&gt;")
+
+    def test_plurals_and_verb_endings_match(self):
+        self.assertEqual(tokenize("dragons hunting stories glass"), ["dragon", "hunt", "story", "glass"])
+        self.assertEqual(tokenize("red beds"), ["red", "bed"])